@@ -0,0 +1,77 @@
+# Copyright (C) 2024 Salvatore Sanfilippo <antirez@gmail.com>
+# All Rights Reserved
+#
+# This code is released under the BSD 2 clause license.
+# See the LICENSE file for more information
+
+from array import array
+from micropython import const
+
+_MAX_FRAME_LEN = const(255)
+
+# Return the time on air, in milliseconds, of a LoRa frame with a payload
+# of 'payload_len' bytes, using the formula of the Semtech datasheets:
+#
+#   Tsym = 2^SF / BW
+#   Tpreamble = (preamble + 4.25) * Tsym
+#   Npayload = 8 + max(ceil((8*PL - 4*SF + 28 + 16*CRC - 20*IH) /
+#                           (4*(SF - 2*DE))) * (CR+4), 0)
+#   ToA = Tpreamble + Npayload * Tsym
+#
+# Where IH is 1 for implicit header mode, DE is 1 when low data rate
+# optimization is enabled, and CR is 1 to 4 for coding rates 4/5 to 4/8.
+# 'cr' is passed as the denominator of the coding rate (5 to 8) as in
+# the rest of the code base.
+def time_on_air(payload_len, sf, bw, cr, preamble=10, explicit_header=False, crc=True, ldro=True):
+    tsym = (1 << sf) / bw * 1000
+    ih = 0 if explicit_header else 1
+    de = 1 if ldro else 0
+    num = 8*payload_len - 4*sf + 28 + (16 if crc else 0) - 20*ih
+    den = 4*(sf - 2*de)
+    nsym = 8 + max(-(-num // den) * cr, 0)  # -(-a//b) is ceil(a/b).
+    return (preamble + 4.25) * tsym + nsym * tsym
+
+# Precomputed time on air for every frame length of a given radio
+# configuration, so that predicting the airtime of a frame is just a
+# table lookup. Values are in milliseconds, rounded up.
+#
+# In implicit header mode the radio always transmits 'fixed_len' bytes,
+# whatever the length of the data, and get() takes this into account.
+class AirtimeTable:
+    def __init__(self, sf, bw, cr, preamble=10, explicit_header=False, crc=True, ldro=True, fixed_len=None):
+        self.sf = sf
+        self.bw = bw
+        self.cr = cr
+        self.fixed_len = None if explicit_header else fixed_len
+        self.table = array('I',[0]*(_MAX_FRAME_LEN+1))
+        for l in range(_MAX_FRAME_LEN+1):
+            toa = time_on_air(l,sf,bw,cr,preamble,explicit_header,crc,ldro)
+            self.table[l] = int(toa) + (toa != int(toa))
+
+    # Return the time on air in milliseconds of a frame carrying
+    # 'frame_len' bytes of data.
+    def get(self, frame_len):
+        if self.fixed_len: frame_len = self.fixed_len
+        return self.table[min(frame_len,_MAX_FRAME_LEN)]
+
+    # Return the length of the longest frame with a time on air of at
+    # most 'ms' milliseconds, or -1 if even an empty frame takes longer.
+    def max_len(self, ms):
+        if self.fixed_len:
+            return _MAX_FRAME_LEN if self.get(0) <= ms else -1
+        lo, hi = -1, _MAX_FRAME_LEN   # table[lo] <= ms, table[hi+1] > ms
+        while lo < hi:
+            mid = (lo+hi+1)//2
+            if self.table[mid] <= ms: lo = mid
+            else: hi = mid-1
+        return lo
+
+# Return the preamble length, in symbols, frames must have in order to
+# be received by nodes in RX duty cycle mode, listening 'rx_ms' and then
+# sleeping 'sleep_ms' milliseconds. As suggested by Semtech, the preamble
+# must last at least sleep_ms + 2*rx_ms, so that whenever the frame is
+# sent, at least one full RX window falls inside the preamble.
+def wakeup_preamble_len(sf, bw, rx_ms, sleep_ms):
+    tsym_us = (1 << sf) * 1000000 // bw
+    preamble = -(-(sleep_ms + 2*rx_ms) * 1000 // tsym_us) + 1
+    return min(preamble, 0xffff)
@@ -0,0 +1,708 @@
+# Copyright (C) 2024 Salvatore Sanfilippo <antirez@gmail.com>
+# All Rights Reserved
+#
+# This code is released under the BSD 2 clause license.
+# See the LICENSE file for more information
+
+# Benchmarks of the FreakWAN hot paths. Upload this file to the device
+# and run from the REPL with:
+#
+#   import bench
+#   bench.run()
+#
+# The radio is simulated (see sx1262_sim.py), so the benchmarks can also
+# run on the host with CPython:
+#
+#   PYTHONPATH=host:. python3 bench.py
+
+import time, gc, asyncio, os, hashlib
+import sx1262
+from sx1262_sim import SimRadio, SimChannel
+from message import Message, SeenMessage, MessagePool
+from keychain import Keychain
+from textcodec import compress, decompress
+from scheduler import *
+
+# Count the commands issued by the main driver operations and the time
+# they keep the caller blocked. For comparison we also report how long
+# the old fixed 4 ms delay after every command would have blocked.
+def bench_commands():
+    print("== SX1262 commands (simulated chip)")
+    lora = sx1262.SX1262({'backend':SimRadio()}, None)
+    ops = (('begin', lambda: lora.begin()),
+           ('configure', lambda: lora.configure(869500000,125000,8,12,22)),
+           ('receive', lambda: lora.receive()),
+           ('reconfigure, no change', lambda: lora.configure(
+                869500000,125000,8,12,22,incremental=True)),
+           ('reconfigure, TX power', lambda: lora.configure(
+                869500000,125000,8,12,10,incremental=True)),
+           ('send', lambda: lora.send(bytes(20))),
+           ('receive after TX', lambda: lora.receive()),
+           ('reconfigure after TX, no change', lambda: lora.configure(
+                869500000,125000,8,12,10,incremental=True)))
+    for name, op in ops:
+        cmd_count = lora.cmd_count
+        busy_wait_us = lora.busy_wait_us
+        start = time.ticks_us()
+        op()
+        elapsed = time.ticks_diff(time.ticks_us(),start)
+        cmd_count = lora.cmd_count - cmd_count
+        busy_wait_us = lora.busy_wait_us - busy_wait_us
+        print(f"{name}: {cmd_count} commands, blocked {elapsed} us "
+              f"({busy_wait_us} us waiting BUSY), "
+              f"fixed 4 ms delay: {cmd_count*4000} us")
+
+# Return the bytes allocated by each call of f(), or None if the
+# platform can't tell us (gc.mem_alloc() is MicroPython specific).
+def allocated_per_call(f, count=100):
+    if not hasattr(gc,'mem_alloc'): return None
+    gc.collect()
+    gc.disable()
+    start = gc.mem_alloc()
+    for i in range(count): f()
+    allocated = gc.mem_alloc()-start
+    gc.enable()
+    return allocated/count
+
+# Return the heap bytes retained by each of the 'count' objects created
+# by f(i), using gc.mem_alloc() on MicroPython, tracemalloc on CPython,
+# or None if neither is available. The list holding the objects is
+# included, a few bytes per object.
+def retained_per_object(f, count=200):
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if hasattr(gc,'mem_alloc'):
+        used = gc.mem_alloc
+    elif tracemalloc:
+        tracemalloc.start()
+        used = lambda: tracemalloc.get_traced_memory()[0]
+    else:
+        return None
+    objects = []
+    gc.collect()
+    start = used()
+    for i in range(count): objects.append(f(i))
+    gc.collect()
+    retained = used()-start
+    if tracemalloc and tracemalloc.is_tracing(): tracemalloc.stop()
+    return retained/count
+
+# Heap bytes used by each entry of the processed messages cache: the
+# messages we originate (with and without ACKs) are cached as they are,
+# the ones we receive as a SeenMessage record.
+def bench_cache(count=200):
+    print("== Processed messages cache, heap bytes per entry")
+    keychain = Keychain()
+    encoded = [Message(content=f'{i:04d}',key_name=keychain.device_key_name
+               ).encode(keychain=keychain) for i in range(count)]
+
+    def acked(i):
+        m = Message(nick='ME', content=f'{i:04d}')
+        m.add_ack('N1')
+        return m
+
+    for name, f in (
+        ('sent message', lambda i: Message(nick='ME', content=f'{i:04d}')),
+        ('sent message with ACKs', acked),
+        ('received message', lambda i: Message.from_encoded(encoded[i],keychain)),
+        ('received message record', lambda i: SeenMessage(i))):
+        retained = retained_per_object(f, count)
+        if retained == None:
+            print(f"{name}: heap usage not available")
+        else:
+            print(f"{name}: {retained:.0f} bytes")
+
+# Heap allocations of the driver for a full RX cycle (IRQ status, read
+# of the frame into the RX ring, callback) and a full TX cycle (send,
+# then TX done IRQ and return to RX), and of the decoding of a DATA
+# frame, that is what relays and duplicates cost, since their content
+# is never turned into a string. Decoding into a message taken from
+# the message pool, as the receive path does, should allocate much less.
+def bench_alloc():
+    print("== SX1262 allocations per cycle (simulated chip)")
+    radio = SimRadio()
+    lora = sx1262.SX1262({'backend':radio}, None)
+    lora.received_callback = lambda lora, packet, rssi, snr, bad_crc: None
+    lora.begin()
+    lora.configure(869500000,125000,8,12,22)
+    lora.receive()
+    frame = bytes(20)
+    keychain = Keychain()
+    data = Message(content='0000',key_name=keychain.device_key_name).encode(
+        keychain=keychain)
+
+    def rx_cycle():
+        radio.inject(frame)
+        lora.service_irq()
+
+    def tx_cycle():
+        lora.send(frame)
+        radio.tx_done()
+        lora.service_irq()
+
+    def decode():
+        Message.from_encoded(data, keychain)
+
+    pool = MessagePool()
+    def pooled_decode():
+        m = pool.acquire()
+        m.decode(data, keychain)
+        pool.release(m)
+
+    for name, f in (('RX', rx_cycle), ('TX', tx_cycle), ('DATA decode', decode),
+                    ('pooled DATA decode', pooled_decode)):
+        allocated = allocated_per_call(f)
+        if allocated == None:
+            print(f"{name} cycle: gc.mem_alloc() not available")
+        else:
+            print(f"{name} cycle: {allocated:.0f} bytes allocated")
+
+# Two nodes on a simulated channel delivering frames instantly: measure
+# the CPU time per DATA frame of encoding and encryption, of the radio
+# path (TX on one node, RX ring and callback on the other), and of
+# decryption and decoding.
+def bench_link(count=200):
+    print("== DATA frame CPU time (simulated link)")
+    keychain = Keychain()
+    channel = SimChannel(airtime_scale=0)
+    received = []
+    a = sx1262.SX1262({'backend':SimRadio(channel)}, None)
+    b = sx1262.SX1262({'backend':SimRadio(channel)},
+        lambda lora, packet, rssi, snr, bad_crc: received.append(bytes(packet)))
+    for lora in (a, b):
+        lora.begin()
+        lora.configure(869500000,125000,8,12,22)
+        lora.receive()
+
+    encode_us = radio_us = decode_us = 0
+    for i in range(count):
+        m = Message(nick=keychain.device_key_name, content=f'{i:04d}',
+                    key_name=keychain.device_key_name)
+        start = time.ticks_us()
+        encoded = m.encode(keychain=keychain)
+        t1 = time.ticks_us()
+        a.send(encoded)
+        channel.tick()
+        a.service_irq()
+        b.service_irq()
+        t2 = time.ticks_us()
+        decoded = Message.from_encoded(received.pop(), keychain)
+        t3 = time.ticks_us()
+        if not decoded or decoded.content != m.content:
+            print("Frame corrupted in the simulated link")
+            return
+        encode_us += time.ticks_diff(t1,start)
+        radio_us += time.ticks_diff(t2,t1)
+        decode_us += time.ticks_diff(t3,t2)
+    total = encode_us+radio_us+decode_us
+    print(f"encode {encode_us/count:.0f} us, radio {radio_us/count:.0f} us, "
+          f"decode {decode_us/count:.0f} us, "
+          f"{count*1000000/total:.0f} frames/sec")
+
+# Find the key of an encrypted packet hashing all the keys, as the
+# keychain did before having the key id index. Used for comparison.
+def scan_key_id(keychain, key_id):
+    for key_name, key in keychain.keys.items():
+        if hashlib.sha256(key).digest()[:3] == key_id: return key_name
+    return None
+
+# Cost of decrypting a DATA frame with keychains of different sizes. The
+# frame is encrypted with the last key added, the worst case for a scan
+# of all the keys.
+def bench_keychain(sizes=(1,8,32,64), count=50):
+    print("== Keychain decrypt cost vs keychain size")
+    keys_dir = 'bench_keys'
+    try: os.mkdir(keys_dir)
+    except: pass
+    with open(f'{keys_dir}/*BEN', 'wb') as f: f.write(b'bench')
+    keychain = Keychain(keys_dir)
+    added = 0
+    for size in sizes:
+        while len(keychain.keys) < size:
+            keychain.add_key(f'K{added:03d}', f'key-{added}')
+            added += 1
+        last = keychain.list_keys()[-1]
+        packet = keychain.encrypt(bytes(13), last)
+
+        start = time.ticks_us()
+        for i in range(count): keychain.decrypt(packet)
+        index_us = time.ticks_diff(time.ticks_us(),start)/count
+
+        start = time.ticks_us()
+        for i in range(count): scan_key_id(keychain, packet[:3])
+        scan_us = time.ticks_diff(time.ticks_us(),start)/count
+        print(f"{len(keychain.keys)} keys: decrypt {index_us:.0f} us, "
+              f"key lookup without index {scan_us:.0f} us")
+    if keychain.collisions:
+        print(f"Key id collisions: {keychain.collisions}")
+    for key_name in keychain.list_keys(): keychain.del_key(key_name)
+    os.remove(f'{keys_dir}/*BEN')
+    os.rmdir(keys_dir)
+
+# XOR the packet with the key byte by byte, as the keychain did before
+# caching the keystreams. Used for comparison.
+def xor_loop(packet, key):
+    encrypted = bytearray(packet)
+    for i in range(len(packet)):
+        encrypted[i] ^= key[i % len(key)]
+    return bytes(encrypted)
+
+# Cost of the ciphers per frame: XOR, compared with the byte by byte
+# loop, and AES-CTR if cryptolib is available. Decrypting costs the same
+# as encrypting, plus the key lookup, see bench_keychain().
+def bench_cipher(count=200):
+    print("== Cipher cost per frame")
+    keychain = Keychain()
+    key_name = keychain.device_key_name
+    key = keychain.keys[key_name]
+    try:
+        aes_keychain = Keychain(cipher='aes')
+    except Exception as e:
+        aes_keychain = None
+        print(f"AES: {e}")
+    nonce = b'\x01\x02\x03'
+
+    def cost(f):
+        start = time.ticks_us()
+        for i in range(count): f()
+        return time.ticks_diff(time.ticks_us(),start)/count
+
+    for size in (20, 128, 255):
+        packet = bytes(range(size))
+        xor_us = cost(lambda: keychain.encrypt(packet, key_name))
+        loop_us = cost(lambda: xor_loop(packet, key))
+        report = f"{size} bytes: XOR {xor_us:.1f} us " \
+                 f"(byte by byte {loop_us:.1f} us)"
+        if aes_keychain:
+            aes_us = cost(lambda: aes_keychain.encrypt(packet, key_name, nonce))
+            report += f", AES-CTR {aes_us:.1f} us"
+        print(report)
+
+# Size on air of DATA frames (explicit header mode) with typical chat
+# and sensor messages, compressed with textcodec.py and not, and the
+# cost of compression and decompression.
+def bench_textcodec(count=100):
+    print("== Text compression of DATA messages")
+    texts = ('0042', 'ok', 'Hello, how are you?', 'ciao a tutti, ci sono',
+             'temp 21.5°C hum 40% bat 3.9 volt',
+             "I'm near the bridge, can you see the lights from there?",
+             'The node on the hill is back, rssi -98 dBm and snr 5. '*3)
+    for text in texts:
+        data = text.encode()
+        packed = compress(data)
+        start = time.ticks_us()
+        for i in range(count): compress(data)
+        compress_us = time.ticks_diff(time.ticks_us(),start)/count
+        start = time.ticks_us()
+        for i in range(count): decompress(packed)
+        decompress_us = time.ticks_diff(time.ticks_us(),start)/count
+        frame_len = len(Message(content=text).encode(
+            keychain=Keychain(),variable_len=True))
+        print(f"{len(data)} bytes -> {len(packed)} bytes, frame {frame_len} "
+              f"bytes (raw {len(data)+8}), compress {compress_us:.0f} us, "
+              f"decompress {decompress_us:.0f} us")
+
+# One cron tick of the send queue as a list, as send_messages_in_queue()
+# did before the scheduler, when no message is due: every message is
+# popped and the list is rebuilt. Used for comparison.
+def list_queue_tick(queue):
+    send_later = []
+    while len(queue):
+        m = queue.pop(0)
+        if time.ticks_diff(time.ticks_ms(),m.send_time) > 0: pass
+        send_later.append(m)
+    return queue + send_later
+
+# Cost of the send queue operations with different queue depths: a
+# cron tick when nothing is due, queueing a message, and sending the
+# next message and queueing it again for retransmission.
+def bench_scheduler(depths=(50,500,5000), count=20):
+    print("== Send queue cost vs queue depth")
+    import urandom
+    for depth in depths:
+        now = time.ticks_ms()
+        messages = []
+        for i in range(depth):
+            m = Message()
+            m.send_time = time.ticks_add(now,60000+urandom.randint(0,60000))
+            messages.append(m)
+
+        queue = list(messages)
+        start = time.ticks_us()
+        for i in range(count): queue = list_queue_tick(queue)
+        list_tick_us = time.ticks_diff(time.ticks_us(),start)/count
+
+        scheduler = SendScheduler()
+        start = time.ticks_us()
+        for m in messages: scheduler.push(m)
+        push_us = time.ticks_diff(time.ticks_us(),start)/depth
+
+        start = time.ticks_us()
+        for i in range(count): scheduler.next_due_ms() > 0
+        tick_us = time.ticks_diff(time.ticks_us(),start)/count
+
+        start = time.ticks_us()
+        for i in range(count):
+            m = scheduler.pop()
+            m.send_time = time.ticks_add(m.send_time,60000)
+            scheduler.push(m)
+        requeue_us = time.ticks_diff(time.ticks_us(),start)/count
+
+        print(f"{depth} messages: idle tick {tick_us:.1f} us "
+              f"(list {list_tick_us:.0f} us), push {push_us:.1f} us, "
+              f"send and requeue {requeue_us:.1f} us")
+
+# A relay storm: the queue receives many more messages than it can
+# send, mostly relays. Compare a single queue, refusing messages when
+# full, with the queue split by class, and count for each class the
+# messages that were sent and the ones that were dropped.
+def bench_send_queue(count=400, drain_every=3):
+    print("== Send queue under a relay storm")
+    import urandom
+    urandom.seed(1234)
+    classes = []
+    for i in range(count):
+        r = urandom.randint(0,99)
+        if r < 70: classes.append(SEND_CLASS_RELAY)
+        elif r < 80: classes.append(SEND_CLASS_DATA)
+        elif r < 95: classes.append(SEND_CLASS_ACK)
+        else: classes.append(SEND_CLASS_BEACON)
+    ttls = [urandom.randint(1,15) for c in classes]
+
+    for name in ('Single queue','Class queues'):
+        if name == 'Single queue':
+            queue = SendScheduler()
+            def push(m):
+                if len(queue) >= 50: return m
+                queue.push(m)
+        else:
+            queue = SendQueue()
+            push = queue.push
+        sent = [0]*len(SEND_CLASS_NAMES)
+        drops = [0]*len(SEND_CLASS_NAMES)
+        for i in range(count):
+            m = Message(ttl=ttls[i])
+            m.send_class = classes[i]
+            dropped = push(m)
+            if dropped: drops[dropped.send_class] += 1
+            if i % drain_every == 0:
+                m = queue.pop()
+                if m: sent[m.send_class] += 1
+        print(f"{name}: " + ", ".join(
+              [f"{SEND_CLASS_NAMES[c]} {sent[c]} sent/{drops[c]} dropped"
+               for c in range(len(SEND_CLASS_NAMES))]))
+
+# A node that always has something to send: high priority frames
+# every 'high_every' milliseconds, and low priority ones whenever the
+# airtime budget allows. Check the worst airtime in any window against
+# the duty cycle limit, and how the budget was split. The window is
+# scaled down to 'window' seconds.
+def bench_budget(limit=10, window=5, duration=15, frame=20, high_every=400):
+    print("== Airtime budget admission control")
+    from dutycycle import AirtimeBudget
+    budget = AirtimeBudget(limit, window, frame)
+    sent = []       # (time, priority) of each frame.
+    start = time.ticks_ms()
+    next_high = 0
+    busy_until = -1
+    while True:
+        now = time.ticks_diff(time.ticks_ms(),start)
+        if now >= duration*1000: break
+        if now < busy_until: continue   # Still on air.
+        high = now >= next_high
+        if budget.wait_ms(frame, not high) == 0:
+            budget.charge(frame)
+            sent.append((now,high))
+            busy_until = now+frame
+            if high: next_high += high_every
+    worst = 0
+    for i in range(len(sent)):
+        on_air = sum([frame for t, h in sent[i:]
+                      if t < sent[i][0]+window*1000])
+        worst = max(worst,on_air)
+    high = len([s for s in sent if s[1]])
+    print(f"Limit {limit}%: worst {window} s window {worst/(window*10):.2f}%, "
+          f"average {len(sent)*frame/(duration*10):.2f}%, "
+          f"high priority {high}/{-(-duration*1000//high_every)} sent, "
+          f"low priority {len(sent)-high} sent")
+
+# Log nothing: the benchmarks don't need the SD card and the RTC.
+class NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+    def log_sys(self, *args, **kwargs):
+        pass
+
+    def log_msg(self, *args, **kwargs):
+        pass
+
+# Return a FreakWAN node on the simulated channel 'channel', using
+# the default configuration with the 'lora' and 'FW' options
+# overridden by the ones passed.
+def make_node(channel, name, lora={}, fw={}):
+    from freakwan import FreakWAN
+    from config import Config
+    from nodes import Nodes
+
+    config = {}
+    for group, items in Config('configs').get_plain().items():
+        config[group] = dict(items) if isinstance(items, dict) else items
+    config['sx1262'] = {'backend':SimRadio(channel)}
+    config['FW']['automsg'] = False
+    config['FW']['testing'] = False
+    config['lora'].update(lora)
+    config['FW'].update(fw)
+    logger = NullLogger()
+    node = FreakWAN(logger, config, Nodes(logger), lambda cb: None)
+    node.device_name = name
+    node.serial_log_enabled = False
+    return node
+
+# Two complete FreakWAN nodes on a simulated channel with the real time
+# on air: node A sends DATA messages, node B receives them and replies
+# with ACKs. Measure the delivery and the ACK latency.
+async def bench_freakwan_async(count, sf, bw):
+    channel = SimChannel()
+    nodes = [make_node(channel, name, {'sf':sf,'bw':bw},
+                       {'acks':True,'relays':False}) for name in ('SA','SB')]
+    a, b = nodes
+    tasks = [asyncio.create_task(channel.run())]
+    for fw in nodes: tasks.append(asyncio.create_task(fw.cron()))
+
+    delivery_ms = ack_ms = delivered = acked = 0
+    for i in range(count):
+        m = Message(nick=a.device_name, content=f'{i:04d}',
+                    key_name=a.keychain.device_key_name)
+        a.send_asynchronously(m, max_delay=0)
+        start = time.ticks_ms()
+        got_data = False
+        while time.ticks_diff(time.ticks_ms(),start) < 10000:
+            if not got_data and b.get_processed_message(m.uid):
+                got_data = True
+                delivered += 1
+                delivery_ms += time.ticks_diff(time.ticks_ms(),start)
+            if m.acks:
+                acked += 1
+                ack_ms += time.ticks_diff(time.ticks_ms(),start)
+                break
+            await asyncio.sleep_ms(1)
+    for t in tasks: t.cancel()
+    pool = b.message_pool
+    print(f"Receiver message pool: {pool.reused} reused, "
+          f"{pool.allocated} allocated")
+    print(f"SF{sf} BW{bw}: delivered {delivered}/{count}, "
+          f"avg latency {delivery_ms/max(delivered,1):.0f} ms "
+          f"(time on air {a.airtime.get(20)} ms), acked {acked}/{count}, "
+          f"avg ACK latency {ack_ms/max(acked,1):.0f} ms")
+
+def bench_freakwan(count=10, sf=7, bw=250000):
+    print("== FreakWAN DATA and ACK latency (simulated channel)")
+    asyncio.run(bench_freakwan_async(count, sf, bw))
+
+# Node A sends a burst of DATA messages, and node B replies with an ACK
+# for each one. Return the messages acked, the frames B transmitted,
+# their time on air, and node B. The 'lora' and 'fw' options of node B
+# override the defaults.
+async def ack_burst(count, lora, fw):
+    channel = SimChannel()
+    a = make_node(channel, 'SA', lora, {'acks':True,'relays':False})
+    fw = dict(fw, acks=True, relays=False)
+    b = make_node(channel, 'SB', lora, fw)
+    tx_frames = tx_airtime = 0
+    b_send = b.lora.send
+    def send(data):
+        nonlocal tx_frames, tx_airtime
+        tx_frames += 1
+        tx_airtime += b.airtime.get(len(data))
+        b_send(data)
+    b.lora.send = send
+    tasks = [asyncio.create_task(channel.run())]
+    for node in (a, b): tasks.append(asyncio.create_task(node.cron()))
+
+    sent = []
+    for i in range(count):
+        m = Message(nick=a.device_name, content=f'{i:04d}',
+                    key_name=a.keychain.device_key_name)
+        a.send_asynchronously(m, max_delay=count*200)
+        sent.append(m)
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(),start) < 20000:
+        if all(m.acks for m in sent): break
+        await asyncio.sleep_ms(10)
+    for t in tasks: t.cancel()
+    acked = len([m for m in sent if m.acks])
+    return acked, tx_frames, tx_airtime, b
+
+# With aggregation B should send the ACKs in a few bundles, instead of
+# one frame each.
+def bench_bundle(count=10):
+    print("== ACK aggregation (simulated channel)")
+    lora = {'sf':7,'bw':250000,'explicit_header':True}
+    for bundle in (False, True):
+        acked, frames, airtime, b = asyncio.run(ack_burst(count, lora,
+            {'ack_batch':False,'bundle':bundle}))
+        print(f"Aggregation {'on' if bundle else 'off'}: acked {acked}/{count}, "
+              f"{frames} frames, {airtime} ms on air, "
+              f"frames saved {b.bundle_frames_saved}, "
+              f"airtime saved {b.bundle_airtime_saved} ms")
+
+# Airtime of single ACKs compared to batched ACKs, with fixed length
+# and variable length frames.
+def bench_acks(count=10):
+    print("== Batched ACKs (simulated channel)")
+    for explicit in (False, True):
+        lora = {'sf':7,'bw':250000,'explicit_header':explicit}
+        for batch in (False, True):
+            acked, frames, airtime, b = asyncio.run(ack_burst(count, lora,
+                {'ack_batch':batch,'bundle':False}))
+            print(f"{'Explicit' if explicit else 'Implicit'} header, "
+                  f"{'batched' if batch else 'single'} ACKs: "
+                  f"acked {acked}/{count}, {frames} frames, "
+                  f"{airtime} ms on air")
+
+# Three nodes in a line, A - B - C, with A and C out of range. The nodes
+# only send HELLOs: check that A learns from the HELLOs of B that C is
+# a neighbor of B, and how the HELLO period backs off once the network
+# is stable, past the node flush threshold without nodes timing out.
+# Periods are scaled down to run in 'duration' seconds.
+async def bench_hello_async(duration):
+    channel = SimChannel()
+    fw = {'hello_msg_period_min':1,'hello_msg_period_max':8,
+          'node_flush_threshold':4,'node_flush_interval':1}
+    lora = {'sf':7,'bw':250000}
+    a, b, c = [make_node(channel, name, lora, fw) for name in ('SA','SB','SC')]
+    channel.set_link(a.config['sx1262']['backend'],
+                     c.config['sx1262']['backend'], None)
+    tasks = [asyncio.create_task(channel.run())]
+    for node in (a, b, c): tasks.append(asyncio.create_task(node.cron()))
+    learned_ms = None
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(),start) < duration*1000:
+        if learned_ms == None and a.nodes.maybe_neighbor('SB','SC'):
+            learned_ms = time.ticks_diff(time.ticks_ms(),start)
+        await asyncio.sleep_ms(50)
+    for t in tasks: t.cancel()
+    for node in (a, b, c):
+        print(f"{node.device_name}: {node.nodes.count} neighbors, "
+              f"{node.config['sx1262']['backend'].tx_frames} HELLOs, "
+              f"period now {node.hello_period} s")
+    print(f"A learned that C is a neighbor of B after {learned_ms} ms, "
+          f"C neighbor of A: {a.nodes.seen('SC')}")
+
+def bench_hello(duration=30):
+    print("== HELLO beacons and 2-hop topology (simulated channel)")
+    asyncio.run(bench_hello_async(duration))
+
+# A node sends a burst of DATA messages all due at once: measure the
+# delay of the first frame, the idle air time between one frame and the
+# next, and how many times the transmit loop runs per second once the
+# queue is empty.
+async def tx_gaps(count, lbt):
+    channel = SimChannel()
+    a = make_node(channel, 'SA', {'sf':7,'bw':250000},
+                  {'acks':False,'relays':False,'lbt':lbt})
+    starts = []
+    a_send = a.lora.send
+    def send(data):
+        starts.append((time.ticks_ms(),a.airtime.get(len(data))))
+        a_send(data)
+    a.lora.send = send
+    loops = 0
+    a_send_messages = a.send_messages_in_queue
+    def send_messages():
+        nonlocal loops
+        loops += 1
+        a_send_messages()
+    a.send_messages_in_queue = send_messages
+    tasks = [asyncio.create_task(channel.run()),
+             asyncio.create_task(a.cron())]
+
+    await asyncio.sleep_ms(50)
+    start = time.ticks_ms()
+    for i in range(count):
+        m = Message(nick=a.device_name, content=f'{i:04d}',
+                    key_name=a.keychain.device_key_name)
+        a.send_asynchronously(m, max_delay=0)
+    while len(a.send_queue) and time.ticks_diff(time.ticks_ms(),start) < 10000:
+        await asyncio.sleep_ms(10)
+    await asyncio.sleep_ms(200)
+    loops = 0
+    await asyncio.sleep_ms(2000)
+    idle_loops = loops
+    for t in tasks: t.cancel()
+    # Only consider our burst: the node may also send a HELLO.
+    starts = [s for s in starts if time.ticks_diff(s[0],start) >= 0][:count]
+    gaps = [time.ticks_diff(starts[i+1][0],starts[i][0])-starts[i][1]
+            for i in range(len(starts)-1)]
+    return len(starts), time.ticks_diff(starts[0][0],start), \
+           sum(gaps)/max(len(gaps),1), idle_loops/2
+
+def bench_tx_gaps(count=10):
+    print("== Transmit loop: idle air gaps (simulated channel)")
+    for lbt in (False, True):
+        frames, first, gap, idle = asyncio.run(tx_gaps(count, lbt))
+        print(f"LBT {'on' if lbt else 'off'}: {frames} frames, "
+              f"first sent after {first} ms, "
+              f"avg gap between frames {gap:.1f} ms, "
+              f"{idle:.1f} transmit loops/sec when idle")
+
+# A dense cluster: all the nodes hear each other, and relay the messages
+# of node A. Count the relays transmitted with relay suppression off
+# (k=0) and on, and the nodes that got every message.
+async def relay_cluster(nodes_count, count, k):
+    channel = SimChannel()
+    fw = {'relays':True,'acks':False,'relay_suppress_k':k}
+    nodes = [make_node(channel, f'S{i}', {'sf':7,'bw':250000}, fw)
+             for i in range(nodes_count)]
+    a = nodes[0]
+    tasks = [asyncio.create_task(channel.run())]
+    for node in nodes: tasks.append(asyncio.create_task(node.cron()))
+    sent = []
+    for i in range(count):
+        m = Message(nick=a.device_name, content=f'{i:04d}', ttl=4,
+                    key_name=a.keychain.device_key_name)
+        a.send_asynchronously(m, max_delay=0, relay=True)
+        sent.append(m.uid)
+        await asyncio.sleep_ms(1000)
+    await asyncio.sleep_ms(a.config['FW']['relay_max_delay']+500)
+    for t in tasks: t.cancel()
+    relays = received = suppressed = saved = 0
+    for node in nodes[1:]:
+        relays += node.config['sx1262']['backend'].tx_frames
+        suppressed += node.relays_suppressed
+        saved += node.relay_airtime_saved
+        received += len([uid for uid in sent if node.get_processed_message(uid)])
+    return relays, received, suppressed, saved
+
+def bench_relays(nodes_count=6, count=8):
+    print("== Relay suppression in a dense cluster (simulated channel)")
+    for k in (0, 1, 2):
+        relays, received, suppressed, saved = asyncio.run(
+            relay_cluster(nodes_count, count, k))
+        print(f"k={k}: {relays} frames sent by the relays, "
+              f"received {received}/{(nodes_count-1)*count}, "
+              f"{suppressed} relays suppressed, {saved} ms of airtime saved")
+
+def run():
+    bench_commands()
+    bench_alloc()
+    bench_cache()
+    bench_link()
+    bench_keychain()
+    bench_cipher()
+    bench_textcodec()
+    bench_scheduler()
+    bench_send_queue()
+    bench_budget()
+    bench_freakwan()
+    bench_bundle()
+    bench_acks()
+    bench_hello()
+    bench_tx_gaps()
+    bench_relays()
+
+if __name__ == "__main__":
+    run()
@@ -160,7 +160,7 @@ class CommandsController:
             send_reply("Setting bw:"+str(self.fw.config['lora_bw'])+
                         " cr:"+str(self.fw.config['lora_cr'])+
                         " sp:"+str(self.fw.config['lora_sp']))
-            self.fw.lora_reset_and_configure()
+            self.fw.lora_reconfigure()
         else:
             send_reply("Valid presets: "+ ", ".join(x for x in LoRaPresets))
         return True
@@ -176,7 +176,7 @@ class CommandsController:
                 send_reply("Invalid tx power (dbm). Use 2-20.")
             else:
                 self.fw.config['lora_pw'] = txpower
-                self.fw.lora_reset_and_configure()
+                self.fw.lora_reconfigure()
         send_reply("TX power set to "+str(self.fw.config['lora_pw']))
         return True
 
@@ -191,7 +191,7 @@ class CommandsController:
                 send_reply("Invalid spreading. Use 6-12.")
             else:
                 self.fw.config['lora_sp'] = spreading
-                self.fw.lora_reset_and_configure()
+                self.fw.lora_reconfigure()
         send_reply("Spreading set to "+str(self.fw.config['lora_sp']))
         return True
 
@@ -206,7 +206,7 @@ class CommandsController:
                 send_reply("Invalid coding rate. Use 5-8.")
             else:
                 self.fw.config['lora_cr'] = cr 
-                self.fw.lora_reset_and_configure()
+                self.fw.lora_reconfigure()
         send_reply("Coding rate set to "+str(self.fw.config['lora_cr']))
         return True
 
@@ -224,7 +224,7 @@ class CommandsController:
                             ", ".join(str(x) for x in valid_bw_values))
             else:
                 self.fw.config['lora_bw'] = bw
-                self.fw.lora_reset_and_configure()
+                self.fw.lora_reconfigure()
         send_reply("bandwidth set to "+str(self.fw.config['lora_bw']))
         return True
 
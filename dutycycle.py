@@ -18,6 +18,10 @@ import time
 # 4 slots of 15 minutes. Each slot knows the total tx time
 # during that slot, in milliseconds. When we call get_duty_cycle()
 # the class will perform the average of the slots.
+#
+# start_tx() can also be given the predicted time on air of the frame
+# (see airtime.py), so that it is possible to compare the predicted
+# duty cycle with the measured one.
 class DutyCycle:
     def __init__(self,slots_num=4,slots_dur=60*15):
         self.slots_dur = slots_dur
@@ -29,8 +33,9 @@ class DutyCycle:
         # We initialize the epochs to -1 to mark the slots
         # as invalid, so that the algorithm will not count them
         # before they are populated with actual data.
-        self.slots = [{'txtime':0,'epoch':-1} for i in range(self.slots_num)]
+        self.slots = [{'txtime':0,'predicted':0,'epoch':-1} for i in range(self.slots_num)]
         self.tx_start_time = -1 # time.ticks_ms() of start_tx() call.
+        self.tx_predicted = 0   # Predicted airtime of the current TX.
 
     #  Return the current active slot. This is just the UNIX time
     # divided by the slot duration, modulo the number of slots. So
@@ -47,8 +52,9 @@ class DutyCycle:
     def get_epoch(self):
         return int(time.time()/self.slots_dur)
 
-    def start_tx(self):
+    def start_tx(self,predicted=0):
         self.tx_start_time = time.ticks_ms()
+        self.tx_predicted = predicted
 
     def get_current_tx_time(self):
         if self.tx_start_time == -1: return 0
@@ -62,21 +68,103 @@ class DutyCycle:
         if slot['epoch'] != epoch:
             slot['epoch'] = epoch
             slot['txtime'] = 0
+            slot['predicted'] = 0
         slot['txtime'] += txtime
+        slot['predicted'] += self.tx_predicted
         self.tx_start_time = -1
+        self.tx_predicted = 0
 
-    def get_duty_cycle(self):
+    # Return the duty cycle percentage. If 'predicted' is True, the
+    # predicted airtime passed to start_tx() is used instead of the
+    # measured one.
+    def get_duty_cycle(self,predicted=False):
+        field = 'predicted' if predicted else 'txtime'
         txtime = 0
         epoch = self.get_epoch()
         valid_slots = 0
         for slot in self.slots:
             # Add the time of slots yet not out of scope
             if slot['epoch'] > max(epoch-self.slots_num,0):
-                txtime += slot['txtime']
+                txtime += slot[field]
                 valid_slots += 1
         if valid_slots == 0: return 0
         return (txtime / (self.slots_dur*valid_slots*1000)) * 100
 
+# Admission control enforcing the duty cycle limit: DutyCycle only
+# measures the duty cycle after the fact, while this is a token bucket
+# of airtime, in milliseconds, that the transmitter must ask before
+# sending a frame, charging its predicted time on air (see airtime.py).
+#
+# The bucket refills at a bit less than the limit: 'limit' percent
+# of 'window' seconds is the airtime budget of the window. The capacity
+# of the bucket is 1% of it (but at least the largest frame), and it
+# refills at the rate the rest of the budget takes to accumulate in the
+# window. So in any window we can't transmit more than the capacity plus
+# what refilled, that is, the budget, while the average is 99% of the
+# limit.
+#
+# Low priority traffic must leave a reserve in the bucket, half of its
+# capacity: when we run out of budget, it is deferred first.
+class AirtimeBudget:
+    def __init__(self, limit, window, max_frame=0):
+        self.tokens = None
+        self.configure(limit, window, max_frame)
+        self.tokens = self.capacity
+
+    # Set the duty cycle limit (percentage), the window (seconds) and
+    # the airtime of the largest frame we could send (milliseconds).
+    # A limit of 0 or 100 disables the admission control.
+    #
+    # If the largest frame does not fit in the budget of the window, the
+    # bucket can't be sized so that the limit is never exceeded: in this
+    # case we refill at the rate of the limit, and a burst may exceed it.
+    def configure(self, limit, window, max_frame=0):
+        if self.tokens != None: self.refill()
+        self.enabled = limit > 0 and limit < 100
+        self.window_ms = window*1000
+        budget = self.window_ms*limit/100
+        self.capacity = max(budget/100, max_frame)
+        self.rate = (budget-self.capacity)/self.window_ms
+        if self.enabled and self.rate <= 0:
+            print(f"AirtimeBudget: a {max_frame:.0f} ms frame does not fit the {budget:.0f} ms budget of the window, the duty cycle limit may be exceeded")
+            self.rate = budget/self.window_ms
+        self.reserve = self.capacity/2
+        if self.tokens != None: self.tokens = min(self.tokens,self.capacity)
+        self.last_refill = time.ticks_ms()
+
+    def refill(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now,self.last_refill)
+        self.tokens = min(self.tokens+elapsed*self.rate,self.capacity)
+        self.last_refill = now
+
+    # Return 0 if a frame with the specified time on air can be sent now,
+    # otherwise the milliseconds to wait before it can be sent.
+    def wait_ms(self, airtime, low_priority=False):
+        if not self.enabled: return 0
+        self.refill()
+        needed = airtime
+        if low_priority: needed += min(self.reserve,self.capacity-airtime)
+        missing = needed-self.tokens
+        if missing <= 0: return 0
+        if self.rate == 0: return self.window_ms
+        return int(missing/self.rate)+1
+
+    # Return the airtime, in milliseconds, that can be sent right now
+    # by high priority traffic, or by low priority traffic if
+    # 'low_priority' is True, leaving the reserve alone.
+    def available(self, low_priority=False):
+        if not self.enabled: return self.window_ms
+        self.refill()
+        if low_priority: return self.tokens-self.reserve
+        return self.tokens
+
+    # Charge the bucket for a frame we are transmitting.
+    def charge(self, airtime):
+        if not self.enabled: return
+        self.refill()
+        self.tokens -= airtime
+
 if __name__ == "__main__":
     d = DutyCycle(slots_num=4,slots_dur=10)
     while True:
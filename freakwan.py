@@ -17,6 +17,27 @@ _SEND_MAX_DELAY = const(2000) # Random delay in milliseconds of asynchronous
 _TX_AGAIN_MIN_DELAY = const(3000)
 _TX_AGAIN_MAX_DELAY = const(8000)
 
+# Channel states returned by lbt_check_channel().
+_LBT_FREE = const(0)
+_LBT_BUSY = const(1)
+_LBT_WAIT = const(2)    # CAD in progress, no answer yet.
+
+# In listen-before-talk mode, a CAD result older than this many
+# milliseconds is considered stale and a new CAD is performed.
+_CAD_RESULT_MAX_AGE = const(500)
+
+# In listen-before-talk mode we trust the preamble / header detection
+# of modem_is_receiving_packet() only for a short time (milliseconds),
+# after that the CAD tells us if the channel is really busy.
+_LBT_PREAMBLE_HOLDOFF = const(500)
+_LBT_HEADER_HOLDOFF = const(1500)
+
+# When the earliest message of the send queue is due, but can't be sent
+# yet (a packet is on air, or the radio is stuck), the transmit task
+# checks again after this many milliseconds. TX and CAD completion, and
+# new messages, wake it up earlier. See transmit_task().
+_TX_RETRY_DELAY = const(100)
+
 _HELLO_MSG = const('>> sending HELLO ')
 _AUTO_MSG = const('>> sending AUTO ')
 
@@ -26,9 +47,11 @@ import sx1262
 from collections import OrderedDict
 from machine import Pin, SoftI2C, ADC, SPI
 from message import *
-from clictrl import CommandsController
-from dutycycle import DutyCycle
+from clictrl import CommandsController, LoRaPresets
+from dutycycle import DutyCycle, AirtimeBudget
+from airtime import AirtimeTable, wakeup_preamble_len
 from keychain import Keychain
+from scheduler import *
 
 
 # The application itself, including all the WAN routing logic.
@@ -54,17 +77,43 @@ class FreakWAN:
         else:
             self.tx_led = None
 
+        # Configure the duty cycle tracker, use a period of 60 minutes
+        # with 12 5min slots. Adjust according to regulations.
+        self.duty_cycle = DutyCycle(slots_num=12,slots_dur=60*5)
+
+        # Admission control enforcing the duty cycle limit in the
+        # same period. Configured with the radio, see
+        # configure_airtime_budget().
+        self.airtime_budget = AirtimeBudget(
+            self.config['FW']['duty_cycle_limit'],
+            self.duty_cycle.slots_num*self.duty_cycle.slots_dur)
+        self.budget_deferred = 0    # Frames deferred by the budget.
+
         # Init LoRa chip
         self.lora = sx1262.SX1262(self.config['sx1262'],self.receive_lora_packet,self.lora_tx_done)
+        self.lora.cad_callback = self.wake_transmit_task
         self.lora_reset_and_configure()
 
         # Create our CLI commands controller.
         self.cmdctrl = CommandsController(self)
 
-        # Queue of messages we should send ASAP. We append stuff here, so they
-        # should be sent in reverse order, from index 0.
-        self.send_queue = []
-        self.send_queue_max = 50 # Don't accumulate too many messages
+        # Queue of messages we should send ASAP, ordered by send time,
+        # with a capacity for each message class, see send_class().
+        self.send_queue = SendQueue(capacity=(16,20,30,4), max_len=50)
+
+        # Received messages and ACKs are taken from this pool, and put
+        # back when processed and sent. See release_message().
+        self.message_pool = MessagePool()
+
+        # Batched ACKs message in the send queue that more ACKs can
+        # still join, see send_ack_if_needed().
+        self.pending_acks = None
+
+        # Relays in the send queue: uid -> [message, copies overheard],
+        # see suppress_relay_if_needed().
+        self.pending_relays = {}
+        self.relays_suppressed = 0
+        self.relay_airtime_saved = 0
 
         # Track the RSSI history for the last few messages, to show on the display.
         self.rssi_history = []
@@ -75,17 +124,27 @@ class FreakWAN:
 
         # Our keychain is responsible of handling keys and
         # encrypting / decrypting packets.
-        self.keychain = Keychain()
+        self.keychain = Keychain(cipher=self.config['FW']['cipher'])
         self.device_name = self.keychain.device_key_name
 
-        # Configure the duty cycle tracker, use a period of 60 minutes
-        # with 12 5min slots. Adjust according to regulations.
-        self.duty_cycle = DutyCycle(slots_num=12,slots_dur=60*5)
+        # Listen-before-talk statistics: number of CADs performed, how
+        # many of them found the channel busy, and the total backoff
+        # time (in milliseconds) they caused.
+        self.cad_runs = 0
+        self.cad_busy = 0
+        self.cad_backoff_ms = 0
+
+        # Aggregation statistics: frames we didn't need to transmit since
+        # their messages traveled in a bundle, and the time on air (in
+        # milliseconds) this saved.
+        self.bundle_frames_saved = 0
+        self.bundle_airtime_saved = 0
 
         # The 'processed' dictionary contains messages IDs of messages already
         # received/processed. We save the ID and the associated message
-        # in case we are the originators (in order to collect acks). The
-        # message has also a timestamp, this way we can evict old messages
+        # in case we are the originators (in order to collect acks),
+        # otherwise just a small SeenMessage record. Both have a
+        # timestamp, this way we can evict old messages
         # from this list, to avoid a memory usage explosion.
         #
         # Note that we have two processed dict: a and b. Together, they
@@ -115,7 +174,13 @@ class FreakWAN:
         # Asyncio tasks
         self.auto_msg_task = None
         self.hello_msg_task = None
+        self.hello_period = 0   # Current HELLO period, see send_hello_message().
+        self.hello_params = None    # HELLO config the task started with.
+        self.lora_irq_task = None
         self.test_cycle_task = None
+        self.transmit_task_handle = None
+        self.tx_event = asyncio.Event() # Wakes up transmit_task().
+        self.config_event = asyncio.Event() # Wakes up cron().
 
     # Restart
     def reset(self):
@@ -126,6 +191,7 @@ class FreakWAN:
     def handle_config_update(self,new_config):
         self.config.update(new_config)
         self.config_updated = True
+        self.config_event.set()
         self.logger.log_sys(self.logger_tag, 'INFO', 'Config Updated')
 
     def update_rssi_history(self,rssi):
@@ -144,6 +210,56 @@ class FreakWAN:
     def get_duty_cycle(self):
         return self.duty_cycle.get_duty_cycle()
 
+    # Return the preamble length of the frames we send. Normally it is
+    # the default one, but in wake-up preamble mode it must be long
+    # enough for nodes in RX duty cycle mode to catch our frames.
+    def get_preamble_len(self, sf, bw):
+        lora_cfg = self.config['lora']
+        if not lora_cfg['wakeup_preamble']: return sx1262.DefaultPreambleLen
+        return wakeup_preamble_len(sf, bw,
+            lora_cfg['rx_window_ms'], lora_cfg['rx_sleep_ms'])
+
+    # Return the predicted airtime table for the specified LoRa
+    # parameters, matching how our radio is configured.
+    def get_airtime_table(self, sf, bw, cr):
+        return AirtimeTable(sf, bw, cr,
+            preamble=self.get_preamble_len(sf, bw),
+            explicit_header=self.config['lora']['explicit_header'],
+            fixed_len=sx1262.ImplicitPayloadLen)
+
+    # Return information about the predicted time on air, for the web UI:
+    # the airtime of frames of different sizes with the current radio
+    # configuration and with the LoRa presets, and the airtime of each
+    # message waiting in the send queue.
+    def get_airtime_info(self):
+        info = {}
+        info['lora'] = self.config['lora']
+        info['frames'] = {}
+        for l in (8, 20, 64, 128, 255):
+            info['frames'][str(l)] = self.airtime.get(l)
+        info['presets'] = {}
+        for name, p in LoRaPresets.items():
+            table = self.get_airtime_table(p['lora_sp'],p['lora_bw'],p['lora_cr'])
+            info['presets'][name] = table.get(20)
+        info['queue'] = []
+        total = 0
+        for m in self.send_queue:
+            if m.send_canceled: continue
+            encoded = m.encode(keychain=self.keychain,
+                               variable_len=self.lora.explicit_header)
+            if encoded == None: continue
+            airtime = self.airtime.get(len(encoded))*m.num_tx
+            total += airtime
+            info['queue'].append({'uid':f'{m.uid:04x}','type':m.type,
+                'len':len(encoded),'num_tx':m.num_tx,'airtime':airtime})
+        info['queue_airtime'] = total
+        info['queue_drops'] = dict(zip(SEND_CLASS_NAMES,self.send_queue.drops))
+        info['duty_cycle'] = self.duty_cycle.get_duty_cycle()
+        info['predicted_duty_cycle'] = self.duty_cycle.get_duty_cycle(predicted=True)
+        info['airtime_budget'] = self.airtime_budget.available()
+        info['budget_deferred'] = self.budget_deferred
+        return info
+
     async def cycle_configurations(self):
         cfg_dict = OrderedDict()
         
@@ -180,9 +296,9 @@ class FreakWAN:
                     lora_cfg[key] = int(current_cfg[key])
             
             # Apply new configuration
-            self.lora_reset_and_configure()
+            self.lora_reconfigure()
             
-            cfg_str = f'test={self.config["FW"]["test_cycle_file"]} cfg={cfg_index+1}/{len(cfg_dict)} lora={lora_cfg["fq"]}/{lora_cfg["bw"]}/{lora_cfg["sf"]}/{lora_cfg["cr"]}/{lora_cfg["pw"]}'
+            cfg_str = f'test={self.config["FW"]["test_cycle_file"]} cfg={cfg_index+1}/{len(cfg_dict)} lora={lora_cfg["fq"]}/{lora_cfg["bw"]}/{lora_cfg["sf"]}/{lora_cfg["cr"]}/{lora_cfg["pw"]} toa={self.airtime.get(20)}ms'
                 
             print(cfg_str)
             self.logger.log_sys(self.logger_tag, 'INFO', cfg_str)
@@ -200,15 +316,62 @@ class FreakWAN:
     def lora_reset_and_configure(self):
         was_receiving = self.lora.receiving
         self.lora.begin()
-        self.lora.configure(
-            self.config['lora']['fq'],
-            self.config['lora']['bw'],
-            self.config['lora']['cr'],
-            self.config['lora']['sf'],
-            self.config['lora']['pw'])
-        if was_receiving: self.lora.receive()
+        self.lora_configure(was_receiving)
         print(f'LoRa Reset: {self.config["lora"]}')
 
+    # Apply the current configuration to the radio without resetting
+    # it: the driver only sends the commands for the parameters that
+    # changed, so if for instance just the TX power changed, reception
+    # stops only for the time of a couple of commands.
+    def lora_reconfigure(self):
+        if self.lora_configure(self.lora.receiving, incremental=True):
+            print(f'LoRa Reconfigure: {self.config["lora"]}')
+
+    # Configure the radio according to the 'lora' configuration, and
+    # return back in receive mode if 'was_receiving' is True. Return
+    # True if the radio configuration changed.
+    def lora_configure(self, was_receiving, incremental=False):
+        lora_cfg = self.config['lora']
+        old_rx_duty_cycle = self.lora.rx_duty_cycle
+        self.lora.set_preamble_len(
+            self.get_preamble_len(lora_cfg['sf'], lora_cfg['bw']))
+        if lora_cfg['rx_duty_cycle']:
+            self.lora.set_rx_duty_cycle(lora_cfg['rx_window_ms'],
+                                        lora_cfg['rx_sleep_ms'])
+        else:
+            self.lora.set_rx_duty_cycle(None)
+        cad = None
+        if self.config['FW']['lbt']:
+            cad = (lora_cfg['cad_symbols'],
+                   lora_cfg['cad_det_peak'],
+                   lora_cfg['cad_det_min'])
+        changed = self.lora.configure(
+            lora_cfg['fq'],
+            lora_cfg['bw'],
+            lora_cfg['cr'],
+            lora_cfg['sf'],
+            lora_cfg['pw'],
+            lora_cfg['explicit_header'],
+            incremental,
+            cad)
+        changed = changed or old_rx_duty_cycle != self.lora.rx_duty_cycle
+        if not changed: return False
+
+        # Configuring the chip puts it in standby: return receiving.
+        if was_receiving: self.lora.receive()
+        # Predicted time on air of frames with this configuration.
+        self.airtime = self.get_airtime_table(
+            lora_cfg['sf'], lora_cfg['bw'], lora_cfg['cr'])
+        self.configure_airtime_budget()
+        return True
+
+    # Update the airtime budget with the duty cycle limit and the
+    # airtime of the largest frame with the current radio configuration.
+    def configure_airtime_budget(self):
+        self.airtime_budget.configure(self.config['FW']['duty_cycle_limit'],
+            self.duty_cycle.slots_num*self.duty_cycle.slots_dur,
+            self.airtime.get(MSG_BUNDLE_MAX_LEN))
+
     # Return the battery percentage using the equation of the
     # discharge curve of a typical lipo 3.7v battery.
 #     def get_battery_perc(self):
@@ -233,84 +396,262 @@ class FreakWAN:
     #
     # Check the send_messages_in_queue() method for the function
     # that actually transfers the messages to the LoRa radio.
+    #
+    # If the queue is full, the least valuable message is dropped, see
+    # SendQueue: if it is 'm' itself, False is returned.
     def send_asynchronously(self, m, max_delay=_SEND_MAX_DELAY, num_tx=1, relay=False):
-        if len(self.send_queue) >= self.send_queue_max: return False
         m.send_time = time.ticks_add(time.ticks_ms(),urandom.randint(0,max_delay))
         m.num_tx = num_tx
         if relay: m.flags |= MSG_FLAG_PLEASE_RELAY
-        self.send_queue.append(m)
+        m.send_class = self.send_class(m)
+        dropped = self.send_queue.push(m)
+        if dropped is m: return False
+        if dropped: self.message_dropped(dropped)
+        self.wake_transmit_task()
 
         # Since we generated this message, if applicable by type we
         # add it to the list of messages we know about. This way we will
         # be able to resolve ACKs received, avoiding sending relays for
-        # messages we originated and so forth.
-        self.mark_as_processed(m)
+        # messages we originated and so forth. Relays of messages of
+        # other nodes are already marked when received.
+        self.mark_as_processed(m,keep=True)
         return True
 
-    # Called when the packet was transmitted. Only useful to turn
-    # the TX led off.
+    # Return the class of the message 'm' in the send queue.
+    def send_class(self, m):
+        if m.type == MSG_T_ACK or m.type == MSG_T_ACKS: return SEND_CLASS_ACK
+        if m.type == MSG_T_DATA:
+            if m.flags & MSG_FLAG_RELAYED: return SEND_CLASS_RELAY
+            return SEND_CLASS_DATA
+        return SEND_CLASS_BEACON
+
+    # Called for a queued message that was dropped from the send queue
+    # to make space for a more valuable one.
+    def message_dropped(self, m):
+        if m is self.pending_acks: self.pending_acks = None
+        info = f'>> Send queue full: dropped {SEND_CLASS_NAMES[m.send_class]} {m.uid:04x}'
+        self.serial_log(info)
+        self.logger.log_sys(self.logger_tag, 'WARN', info)
+        self.release_message(m)
+
+    # Called when the packet was transmitted: turn the TX led off, and
+    # let the transmit task send the next packet right away.
     def lora_tx_done(self):
         self.duty_cycle.end_tx()
         self.set_tx_led(False)
-
-    # Send packets waiting in the send queue if duty cycle is below limit. 
-    # TODO: Work out a better way to handle the duty cycle limit (currently can go over).
+        self.wake_transmit_task()
+
+    def wake_transmit_task(self):
+        self.tx_event.set()
+
+    # This task transfers the messages of the send queue to the radio.
+    # Instead of polling the queue, it sleeps till the send time of the
+    # earliest message, or till something that may allow to send is
+    # reported: a new message was queued, the radio finished sending or
+    # the CAD result is ready. This way queued packets are sent with
+    # no idle time between them, and an idle node does not wake up
+    # for nothing.
+    async def transmit_task(self):
+        while True:
+            self.tx_event.clear()
+            self.send_messages_in_queue()
+            wait_ms = self.send_queue.next_due_ms()
+            if wait_ms == None:
+                await self.tx_event.wait()
+                continue
+            # If the earliest message is already due, it could not be
+            # sent: if we are not woken before, check again later.
+            if wait_ms <= 0: wait_ms = _TX_RETRY_DELAY
+            try:
+                await asyncio.wait_for(self.tx_event.wait(), wait_ms/1000)
+            except asyncio.TimeoutError:
+                pass
+
+    # Listen before talk using the SX1262 Channel Activity Detection.
+    # If we have a fresh CAD result return _LBT_FREE or _LBT_BUSY
+    # (consuming the result), otherwise start a new CAD, if not already
+    # in progress, and return _LBT_WAIT.
+    def lbt_check_channel(self):
+        if self.lora.cad_running(): return _LBT_WAIT
+        busy = self.lora.cad_result
+        if busy != None:
+            self.lora.cad_result = None
+            age = time.ticks_diff(time.ticks_ms(),self.lora.cad_result_time)
+            if age <= _CAD_RESULT_MAX_AGE:
+                self.cad_runs += 1
+                if not busy: return _LBT_FREE
+                self.cad_busy += 1
+                return _LBT_BUSY
+        self.lora.start_cad()
+        return _LBT_WAIT
+
+    # Send packets waiting in the send queue, as long as the airtime
+    # budget allows it, see AirtimeBudget.
     def send_messages_in_queue(self):
-#         if self.duty_cycle.get_duty_cycle() >= self.config['FW']['duty_cycle_limit']:
-#             self.logger.log_sys(self.logger_tag, 'WARN', 'Duty cycle limit reached!')
-#             return
-        if self.lora.modem_is_receiving_packet(): return
-        send_later = [] # List of messages we can't send, yet.
-        while len(self.send_queue):
-            m = self.send_queue.pop(0)
-            if (time.ticks_diff(time.ticks_ms(),m.send_time) > 0):
-                # If the radio is busy sending, waiting here is of
-                # little help: it may take a while for the packet to
-                # be transmitted. Try again in the next cycle. However
-                # check if the radio looks stuck sending for
-                # a very long time, and if so, reset the LoRa radio.
-                if self.lora.tx_in_progress:
-                    if self.duty_cycle.get_current_tx_time() > 60000:
-                        warning = 'TX watchdog radio reset'
-                        self.serial_log(warning)
-                        self.logger.log_sys(self.logger_tag, 'WARN', warning)
-
-                        self.lora_reset_and_configure()
-                        self.lora.receive()
-                    # Put back the message, in the same order as
-                    # it was, before exiting the loop.
-                    self.send_queue = [m] + self.send_queue
-                    break
+        lbt = self.config['FW']['lbt']
+        if lbt:
+            if self.lora.modem_is_receiving_packet(_LBT_PREAMBLE_HOLDOFF,
+                                                   _LBT_HEADER_HOLDOFF):
+                return
+        elif self.lora.modem_is_receiving_packet():
+            return
+        while True:
+            m = self.send_queue.peek()
+            # Nothing to send, or the earliest message is not due yet?
+            if m == None or time.ticks_diff(m.send_time,time.ticks_ms()) > 0:
+                break
+
+            # If the radio is busy sending, waiting here is of
+            # little help: it may take a while for the packet to
+            # be transmitted. Try again in the next cycle. However
+            # check if the radio looks stuck sending for
+            # a very long time, and if so, reset the LoRa radio.
+            if self.lora.tx_in_progress:
+                if self.duty_cycle.get_current_tx_time() > 60000:
+                    warning = 'TX watchdog radio reset'
+                    self.serial_log(warning)
+                    self.logger.log_sys(self.logger_tag, 'WARN', warning)
 
-                # Send the message and turn the green led on. This will
-                # be turned off later when the IRQ reports success.
-                if m.send_canceled == False:
-                    encoded = m.encode(keychain=self.keychain)
-                    if encoded != None:
-                        self.set_tx_led(True)
-                        self.duty_cycle.start_tx()
-                        self.lora.send(encoded)
-                        time.sleep_ms(1)
-                        self.logger.log_msg('tx', m.to_log_string())
-                    else:
-                        m.send_canceled = True
-
-                # This message may be scheduled for multiple
-                # retransmissions. In this case decrement the count
-                # of transmissions and queue it back again.
-                if m.num_tx > 1 and m.send_canceled == False and not self.config['FW']['quiet']:
-                    m.num_tx -= 1
-                    m.send_time = time.ticks_add(time.ticks_ms(),urandom.randint(_TX_AGAIN_MIN_DELAY,_TX_AGAIN_MAX_DELAY))
-                    send_later.append(m)
-            else:
-                # Time to send this message yet not reached, send later.
-                send_later.append(m)
+                    self.lora_reset_and_configure()
+                    self.lora.receive()
+                break
+
+            encoded = None
+            if m.send_canceled == False:
+                encoded = m.encode(keychain=self.keychain,
+                                   variable_len=self.lora.explicit_header)
+                if encoded == None: m.send_canceled = True
+
+            # Sending the frame must not exceed the duty cycle limit:
+            # otherwise, defer the message till the airtime budget
+            # has refilled enough. Relays and HELLOs must leave some
+            # budget to our messages and ACKs, so they are deferred
+            # first. This is checked before listen-before-talk, so we
+            # don't waste a CAD, and its result, on a frame that can't
+            # be sent anyway.
+            if encoded != None:
+                wait = self.airtime_budget.wait_ms(
+                    self.airtime.get(len(encoded)),
+                    m.send_class >= SEND_CLASS_RELAY)
+                if wait:
+                    m.send_time = time.ticks_add(time.ticks_ms(),wait)
+                    self.send_queue.reschedule(m)
+                    self.budget_deferred += 1
+                    continue
 
-        # In case of early break of the while loop, we have still
-        # messages in the original send queue, so the new queue is
-        # the sum of the ones to process again, plus the ones not
-        # yet processed.
-        self.send_queue = self.send_queue + send_later
+            # In listen-before-talk mode, check the channel with a
+            # CAD before transmitting. The CAD takes a few symbols,
+            # so if the result is not ready we leave the message in
+            # the queue and try again in the next cycle. If the channel
+            # is busy, retry after a random backoff.
+            if lbt and m.send_canceled == False:
+                channel = self.lbt_check_channel()
+                if channel == _LBT_BUSY:
+                    backoff = urandom.randint(
+                        self.config['FW']['lbt_backoff_min'],
+                        self.config['FW']['lbt_backoff_max'])
+                    m.send_time = time.ticks_add(time.ticks_ms(),backoff)
+                    self.send_queue.reschedule(m)
+                    self.cad_backoff_ms += backoff
+                if channel != _LBT_FREE:
+                    break
+
+            # Send the message and turn the green led on. This will
+            # be turned off later when the IRQ reports success.
+            self.send_queue.pop()
+            if encoded != None:
+                bundled = None
+                if self.lora.explicit_header and self.config['FW']['bundle']:
+                    # Relays and HELLOs in the bundle must leave the
+                    # reserve alone, like when they are sent alone. If
+                    # the bundle starts with a low priority frame, this
+                    # is true for the whole bundle.
+                    low_prio = m.send_class >= SEND_CLASS_RELAY
+                    max_len = self.airtime.max_len(
+                        self.airtime_budget.available(low_prio))
+                    low_max_len = self.airtime.max_len(
+                        self.airtime_budget.available(True))
+                    encoded, bundled = self.bundle_messages(encoded,
+                                                    max_len, low_max_len)
+                airtime = self.airtime.get(len(encoded))
+                self.airtime_budget.charge(airtime)
+                self.set_tx_led(True)
+                self.duty_cycle.start_tx(airtime)
+                self.lora.send(encoded)
+                time.sleep_ms(1)
+                self.logger.log_msg('tx', m.to_log_string())
+                if bundled:
+                    for b in bundled:
+                        self.logger.log_msg('tx', b.to_log_string())
+                        self.message_transmitted(b)
+
+            self.message_transmitted(m)
+
+    # Called when the message 'm' was transmitted (or canceled), and
+    # removed from the send queue. The message may be scheduled for
+    # multiple retransmissions: in this case decrement the count of
+    # transmissions and queue it back again. Otherwise we are done
+    # with it.
+    def message_transmitted(self, m):
+        if m is self.pending_acks: self.pending_acks = None
+        if m.num_tx > 1 and m.send_canceled == False and not self.config['FW']['quiet']:
+            m.num_tx -= 1
+            m.send_time = time.ticks_add(time.ticks_ms(),urandom.randint(_TX_AGAIN_MIN_DELAY,_TX_AGAIN_MAX_DELAY))
+            dropped = self.send_queue.push(m)
+            if dropped: self.message_dropped(dropped)
+        else:
+            self.release_message(m)
+
+    # Messages that can travel in a bundle together with the message we
+    # are transmitting: ACKs, relays and HELLOs, that are not shown to
+    # the user and for which a bit of latency does not matter.
+    def can_bundle(self, m):
+        if m.send_canceled: return False
+        if m.type == MSG_T_DATA: return m.no_key or m.flags & MSG_FLAG_RELAYED
+        return m.type == MSG_T_ACK or m.type == MSG_T_ACKS or \
+               m.type == MSG_T_HELLO
+
+    # Aggregate the messages of the send queue that can be bundled, and
+    # that are due within 'bundle_max_advance' milliseconds, with the
+    # message encoded in 'encoded', that we are going to transmit. The
+    # messages are removed from the send queue. Relays that may still be
+    # suppressed are only bundled once due: sending them early would
+    # cut the window to overhear other copies, see
+    # suppress_relay_if_needed().
+    #
+    # Return the frame to transmit, that is 'encoded' itself if nothing
+    # was aggregated, and the list of messages added to the bundle. The
+    # bundle is at most 'max_len' bytes, and low priority messages
+    # (relays and HELLOs) are only added if it stays within 'low_max_len'
+    # bytes.
+    def bundle_messages(self, encoded, max_len=MSG_BUNDLE_MAX_LEN,
+                        low_max_len=MSG_BUNDLE_MAX_LEN):
+        max_advance = self.config['FW']['bundle_max_advance']
+        suppress = self.config['FW']['relay_suppress_k'] != 0
+        now = time.ticks_ms()
+        bundled = []
+        items = [encoded]
+        bundle_len = 1+1+len(encoded)
+        for m in self.send_queue.due_within(max_advance):
+            if not self.can_bundle(m): continue
+            if suppress and m.uid in self.pending_relays and \
+               time.ticks_diff(m.send_time, now) > 0: continue
+            e = m.encode(keychain=self.keychain, variable_len=True)
+            limit = low_max_len if m.send_class >= SEND_CLASS_RELAY else max_len
+            if e == None or bundle_len+1+len(e) > limit: continue
+            bundle_len += 1+len(e)
+            items.append(e)
+            bundled.append(m)
+            self.send_queue.remove(m)
+        if not bundled: return encoded, bundled
+
+        bundle = encode_bundle(items)
+        saved = -self.airtime.get(len(bundle))
+        for e in items: saved += self.airtime.get(len(e))
+        self.bundle_frames_saved += len(bundled)
+        self.bundle_airtime_saved += saved
+        self.serial_log(f'>> Bundling {len(items)} messages, {saved} ms of airtime saved')
+        return bundle, bundled
 
     # Called upon reception of some message. It triggers sending an ACK
     # if certain conditions are met. This method does not check the
@@ -322,11 +663,27 @@ class FreakWAN:
         if m.flags & MSG_FLAG_RELAYED: return 
         if m.nick == self.device_name: return  # Don't acknowledge our own messages.
         
-        ack = Message(mtype=MSG_T_ACK,uid=m.uid,content=round(m.rssi),ttl=0)
-        ack.nick = self.device_name
-        self.send_asynchronously(
-            ack,
-            max_delay=self.config['FW']['ack_max_delay'])
+        if self.config['FW']['ack_batch']:
+            # Add the ACK to the batched ACKs message waiting in the send
+            # queue, if any and not full, otherwise queue a new one.
+            # The random ACK delay is the window for more ACKs to join.
+            max_acks = MSG_ACKS_MAX if self.lora.explicit_header else MSG_ACKS_MAX_FIXED
+            ack = self.pending_acks
+            if ack and len(ack.content) < max_acks:
+                ack.content.append((m.uid,round(m.rssi)))
+                ack = None
+            else:
+                ack = self.message_pool.acquire(mtype=MSG_T_ACKS,content=[(m.uid,round(m.rssi))],ttl=0)
+                self.pending_acks = ack
+        else:
+            ack = self.message_pool.acquire(mtype=MSG_T_ACK,uid=m.uid,content=round(m.rssi),ttl=0)
+        if ack:
+            ack.nick = self.device_name
+            if not self.send_asynchronously(
+                ack,
+                max_delay=self.config['FW']['ack_max_delay']):
+                if ack is self.pending_acks: self.pending_acks = None
+                self.message_pool.release(ack)
         info = f'>> Sending ACK about {m.uid:04x}'
         self.serial_log(info)
         self.logger.log_sys(self.logger_tag, 'INFO', info)
@@ -348,14 +705,38 @@ class FreakWAN:
         # Ok, we can relay it. Let's update the message.
         m.ttl -= 1
         m.flags |= MSG_FLAG_RELAYED  # This is a relay. No ACKs, please.
-        self.send_asynchronously(
+        if not self.send_asynchronously(
             m,
             num_tx=self.config['FW']['relay_num_tx'],
-            max_delay=self.config['FW']['relay_max_delay'])
+            max_delay=self.config['FW']['relay_max_delay']): return
+        self.pending_relays[m.uid] = [m,0]
         info = f'>> Relaying {m.uid:04x} from {m.nick}'
         self.serial_log(info)
         self.logger.log_sys(self.logger_tag, 'INFO', info)
 
+    # Called when we receive again the message 'uid', that we already
+    # processed. If our relay of it is waiting in the send queue, and
+    # in the meantime we heard 'relay_suppress_k' copies of the message
+    # (from the originator retransmitting it, or from other relays),
+    # the nodes around us likely got it already: like in Trickle, our
+    # relay would add little, so we cancel it.
+    def suppress_relay_if_needed(self, uid):
+        k = self.config['FW']['relay_suppress_k']
+        pending = self.pending_relays.get(uid)
+        if k == 0 or pending == None: return
+        pending[1] += 1
+        m = pending[0]
+        if pending[1] < k or m.send_canceled: return
+        m.send_canceled = True
+        encoded = m.encode(keychain=self.keychain,
+                           variable_len=self.lora.explicit_header)
+        if encoded != None:
+            self.relay_airtime_saved += self.airtime.get(len(encoded))*m.num_tx
+        self.relays_suppressed += 1
+        info = f'>> Relay of {uid:04x} suppressed: {pending[1]} copies heard'
+        self.serial_log(info)
+        self.logger.log_sys(self.logger_tag, 'INFO', info)
+
     # Return the message if it was already marked as processed, otherwise
     # None is returned.
     def get_processed_message(self,uid):
@@ -372,19 +753,22 @@ class FreakWAN:
     # again to the list of messages, True is returned, and the caller knows
     # it can discard the message. Otherwise we return False and add it
     # if needed.
-    def mark_as_processed(self,m):
+    #
+    # Only if 'keep' is True the message itself is cached: this is
+    # needed for the messages we originate, to collect their ACKs.
+    def mark_as_processed(self,m,keep=False):
         if m.type == MSG_T_DATA:
             if self.get_processed_message(m.uid):
                 return True
             else:
-                self.processed_a[m.uid] = m
+                self.processed_a[m.uid] = m if keep else SeenMessage(m.ctime)
                 return False
         else:
             return False
 
     # Remove old items from the processed cache
     def evict_processed_cache(self):
-        count = 10 # Items to scan
+        count = 100 # Items to scan
         maxage = 60000 # Max cached message age in milliseconds
         while count and len(self.processed_a):
             count -= 1
@@ -397,17 +781,45 @@ class FreakWAN:
                 self.processed_b[uid] = m
             else:
                 self.serial_log(f'Cache evicted: {uid:04x}')
+                if isinstance(m,Message): self.release_message(m)
 
         # If we processed all the items of the 'a' dictionary, start again.
         if len(self.processed_a) == 0 and len(self.processed_b) != 0:
             self.processed_a = self.processed_b
             self.processed_b = {}
 
-    # Called by the LoRa radio IRQ upon new packet reception.
+    # Put a message taken from the message pool back, unless it is still
+    # referenced by the send queue, or by the processed cache (messages
+    # we originated, waiting for ACKs). Messages that were not taken
+    # from the pool can be put back as well. Relays we are done with
+    # are removed from pending_relays.
+    def release_message(self,m):
+        if m in self.send_queue: return
+        pending = self.pending_relays.get(m.uid)
+        if pending and pending[0] is m: del self.pending_relays[m.uid]
+        if self.get_processed_message(m.uid) is m: return
+        self.message_pool.release(m)
+
+    # Called by the LoRa radio IRQ task upon new packet reception.
+    # See SX1262.irq_task(): this is not interrupt context, so we are
+    # free to allocate memory, log and so forth.
     def receive_lora_packet(self, lora_instance, packet, rssi, snr, bad_crc):
         if self.config['FW']['check_crc'] and bad_crc: return
-        m = Message.from_encoded(packet,self.keychain)
-        if m:
+        # Bundles are just a container: process each message in it.
+        bundle = split_bundle(packet)
+        if bundle != None:
+            for encoded in bundle:
+                self.receive_lora_packet(lora_instance, encoded, rssi, snr, bad_crc)
+            return
+        m = self.message_pool.acquire()
+        if not m.decode(packet,self.keychain,self.lora.explicit_header):
+            self.message_pool.release(m)
+            err = f'<< Can\'t decode message {repr(bytes(packet))}'
+            self.serial_log(err)
+            self.logger.log_sys(self.logger_tag, 'ERROR', err)
+            return
+
+        try:
             m.rssi = rssi
             m.snr = snr
             self.update_rssi_history(rssi)
@@ -417,7 +829,9 @@ class FreakWAN:
             if m.no_key == True:
                 # This message is encrypted and we don't have the
                 # right key. Let's relay it, to help the network anyway.
-                if self.mark_as_processed(m): return
+                if self.mark_as_processed(m):
+                    self.suppress_relay_if_needed(m.uid)
+                    return
                 self.relay_if_needed(m)
                 
             elif m.type == MSG_T_DATA:
@@ -426,6 +840,7 @@ class FreakWAN:
                     info = f'<< Ignore duplicate msg: {m.uid:04x}'
                     self.serial_log(info)
                     self.logger.log_sys(self.logger_tag, 'INFO', info)
+                    self.suppress_relay_if_needed(m.uid)
                     return
 
                 # If this message is not relayed by some other node, then
@@ -455,35 +870,44 @@ class FreakWAN:
                 self.relay_if_needed(m)
                 
             elif m.type == MSG_T_ACK:
-                about = self.get_processed_message(m.uid)
-                # Only log and process ACKs for messages that originated from us
-                if about != None and about.nick == self.device_name:
-                    log = f'<< Got ACK about {m.uid:04x} from {m.nick}'
-                    self.serial_log(log)
-                    self.logger.log_sys(self.logger_tag, 'INFO', log)
-                    self.logger.log_msg('rx', m.to_log_string())
-                    about.acks[m.nick] = True
-                    self.update_active_nodes(m.nick, rssi)
-                    # If we received ACKs from all the nodes we know about,
-                    # stop retransmitting this message.
-                    if self.nodes.count and len(about.acks) == self.nodes.count:
-                        about.send_canceled = True
-                        log = f'<< ACKs received from all {self.nodes.count} known nodes. Suppress resending.'
-                        self.serial_log(log)
-                        self.logger.log_sys(self.logger_tag, 'INFO', log)
-                        
+                self.handle_ack(m, m.uid, rssi)
+
+            elif m.type == MSG_T_ACKS:
+                for ack in m.content: self.handle_ack(m, ack[0], rssi)
+
             elif m.type == MSG_T_HELLO:
                 self.update_active_nodes(m.nick, rssi)
+                self.nodes.set_neighbors(m.nick, m.seen, m.content,
+                                         time.ticks_ms())
 
             else:
                 err = f'<< Message type not implemented: {m.type}'
                 self.serial_log(err)
                 self.logger.log_sys(self.logger_tag, 'ERROR', err) 
-        else:
-            err = f'<< Can\'t decode message {repr(packet)}'
-            self.serial_log(err)
-            self.logger.log_sys(self.logger_tag, 'ERROR', err)
+        finally:
+            # Unless relayed, the message is no longer referenced.
+            self.release_message(m)
             
+    # Process the ACK about the message 'uid' received from the node
+    # m.nick, in the ACK (or batched ACKs) message 'm'.
+    def handle_ack(self, m, uid, rssi):
+        about = self.get_processed_message(uid)
+        # Only log and process ACKs for messages that originated from us
+        if about != None and about.nick == self.device_name:
+            log = f'<< Got ACK about {uid:04x} from {m.nick}'
+            self.serial_log(log)
+            self.logger.log_sys(self.logger_tag, 'INFO', log)
+            self.logger.log_msg('rx', m.to_log_string())
+            acks = about.add_ack(m.nick)
+            self.update_active_nodes(m.nick, rssi)
+            # If we received ACKs from all the nodes we know about,
+            # stop retransmitting this message.
+            if self.nodes.count and acks == self.nodes.count:
+                about.send_canceled = True
+                log = f'<< ACKs received from all {self.nodes.count} known nodes. Suppress resending.'
+                self.serial_log(log)
+                self.logger.log_sys(self.logger_tag, 'INFO', log)
+
     # When a message is received, if node is known, update its info, else add
     # it to known list.         
     def update_active_nodes(self, nick, rssi):
@@ -494,36 +918,65 @@ class FreakWAN:
             self.serial_log(log)
             self.nodes.add(nick, time.ticks_ms(), rssi)        
 
-    # Send HELLO messages from time to time. Evict nodes not refreshed
-    # for some time from the nodes list.
+    # Send HELLO messages from time to time, advertising the count and
+    # the digest of our neighbors, so that they can learn the 2-hop
+    # topology (see Nodes.maybe_neighbor()).
+    #
+    # The period adapts: it starts at hello_msg_period_min seconds, and
+    # doubles every time our neighbors did not change since the last
+    # HELLO, so a stable network spends little airtime in HELLOs. When
+    # the neighbors change, we go back to the min period. The period
+    # can grow up to hello_msg_period_max: our neighbors don't time us
+    # out while we are silent, since they track our HELLO period, see
+    # flush_nodes().
     async def send_hello_message(self):
-        hello_msg_period_min = self.config['FW']['hello_msg_period_min']
-        hello_msg_period_max = self.config['FW']['hello_msg_period_max']
-    
-        # Send HELLO, if not in quiet mode.
-        if not self.config['FW']['quiet']:
-            self.serial_log(_HELLO_MSG)
-            
-            msg = Message(
-                mtype=MSG_T_HELLO,  
-                nick=self.device_name,
-                seen=self.nodes.count
-            )
-            self.send_asynchronously(msg, max_delay=3000)
-
-            # Wait until we need to send the next HELLO.
-            await asyncio.sleep(urandom.randint(hello_msg_period_min,hello_msg_period_max))
-    
+        last_digest = None
+        self.hello_params = self.get_hello_params()
+        period = self.config['FW']['hello_msg_period_min']
+        while True:
+            period_min = self.config['FW']['hello_msg_period_min']
+            period_max = self.config['FW']['hello_msg_period_max']
+            digest = self.nodes.digest()
+            if digest != last_digest:
+                period = period_min
+            else:
+                period = min(period*2, period_max)
+            last_digest = digest
+            self.hello_period = period
+
+            # Send HELLO, if not in quiet mode.
+            if not self.config['FW']['quiet']:
+                self.serial_log(_HELLO_MSG)
+                msg = Message(
+                    mtype=MSG_T_HELLO,
+                    nick=self.device_name,
+                    seen=self.nodes.count,
+                    content=digest
+                )
+                self.send_asynchronously(msg, max_delay=3000)
+
+            # Wait until we need to send the next HELLO. The random
+            # part avoids nodes sending HELLOs in sync.
+            await asyncio.sleep(period + urandom.randint(0,max(period//4,1)))
+
+    # Return the configuration parameters of send_hello_message(), to
+    # tell if the task needs to be restarted after a config update.
+    def get_hello_params(self):
+        fw = self.config['FW']
+        return (fw['hello_msg_period_min'], fw['hello_msg_period_max'])
+
+    # Evict the nodes we did not hear from in node_flush_threshold
+    # seconds, or longer if they send HELLOs less often than that.
     async def flush_nodes(self):
         flush_threshold = self.config['FW']['node_flush_threshold'] * 1000
         flush_interval = self.config['FW']['node_flush_interval']
         while True:
             # Evict nodes we haven't received a message from in a while.
             if self.nodes.count > 0:
-                for node, data in self.nodes.active.items():
+                for node, data in list(self.nodes.active.items()):
                     last_seen = data['last_seen_ms']
                     age = time.ticks_diff(time.ticks_ms(), last_seen)
-                    if age <= flush_threshold:
+                    if age <= self.nodes.timeout_ms(node, flush_threshold):
                         continue
                     else:
                         self.nodes.timeout(node)
@@ -553,7 +1006,8 @@ class FreakWAN:
     # This shows some information about the process in the debug console.
     def show_status_log(self):
         sent = self.lora.msg_sent
-        msg = f'~{self.device_name} Sent:{sent} Q:{len(self.send_queue)} Free:{gc.mem_free()} DC:{self.duty_cycle.get_duty_cycle():.2f}'
+        drops = '/'.join([str(d) for d in self.send_queue.drops])
+        msg = f'~{self.device_name} Sent:{sent} Q:{len(self.send_queue)} Free:{gc.mem_free()} DC:{self.duty_cycle.get_duty_cycle():.2f}/{self.duty_cycle.get_duty_cycle(predicted=True):.2f} CAD:{self.cad_busy}/{self.cad_runs} BO:{self.cad_backoff_ms}ms ON:~{self.lora.get_radio_on_time()//1000}s AGG:{self.bundle_frames_saved}/{self.bundle_airtime_saved}ms HELLO:{self.hello_period}s DROP:{drops} BUDGET:{self.airtime_budget.available():.0f}ms/{self.budget_deferred} SUP:{self.relays_suppressed}/{self.relay_airtime_saved}ms'
         self.serial_log(msg)
         self.logger.log_sys(self.logger_tag, 'INFO', msg)
 
@@ -600,22 +1054,30 @@ class FreakWAN:
         self.serial_log(msg,force=True)
 
     # This is the main control loop of the application, where we perform
-    # periodic tasks, like sending messages in the queue. Other tasks
-    # are handled by different tasks created at startup, at the end
+    # periodic tasks, like evicting old entries of the processed messages
+    # cache. Sending the messages in the queue, and other jobs, are
+    # handled by different tasks created at startup, at the end
     # of this file.
+    #
+    # None of the periodic tasks needs a fine resolution, so the loop
+    # runs about once per second, to let the node sleep between ticks.
+    # Configuration updates wake it up immediately.
     async def cron(self):
         tick = 0
         
+        # The LoRa IRQ handler defers the events processing to this task.
+        self.lora_irq_task = asyncio.create_task(self.lora.irq_task())
+        self.transmit_task_handle = asyncio.create_task(self.transmit_task())
         if self.config['FW']['testing']:
             self.test_cycle_task = asyncio.create_task(self.cycle_configurations()) 
         if self.config['FW']['automsg']:
             self.auto_msg_task = asyncio.create_task(self.send_periodic_message())
         
-#         self.hello_msg_task = asyncio.create_task(self.send_hello_message())
+        self.hello_msg_task = asyncio.create_task(self.send_hello_message())
         self.flush_nodes_task = asyncio.create_task(self.flush_nodes())
         
         while True:
-            if tick % 600 == 0: self.show_status_log()
+            if tick % 60 == 0: self.show_status_log()
 
             # If the configuration was updated (from web interface), we need to
             # reconfigure the LoRa radio.
@@ -631,7 +1093,7 @@ class FreakWAN:
                             await self.test_cycle_task
                         except asyncio.CancelledError:
                             pass        
-                    self.lora_reset_and_configure()
+                    self.lora_reconfigure()
                 else:
                     # Reset task TODO: Only reset if test file has actually changed
                     if self.test_cycle_task:
@@ -645,14 +1107,21 @@ class FreakWAN:
                         # Device not started with testing flag so start task now
                         self.test_cycle_task = asyncio.create_task(self.cycle_configurations())
 
-#                 # Reset hello msg task TODO: Only reset if params actually changed
-#                 if self.hello_msg_task:
-#                     self.hello_msg_task.cancel()
-#                     try:
-#                         await self.hello_msg_task
-#                     except asyncio.CancelledError:
-#                         self.hello_msg_task = asyncio.create_task(self.send_hello_message())
-#                         pass
+                # The airtime budget depends on the duty cycle limit and
+                # on the airtime table, that lora_reconfigure() rebuilds
+                # for the new radio configuration: update it now.
+                self.configure_airtime_budget()
+
+                # Restart the HELLO task, so that it starts again from
+                # the min period, only if its parameters changed.
+                if self.hello_msg_task and \
+                   self.get_hello_params() != self.hello_params:
+                    self.hello_msg_task.cancel()
+                    try:
+                        await self.hello_msg_task
+                    except asyncio.CancelledError:
+                        self.hello_msg_task = asyncio.create_task(self.send_hello_message())
+                        pass
                     
                 if self.flush_nodes_task:
                     self.flush_nodes_task.cancel()
@@ -662,16 +1131,20 @@ class FreakWAN:
                         self.flush_nodes_task = asyncio.create_task(self.flush_nodes())
                         pass
 
-            self.send_messages_in_queue()
             self.evict_processed_cache()
 
-            # The tick time is randomized between 80 and 120
-            # milliseconds instead of being exactly 100. This is
+            # The tick time is randomized between 800 and 1200
+            # milliseconds instead of being exactly 1000. This is
             # useful to always take the different nodes in desync:
             # a simple but effective way to avoid an all-together start
             # after listen-before-talk and other events.
-            sleeptime = urandom.randint(800,1200)/10000
-            await asyncio.sleep(sleeptime)
+            sleeptime = urandom.randint(800,1200)/1000
+            self.config_event.clear()
+            if not self.config_updated:
+                try:
+                    await asyncio.wait_for(self.config_event.wait(), sleeptime)
+                except asyncio.TimeoutError:
+                    pass
             tick += 1
 
     # Turn the exception into a proper stack trace.
@@ -684,7 +1157,9 @@ class FreakWAN:
     def crash_handler(self,loop,context):
         # Try freeing some memory in order to avoid OOM during
         # the crash logging itself.
-        self.send_queue = []
+        self.send_queue.clear()
+        self.pending_acks = None
+        self.pending_relays = {}
         self.processed_a = {}
         self.processed_b = {}
         gc.collect()
@@ -0,0 +1,63 @@
+# Host (CPython) replacement of the MicroPython 'machine' module, see
+# sitecustomize.py. Pins and buses do nothing: the radio is provided by
+# sx1262_sim.py.
+
+import sys
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id=None, mode=None, pull=None):
+        self.v = 0
+        self.handler = None
+
+    def value(self, v=None):
+        if v == None: return self.v
+        self.v = v
+
+    def on(self):
+        self.v = 1
+
+    def off(self):
+        self.v = 0
+
+    def irq(self, handler=None, trigger=None):
+        self.handler = handler
+
+class SPI:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def write(self, data):
+        pass
+
+    def write_readinto(self, data, reply):
+        pass
+
+SoftSPI = SPI
+
+class SoftI2C:
+    def __init__(self, *args, **kwargs):
+        pass
+
+I2C = SoftI2C
+
+class ADC:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def read_u16(self):
+        return 0
+
+def unique_id():
+    return b'host'
+
+def reset():
+    sys.exit()
+
+def deepsleep(ms=0):
+    sys.exit()
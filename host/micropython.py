@@ -0,0 +1,11 @@
+# Host (CPython) replacement of the MicroPython 'micropython' module,
+# see sitecustomize.py.
+
+def const(x):
+    return x
+
+def native(f):
+    return f
+
+def viper(f):
+    return f
@@ -0,0 +1,61 @@
+# Run FreakWAN modules on the host with CPython, for instance in order to
+# benchmark them against the simulated radio of sx1262_sim.py:
+#
+#   PYTHONPATH=host:. python3 bench.py
+#
+# Python imports this file at startup when the 'host' directory is in the
+# path. It adds to the standard modules the MicroPython specific functions
+# used by the code base. The 'machine', 'micropython' and 'urandom'
+# modules are in this directory too.
+
+import time, asyncio, gc, sys, builtins, traceback
+from micropython import const
+
+# MicroPython ticks wrap around at 2^30 like on the ESP32 port: keep the
+# same behavior here, so that wrapping bugs show up on the host too.
+_TICKS_PERIOD = const(1<<30)
+_TICKS_MAX = const(_TICKS_PERIOD-1)
+_TICKS_HALFPERIOD = const(_TICKS_PERIOD//2)
+_start = time.perf_counter_ns()
+
+def ticks_ms():
+    return ((time.perf_counter_ns()-_start)//1000000) & _TICKS_MAX
+
+def ticks_us():
+    return ((time.perf_counter_ns()-_start)//1000) & _TICKS_MAX
+
+def ticks_add(ticks, delta):
+    return (ticks+delta) & _TICKS_MAX
+
+def ticks_diff(a, b):
+    return ((a-b+_TICKS_HALFPERIOD) & _TICKS_MAX) - _TICKS_HALFPERIOD
+
+time.ticks_ms = ticks_ms
+time.ticks_us = ticks_us
+time.ticks_add = ticks_add
+time.ticks_diff = ticks_diff
+time.sleep_ms = lambda ms: time.sleep(ms/1000)
+time.sleep_us = lambda us: time.sleep(us/1000000)
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms/1000)
+
+# Like MicroPython ThreadSafeFlag, the flag is cleared by wait().
+class ThreadSafeFlag(asyncio.Event):
+    async def wait(self):
+        await super().wait()
+        self.clear()
+
+asyncio.sleep_ms = sleep_ms
+asyncio.ThreadSafeFlag = ThreadSafeFlag
+
+# The host has no fixed heap. gc.mem_alloc() is left undefined on
+# purpose, so that allocation benchmarks report it is not available.
+gc.mem_free = lambda: 0
+gc.threshold = lambda *args: None
+
+def print_exception(e, file=sys.stdout):
+    traceback.print_exception(type(e), e, e.__traceback__, file=file)
+
+sys.print_exception = print_exception
+builtins.const = const
@@ -0,0 +1,4 @@
+# Host (CPython) replacement of the MicroPython 'urandom' module, see
+# sitecustomize.py.
+
+from random import *
@@ -1,20 +1,65 @@
 import os, hashlib
 from collections import OrderedDict
+from micropython import const
+
+# The AES cipher needs the cryptolib module. It is not available in all
+# the MicroPython builds, and XOR works without it.
+try:
+    import cryptolib
+except ImportError:
+    cryptolib = None
+
+# Keystreams are as long as the largest LoRa frame.
+_KEYSTREAM_LEN = const(255)
+
+# AES-CTR counter blocks: 16 blocks cover the largest frame.
+_AES_BLOCK_LEN = const(16)
+_AES_CTR_LEN = const(256)
+_AES_MODE_ECB = const(1)
+_AES_ZERO_BLOCK = bytes(_AES_BLOCK_LEN)
 
 # This class implements the packets encryption keychain. It loads and
 # saves keys from/to disk, and implements encryption and decryption.
+#
+# Encrypted packets start with a 3 bytes key identifier (the first bytes
+# of the SHA256 of the key). We keep an index from key ids to key names,
+# so that finding the key of a received packet does not require hashing
+# all the keys we have.
+#
+# Two ciphers are available, both XORing the data with a keystream:
+#
+# 'xor': the keystream is the key repeated as needed. For each key we
+#        cache it, expanded to the max frame length, so that the XOR can
+#        be performed on the whole buffer at once. See encrypt().
+# 'aes': AES in CTR mode, using cryptolib (hardware accelerated on the
+#        ESP32). The AES key is derived from the key with SHA256, and we
+#        cache the AES context of each key. The keystream is the
+#        encryption of counter blocks made of the nonce passed by the
+#        caller and of the block number.
 class Keychain:
-    def __init__(self,keychain_dir="keys"):
+    def __init__(self,keychain_dir="keys",cipher='xor'):
+        if cipher == 'aes' and cryptolib == None:
+            raise Exception("The aes cipher needs the cryptolib module")
         try: os.mkdir(keychain_dir)
         except: pass
         self.keychain_dir = keychain_dir
+        self.cipher = cipher
+        # Buffers for the AES-CTR counter blocks and the keystream.
+        self.aes_ctr = bytearray(_AES_CTR_LEN)
+        self.aes_ctr_mv = memoryview(self.aes_ctr)
+        self.aes_stream_mv = memoryview(bytearray(_AES_CTR_LEN))
         self.keys = OrderedDict()
+        self.key_ids = {}       # Key name -> key id.
+        self.key_names = {}     # Key id -> key name.
+        self.keystreams = {}    # Key name -> keystream (XOR cipher).
+        self.aes = {}           # Key name -> AES context (AES cipher).
+        self.collisions = []    # (key name, key name) pairs with same id.
         self.device_key_name = ''
         self.load_keys()
 
     # Load keys in memory.
     def load_keys(self):
-        key_names = os.listdir(self.keychain_dir)
+        key_names = sorted(os.listdir(self.keychain_dir))
         # The first key name in the list (*key) belongs to this device.
         device_key_name = key_names.pop(0)
         with open(f'{self.keychain_dir}/{device_key_name}', 'rb') as f:
@@ -29,38 +74,160 @@ class Keychain:
                     key = f.read()    
                     self.keys[key_name] = key
             except: pass
+        self.build_index()
 
-    # This function expects an already encoded data packet, and
-    # return its encrypted version.
-    def encrypt(self, packet, key_name):
-        key = self.keys[key_name]
-        if key == None:
+    # Compute the key identifier (first 3 bytes of SHA256 hash).
+    def get_key_id(self, key):
+        return hashlib.sha256(key).digest()[:3]
+
+    # Return the key repeated to fill _KEYSTREAM_LEN bytes.
+    def get_keystream(self, key):
+        keystream = bytearray(_KEYSTREAM_LEN)
+        for i in range(_KEYSTREAM_LEN):
+            keystream[i] = key[i % len(key)]
+        return memoryview(keystream)
+
+    # Return the AES context for the specified key. The AES key must
+    # be 16 bytes: we derive it with SHA256 from the key, adding a prefix
+    # so that it is unrelated to the key id, that is sent in clear.
+    def get_aes(self, key):
+        aes_key = hashlib.sha256(b'aes'+key).digest()[:_AES_BLOCK_LEN]
+        return cryptolib.aes(aes_key, _AES_MODE_ECB)
+
+    # Add the key 'key_name' to the key id index, and cache its
+    # keystream or AES context. If another key has the same 3 bytes id,
+    # packets with such id can't be attributed to one or the other: we
+    # report the collision, and keep using the key that was already in
+    # the index.
+    def index_key(self, key_name):
+        if self.cipher == 'aes':
+            self.aes[key_name] = self.get_aes(self.keys[key_name])
+        else:
+            self.keystreams[key_name] = self.get_keystream(self.keys[key_name])
+        key_id = self.get_key_id(self.keys[key_name])
+        self.key_ids[key_name] = key_id
+        other = self.key_names.get(key_id)
+        if other != None and other != key_name:
+            self.collisions.append((other, key_name))
+            print(f"Keychain: keys {other} and {key_name} have the same key id {key_id.hex()}")
+            return
+        self.key_names[key_id] = key_name
+
+    def build_index(self):
+        self.key_ids = {}
+        self.key_names = {}
+        self.keystreams = {}
+        self.aes = {}
+        self.collisions = []
+        for key_name in self.keys: self.index_key(key_name)
+
+    def has_key(self, key_name):
+        return key_name in self.keys
+
+    def list_keys(self):
+        return list(self.keys)
+
+    # Add a key to the keychain, saving it on disk. If a key with the
+    # same name exists, it is replaced.
+    def add_key(self, key_name, key):
+        if isinstance(key, str): key = key.encode()
+        filename = key_name
+        if key_name == self.device_key_name: filename = '*'+key_name
+        with open(f'{self.keychain_dir}/{filename}', 'wb') as f:
+            f.write(key)
+        replaced = key_name in self.keys
+        self.keys[key_name] = key
+        if replaced:
+            self.build_index()
+        else:
+            self.index_key(key_name)
+
+    # Remove a key from the keychain and from disk. The key of this
+    # device can't be removed. Return True if the key was removed.
+    def del_key(self, key_name):
+        if key_name == self.device_key_name or key_name not in self.keys:
+            return False
+        os.remove(f'{self.keychain_dir}/{key_name}')
+        del self.keys[key_name]
+        # A key colliding with the removed one may now take its id.
+        self.build_index()
+        return True
+
+    # Return the AES-CTR keystream to encrypt 'n' bytes with the AES
+    # context 'aes' and the specified nonce. Each counter block is the
+    # nonce, zero padded, with the block number in the last byte. The
+    # returned keystream is only valid till the next call.
+    def get_aes_keystream(self, aes, nonce, n):
+        ctr = self.aes_ctr
+        blocks = (n+_AES_BLOCK_LEN-1)//_AES_BLOCK_LEN
+        nonce_len = min(len(nonce),_AES_BLOCK_LEN-1)
+        for b in range(blocks):
+            off = b*_AES_BLOCK_LEN
+            ctr[off:off+_AES_BLOCK_LEN] = _AES_ZERO_BLOCK
+            ctr[off:off+nonce_len] = nonce[:nonce_len]
+            ctr[off+_AES_BLOCK_LEN-1] = b
+        ctr_len = blocks*_AES_BLOCK_LEN
+        aes.encrypt(self.aes_ctr_mv[:ctr_len], self.aes_stream_mv[:ctr_len])
+        return self.aes_stream_mv
+
+    # Return the keystream of the key 'key_name' to encrypt or decrypt
+    # 'n' bytes. The nonce is only used by the AES cipher, and must be
+    # the same when decrypting: it should be different for every message
+    # encrypted with the same key, otherwise the same keystream is used.
+    def get_key_keystream(self, key_name, nonce, n):
+        if n > _KEYSTREAM_LEN:
+            raise Exception("Packet too long to encrypt: "+str(n))
+        if self.cipher == 'aes':
+            aes = self.aes.get(key_name)
+            keystream = None if aes == None else \
+                        self.get_aes_keystream(aes, nonce, n)
+        else:
+            keystream = self.keystreams.get(key_name)
+        if keystream == None:
             raise Exception("No key with the specified name: "+str(key_name))
+        return keystream
 
-        key_len = len(key)
-        encrypted = bytearray(packet)  # Convert bytes to mutable bytearray
-        for i in range(len(packet)):
-            encrypted[i] ^= key[i % key_len]  # XOR operation
-            
-        # Compute a key identifier (use first 3 bytes of SHA256 hash)
-        key_id = hashlib.sha256(key).digest()[:3]
+    # XOR 'data' with the keystream of the key 'key_name' and return
+    # the result. This is both encryption and decryption.
+    #
+    # Instead of XORing byte by byte in a Python loop, we turn both the
+    # data and the keystream into big integers, and XOR them with a
+    # single operation, that runs in C.
+    def xor_keystream(self, data, key_name, nonce=b''):
+        n = len(data)
+        keystream = self.get_key_keystream(key_name, nonce, n)
+        xored = int.from_bytes(data,'big') ^ \
+                int.from_bytes(keystream[:n],'big')
+        return xored.to_bytes(n,'big')
 
-        return key_id + bytes(encrypted)  # Convert back to immutable bytes
+    # This function expects an already encoded data packet, and
+    # return its encrypted version, prefixed by the key id.
+    def encrypt(self, packet, key_name, nonce=b''):
+        encrypted = self.xor_keystream(packet, key_name, nonce)
+        return self.key_ids[key_name] + encrypted
 
-    def decrypt(self, packet):
-        key_id_received = packet[:3]
-        encrypted_data = packet[3:]
-        
-        # Find the correct key by comparing hashed key identifiers
-        matching_key_name = None
-        for key_name, key_value in self.keys.items():
-            key_digest = hashlib.sha256(key_value).digest()[:3]
-            if key_digest == bytes(key_id_received):  # Convert bytearray to bytes for comparison
-                matching_key_name = key_name
-                break
-                
+    # Decrypt 'packet' (key id + encrypted data) writing the plaintext
+    # at the start of 'dest', so that callers can reuse the same buffer
+    # for every packet. Return the name of the key that decrypted the
+    # packet, or None if we don't have the key.
+    #
+    # Unlike xor_keystream(), the XOR is performed byte by byte directly
+    # into 'dest': slower, but it does not allocate the big integers and
+    # the plaintext bytes for every received packet.
+    def decrypt_into(self, packet, dest, nonce=b''):
+        # Find the key from the key identifier.
+        matching_key_name = self.key_names.get(bytes(packet[:3]))
+        if not matching_key_name: return None
+        n = len(packet)-3
+        keystream = self.get_key_keystream(matching_key_name, nonce, n)
+        for i in range(n):
+            dest[i] = packet[3+i] ^ keystream[i]
+        return matching_key_name
+
+    def decrypt(self, packet, nonce=b''):
+        plain = bytearray(max(len(packet)-3,0))
+        matching_key_name = self.decrypt_into(packet, plain, nonce)
         if matching_key_name:
-            decrypted = self.encrypt(encrypted_data, matching_key_name)
-            return matching_key_name, decrypted[3:]
+            return matching_key_name, bytes(plain)
         else:
             return None
@@ -84,6 +84,7 @@ async def main():
 
     # The FreakWAN class is the main class that implements networking.
     fw = FreakWAN(logger, cfg_plain, nodes, cfg.set_update_callback)
+    ws.set_airtime_callback(fw.get_airtime_info)
     asyncio.create_task(fw.cron())
     asyncio.create_task(fw.receive_from_serial())
     
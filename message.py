@@ -6,6 +6,7 @@
 
 import struct, time, urandom, machine, sys
 from micropython import const
+from textcodec import encode_text, decompress
 
 _MSG_TYPE_MASK = const(0x07)  # 0000 0111
 _MSG_FLAGS_MASK = const(0xF8)  # 1111 1000
@@ -13,20 +14,91 @@ _MSG_FLAGS_MASK = const(0xF8)  # 1111 1000
 # Message types
 MSG_T_DATA = const(1)
 MSG_T_ACK = const(1<<1)
+MSG_T_BUNDLE = const(3)     # Many messages in one frame, see encode_bundle().
 MSG_T_HELLO = const(1<<2)
+MSG_T_ACKS = const(5)       # Many ACKs in one message.
 # Message flags
 MSG_FLAG_RELAYED = const(1<<3)     
 MSG_FLAG_PLEASE_RELAY = const(1<<4)
 MSG_FLAG_ENCR = const(1<<5)
+MSG_FLAG_PACKED = const(1<<6)   # DATA content compressed, see textcodec.py.
 
 # Virtual flags: not really in the packet header, but added
 # in the message object representing the packet to provide
 # further information.
 MSG_FLAG_BADCRC = const(1<<7)
 
+# DATA content length limits: 4 bytes header and 3 bytes key id in a
+# fixed length frame, plus one byte of content length in the largest
+# frame, see Message.encode().
+_FIXED_CONTENT_LEN = const(13)
+_MAX_CONTENT_LEN = const(247)
+
+# Max number of (uid, rssi) pairs in a MSG_T_ACKS message: 5 bytes of
+# header and 4 bytes per pair, in a fixed length or in the largest frame.
+MSG_ACKS_MAX_FIXED = const(3)
+MSG_ACKS_MAX = const(62)
+
+# Max length of a bundle: one frame in explicit header mode. Every
+# message in the bundle costs its length, plus one byte.
+MSG_BUNDLE_MAX_LEN = const(255)
+
+# Decryption buffer shared by all the decoded messages: the plaintext
+# lives here only until the content bytes are copied in the message.
+_DECRYPT_BUF = memoryview(bytearray(255))
+
+# Return the nonce used to encrypt a message: the header fields that
+# relays never change, that is, the type and the uid (flags and TTL are
+# modified when relaying).
+def cipher_nonce(mtype, uid):
+    return struct.pack('<BH', mtype, uid)
+
+# Return a bundle frame, containing the encoded messages in the list
+# 'encoded'. A bundle is a type byte (MSG_T_BUNDLE, no flags) followed
+# by every message, prefixed by its length as a byte:
+#
+#   +--------+--------+----------//--+--------+----------//--+
+#   | type:8 | len1:8 | message 1 .. | len2:8 | message 2 .. |
+#   +--------+--------+----------//--+--------+----------//--+
+#
+# The caller must make sure the bundle fits in MSG_BUNDLE_MAX_LEN bytes.
+def encode_bundle(encoded):
+    bundle = bytearray((MSG_T_BUNDLE,))
+    for e in encoded:
+        bundle.append(len(e))
+        bundle.extend(e)
+    return bytes(bundle)
+
+# If 'encoded' is a bundle, return the list of the messages in it, as
+# memoryviews of 'encoded', otherwise return None. The list is truncated
+# at the first malformed message, and bundles nested inside a bundle are
+# skipped.
+def split_bundle(encoded):
+    if len(encoded) == 0 or encoded[0] & _MSG_TYPE_MASK != MSG_T_BUNDLE:
+        return None
+    mv = memoryview(encoded)
+    messages = []
+    i = 1
+    while i < len(mv):
+        l = mv[i]
+        if l == 0 or i+1+l > len(mv): break
+        if mv[i+1] & _MSG_TYPE_MASK != MSG_T_BUNDLE:
+            messages.append(mv[i+1:i+1+l])
+        i += 1+l
+    return messages
+
 # The message object represents a FreakWAN message, and is also responsible
 # of the decoding and encoding of the messages to be sent to the "wire".
+#
+# Many messages live in memory at the same time (send queue, processed
+# messages cache), so the attributes are declared in __slots__, and
+# the ACKs dict is only created for messages that actually get ACKs.
 class Message:
+    __slots__ = ('ctime','send_time','num_tx','acks','type','flags','nick',
+                 '_content','content_bytes','uid','ttl','seen','rssi','snr',
+                 'key_name','no_key','packet','send_canceled','sched_entry',
+                 'send_class')
+
     def __init__(self, nick='---', content='---', uid=False, ttl=0, mtype=MSG_T_DATA, flags=0, rssi=0, seen=0, key_name=None):
         self.ctime = time.ticks_ms() # To evict old messages
 
@@ -37,11 +109,11 @@ class Message:
         # is transmitted, this value is reduced by one. When it reaches
         # zero, the message is removed from the send queue.
         self.num_tx = 1
-        self.acks = {}  # Device IDs we received ACKs from
+        self.acks = None    # Device IDs we received ACKs from, see add_ack().
         self.type = mtype
         self.flags = flags
         self.nick = nick
-        self.content = content
+        self.content = content      # Sets content_bytes to None.
         self.uid = uid if uid != False else self.gen_uid()
         self.ttl = ttl              # Only DATA
         self.seen = seen            # Only HELLO
@@ -49,6 +121,7 @@ class Message:
         self.snr = 0
         self.key_name = key_name
         self.no_key = False         # True if it was not possible to decrypt.
+        self.packet = None          # Encrypted packet, if no_key is True.
 
         # If key_name is set, encoded messages will be encrypted, too.
         # When messages are decoded, key_name is set to the key that
@@ -59,21 +132,77 @@ class Message:
         # to look for the message, we just set this flag to True.
         self.send_canceled = False
 
+        # Entry of the message in the send queue, and its class there,
+        # see scheduler.py.
+        self.sched_entry = None
+        self.send_class = 0
+
+    # Remember that the device 'nick' acknowledged this message. Return
+    # the number of devices that acknowledged it so far.
+    def add_ack(self, nick):
+        if self.acks == None: self.acks = {}
+        self.acks[nick] = True
+        return len(self.acks)
+
+    # The content of decoded DATA messages is kept as bytes, as found in
+    # the packet (so compressed if MSG_FLAG_PACKED is set), and turned
+    # into a string only the first time it is accessed: relayed and
+    # duplicated messages are never shown, so they don't need it.
+    #
+    # The content bytes are kept after decoding, so relaying the message
+    # still sends them as received. Malformed content (bad compressed
+    # data or invalid UTF-8) is shown as such, it is not worth rejecting
+    # the message when it arrives, that would mean decoding all of them.
+    @property
+    def content(self):
+        if self._content == None and self.content_bytes != None:
+            content = self.content_bytes
+            try:
+                if self.flags & MSG_FLAG_PACKED: content = decompress(content)
+                self._content = content.decode()
+            except ValueError: # UnicodeError is a ValueError, too.
+                self._content = '<malformed content>'
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.content_bytes = None
+
+    # Set the content from the raw bytes of a DATA message. 'raw' may be
+    # a view of a shared buffer, so we copy it.
+    def set_content_bytes(self, raw):
+        self._content = None
+        self.content_bytes = bytes(raw)
+
+    # Return the message as a line of the messages log. The content of
+    # DATA messages is logged as hex if it was never turned into text
+    # (relays and bundled messages), so that logging does not decode it.
     def to_log_string(self):
+        content = self._content
+        if content == None and self.content_bytes != None:
+            content = self.content_bytes.hex()
         if self.type == MSG_T_DATA:
             type_str = 'data'
         elif self.type == MSG_T_ACK:
             type_str = 'ack'
+        elif self.type == MSG_T_ACKS:
+            type_str = 'acks'
         elif self.type == MSG_T_HELLO:
             type_str = 'hello'
-        return f'{type_str},{self.uid:04x},{self.nick},{self.flags>>3:04b},{self.rssi:.0f},{self.snr},{self.ttl},{self.content}'
+        return f'{type_str},{self.uid:04x},{self.nick},{self.flags>>3:04b},{self.rssi:.0f},{self.snr},{self.ttl},{content}'
 
     # Generate a 16 bit unique message ID.
     def gen_uid(self):
         return urandom.getrandbits(16)
 
     # Turn the message into its binary representation.
-    def encode(self, keychain=None):
+    #
+    # If variable_len is True, the radio sends frames of the exact
+    # length of the encoded message (explicit header mode), so we don't
+    # pad the content to a fixed size, and the content can be as long
+    # as the largest frame allows.
+    def encode(self, keychain=None, variable_len=False):
         # combine type and flags into a single byte mask
         combined = (self.type & _MSG_TYPE_MASK | self.flags & _MSG_FLAGS_MASK)
         
@@ -88,87 +217,140 @@ class Message:
             # Encode with the encryption flag set
             combined |= MSG_FLAG_ENCR
                 
-            # TODO: Determine a good fixed payload length. Currently using 20
-            # bytes, which probably isn't long enough for useful messages.
             # DATA messages use:
             # 1 byte for  type+flags
             # 2 bytes for message UID
             # 1 byte for  TTL
-            # -- nickname is probably not needed in final design as messages
-            # -- are determined by enc key.
-            # 3 bytes for nickname
-            # 10 bytes for message content (0000-9999 + 8 byte padding)
             # 3 bytes for key_id
-                
+            # In variable length frames:
+            # 1 byte for  content length
+            # the content, compressed if MSG_FLAG_PACKED is set.
+            # In fixed length frames, the original format, understood by
+            # all the nodes:
+            # 13 bytes for the content, zero padded, never compressed.
+            #
+            # When relaying, the content was never turned into a string:
+            # send it as we received it, if the format allows it.
+            content = self.content_bytes
+            if variable_len:
+                if content == None or len(content) > _MAX_CONTENT_LEN:
+                    content, packed = encode_text(self.content, _MAX_CONTENT_LEN)
+                    combined &= ~MSG_FLAG_PACKED
+                    if packed: combined |= MSG_FLAG_PACKED
+                content = bytes((len(content),)) + content
+            else:
+                if content == None or len(content) > _FIXED_CONTENT_LEN or \
+                   combined & MSG_FLAG_PACKED:
+                    content, packed = encode_text(self.content,
+                                                  _FIXED_CONTENT_LEN, False)
+                    combined &= ~MSG_FLAG_PACKED
+                content += bytes(_FIXED_CONTENT_LEN-len(content))
+
             header = struct.pack('<BHB', combined, self.uid, self.ttl)
-            payload = keychain.encrypt(
-                struct.pack('<13s', self.content.encode()),
-                keychain.device_key_name)
+            payload = keychain.encrypt(content, keychain.device_key_name,
+                                       cipher_nonce(self.type, self.uid))
 
             return header + payload
         
         elif self.type == MSG_T_ACK:
             # ACK content is a 2 byte RSSI for the DATA msg being ACKed 
-            return struct.pack("<BHh3s",combined,self.uid,self.content,self.nick)
-#         elif self.type == MSG_T_HELLO:
-#             return struct.pack("<BB3s",combined,self.seen,self.nick)
+            return struct.pack("<BHh3s",combined,self.uid,self.content,self.nick.encode())
+        elif self.type == MSG_T_ACKS:
+            # Batched ACKs: the content is a list of (uid, rssi) of
+            # the DATA messages being ACKed, preceded by the count.
+            acks = self.content[:MSG_ACKS_MAX if variable_len else MSG_ACKS_MAX_FIXED]
+            encoded = bytearray(struct.pack("<B3sB",combined,self.nick.encode(),len(acks)))
+            for uid, rssi in acks: encoded.extend(struct.pack("<Hh",uid,rssi))
+            return bytes(encoded)
+        elif self.type == MSG_T_HELLO:
+            # HELLO content is the 32 bit digest of our neighbors, see
+            # nodes.py, and 'seen' is their count.
+            return struct.pack("<B3sBI",combined,self.nick.encode(),min(self.seen,255),self.content)
         else:
             print("WARNING Message.encode() unknown msg type",self.type)
             return None
 
     # Fill the message with the data found in the binary representation
-    # provided in 'msg'.
-    def decode(self, msg, keychain=None):
+    # provided in 'msg'. It can be a memoryview of the radio RX buffer,
+    # so we never retain references to it.
+    #
+    # Header fields are parsed in place with unpack_from(), and the
+    # content is decrypted into a buffer shared by all the messages, so
+    # the only copies are the ones the message needs to keep. The content
+    # is not validated here: see the content property.
+    #
+    # 'variable_len' must be True if the frame was received in explicit
+    # header mode, see encode() for the two DATA formats.
+    def decode(self, msg, keychain=None, variable_len=False):
         try:
-            combined = struct.unpack("<B", msg[0:1])[0]
+            mv = memoryview(msg)
+            combined = mv[0]
             
             # Extract type and flags
             mtype = combined & _MSG_TYPE_MASK
             flags = combined & _MSG_FLAGS_MASK
 
-            # If the message is encrypted, try to decrypt it.
-            if mtype == MSG_T_DATA and combined & MSG_FLAG_ENCR:
-                plain = keychain.decrypt(msg[4:])
-
-                # Messages for which we don't have a valid key
-                # are returned in a "raw" form, useful only for relaying.
-                # We signal that the message is in this state by
-                # setting .no_key to True. We also decode what is in the
-                # unencrypted part of the header.
-                if not plain:
-                    self.type = mtype
-                    self.flags = flags
-                    self.uid, self.ttl = struct.unpack("<HB", msg[1:4])
-                    self.no_key = True
-                    self.packet = msg
-                    return True
-
-                # If we have the key, the message is now decrypted.
-                # We can continue with the normal code path after
-                # populating key_name.
-                self.key_name = plain[0]
-                msg = msg[:4] + plain[1]
-                
             # Decode according to message type.
             if mtype == MSG_T_DATA:
                 self.type = mtype
                 self.flags = flags
-                self.uid, self.ttl = struct.unpack("<HB", msg[1:4])
+                self.uid, self.ttl = struct.unpack_from("<HB", mv, 1)
+                content = mv[4:]
+
+                # If the message is encrypted, try to decrypt it.
+                if combined & MSG_FLAG_ENCR:
+                    key_name = keychain.decrypt_into(content, _DECRYPT_BUF,
+                                    cipher_nonce(mtype, self.uid))
+
+                    # Messages for which we don't have a valid key
+                    # are returned in a "raw" form, useful only for
+                    # relaying. We signal that the message is in this
+                    # state by setting .no_key to True.
+                    if not key_name:
+                        self.no_key = True
+                        # 'msg' may be a view of the radio RX buffer: we
+                        # need our own copy to relay the packet later.
+                        self.packet = bytes(mv)
+                        return True
+
+                    # If we have the key, the message is now decrypted.
+                    self.key_name = key_name
+                    content = _DECRYPT_BUF[:len(content)-3]
+
                 self.nick = self.key_name
-                self.content = msg[4:].decode()
+                if variable_len:
+                    if len(content) == 0 or content[0] >= len(content):
+                        print('!!! Decoding message: bad content length')
+                        return False
+                    content = content[1:1+content[0]]
+                else:
+                    # Fixed length frames are never compressed, and the
+                    # content is zero padded.
+                    self.flags &= ~MSG_FLAG_PACKED
+                    end = len(content)
+                    while end and content[end-1] == 0: end -= 1
+                    content = content[:end]
+                self.set_content_bytes(content)
                 return True
             elif mtype == MSG_T_ACK:
                 self.type = mtype
                 self.flags = flags
-                self.uid,self.content = struct.unpack("<Hh",msg[1:5])
-                self.nick = msg[5:8].decode()
+                self.uid,self.content = struct.unpack_from("<Hh",mv,1)
+                self.nick = bytes(mv[5:8]).decode()
+                return True
+            elif mtype == MSG_T_ACKS:
+                self.type = mtype
+                self.flags = flags
+                nick, count = struct.unpack_from("<3sB",mv,1)
+                self.nick = nick.rstrip(b'\x00').decode() # Short nicks are padded.
+                self.content = [struct.unpack_from("<Hh",mv,5+i*4) for i in range(count)]
+                return True
+            elif mtype == MSG_T_HELLO:
+                self.type = mtype
+                self.flags = flags
+                nick, self.seen, self.content = struct.unpack_from("<3sBI",mv,1)
+                self.nick = nick.rstrip(b'\x00').decode() # Short nicks are padded.
                 return True
-#             elif mtype == MSG_T_HELLO:
-#                 self.type = mtype
-#                 self.flags = flags
-#                 self.seen = struct.unpack("<B",msg[1:2])
-#                 self.nick = msg[2:5].decode('utf-8')
-#                 return True
             else:
                 print(f'!!! Decoding message: wrong message type {mtype}')
                 return False
@@ -177,9 +359,51 @@ class Message:
             return False
 
     # Create a message object from the binary representation of a message.
-    def from_encoded(encoded, keychain):
+    def from_encoded(encoded, keychain, variable_len=False):
         m = Message()
-        if m.decode(encoded, keychain):
+        if m.decode(encoded, keychain, variable_len):
             return m
         else:
             return False
+
+# Entry of the processed messages cache for messages we did not
+# originate: to drop duplicates we only need to know that we saw the
+# message, and when, so we don't retain the whole message.
+class SeenMessage:
+    __slots__ = ('ctime',)
+    nick = None     # Never one of our messages: ACKs are ignored.
+
+    def __init__(self, ctime):
+        self.ctime = ctime
+
+# A bounded free list of Message objects. Decoding a received frame, or
+# sending an ACK, takes a message from the pool instead of allocating a
+# new one, and the message is put back when no longer referenced. This
+# way, under sustained RX, the heap does not fill with short lived
+# objects, and gc.collect() pauses become rare.
+class MessagePool:
+    def __init__(self, size=16):
+        self.size = size
+        self.free = []
+        self.reused = 0         # Messages taken from the free list.
+        self.allocated = 0      # Messages allocated: free list was empty.
+
+    # Return a message initialized as Message(**kwargs) would return it.
+    def acquire(self, **kwargs):
+        if len(self.free):
+            m = self.free.pop()
+            m.__init__(**kwargs)
+            self.reused += 1
+        else:
+            m = Message(**kwargs)
+            self.allocated += 1
+        return m
+
+    # Put back a message the caller no longer references. If the free
+    # list is full the message is left to the garbage collector.
+    def release(self, m):
+        if len(self.free) >= self.size or m in self.free: return
+        # Don't retain the content and the packet till reuse.
+        m.content = None
+        m.packet = None
+        self.free.append(m)
@@ -1,10 +1,26 @@
 from micropython import const
+import time
 
 _JOIN = const('<< Node Joined: ')
 _REJOIN = const('<< Node Rejoined: ')
 _TIMEOUT = const('<< Node Timed Out: ')
 _TAG = const('MESH')
 
+# Return the 32 bit digest of a set of nicks, piggybacked in HELLO
+# messages: it is a Bloom filter where every nick sets two bits, chosen
+# by its FNV-1a hash. With a few neighbors the digest tells, with some
+# false positive, if a given node is a neighbor of the sender.
+def nick_bits(nick):
+    h = 0x811c9dc5
+    for c in nick.encode():
+        h = ((h ^ c) * 0x01000193) & 0xffffffff
+    return (1 << (h & 31)) | (1 << ((h >> 5) & 31))
+
+def neighbors_digest(nicks):
+    digest = 0
+    for nick in nicks: digest |= nick_bits(nick)
+    return digest
+
 class Nodes:
     def __init__(self, logger):
         self.logger = logger
@@ -16,7 +32,11 @@ class Nodes:
         new = {
             'last_seen_ms':ticks_ms,
             'last_rssi':rssi,
-            'timedout':False
+            'timedout':False,
+            'seen':0,       # Neighbors count, from its HELLO messages.
+            'digest':0,     # Neighbors digest, from its HELLO messages.
+            'hello_ms':None,    # Time of its last HELLO.
+            'hello_period':0    # Time between its last two HELLOs.
             }
         self.all[nick] = new
         self.active[nick] = new
@@ -42,3 +62,35 @@ class Nodes:
     
     def seen(self, nick):
         return True if nick in self.all else False
+
+    # Remember the neighbors count and digest advertised in the HELLO
+    # message of 'nick', received at 'ticks_ms'. We also track the time
+    # between its HELLOs, since their period adapts, see timeout_ms().
+    def set_neighbors(self, nick, seen, digest, ticks_ms):
+        n = self.all[nick]
+        n['seen'] = seen
+        n['digest'] = digest
+        if n['hello_ms'] != None:
+            n['hello_period'] = time.ticks_diff(ticks_ms,n['hello_ms'])
+        n['hello_ms'] = ticks_ms
+
+    # Return the time without news from the node 'nick' after which it
+    # is considered gone: 'threshold' milliseconds, or more if the node
+    # sends its HELLOs less often. The HELLO period can double (plus a
+    # random 25%) from one HELLO to the next, so we wait three times
+    # the last period observed.
+    def timeout_ms(self, nick, threshold):
+        return max(threshold, self.all[nick]['hello_period']*3)
+
+    # Return the digest of our active neighbors.
+    def digest(self):
+        return neighbors_digest(self.active)
+
+    # Return True if 'other' may be a neighbor of 'nick', according to
+    # the last HELLO of 'nick': our 2-hop topology. False positives are
+    # possible, false negatives only if the HELLO is not recent.
+    def maybe_neighbor(self, nick, other):
+        n = self.all.get(nick)
+        if not n: return False
+        bits = nick_bits(other)
+        return (n['digest'] & bits) == bits
@@ -0,0 +1,257 @@
+# Copyright (C) 2024 Salvatore Sanfilippo <antirez@gmail.com>
+# All Rights Reserved
+#
+# This code is released under the BSD 2 clause license.
+# See the LICENSE file for more information
+
+import time, heapq
+from micropython import const
+
+# Keys are milliseconds relative to an epoch, since ticks wrap around.
+# Once the epoch is older than this, keys are recomputed against a new
+# one: they stay far from the range where ticks_diff() is ambiguous.
+_REBASE_MS = const(1<<27)
+
+# The send queue: messages ordered by their send_time, in a binary heap,
+# so that inserting a message is O(log N), and finding the next message
+# to send is O(1), however long the queue is.
+#
+# Heap entries are [key, seq, message] lists: 'seq' is an insertion
+# counter, so that messages with the same send time are sent in FIFO
+# order. Removing a message is lazy: its entry message is set to None,
+# and the entry is discarded when it reaches the top of the heap (or
+# when removed entries are too many, see remove()). Each queued message
+# references its entry in m.sched_entry.
+class SendScheduler:
+    def __init__(self):
+        self.heap = []
+        self.clear()
+
+    def clear(self):
+        for entry in self.heap:
+            if entry[2]: entry[2].sched_entry = None
+        self.heap = []
+        self.count = 0      # Messages in the heap, without removed ones.
+        self.seq = 0
+        self.epoch = time.ticks_ms()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, m):
+        return m.sched_entry != None
+
+    # Iterate the queued messages, in no particular order.
+    def __iter__(self):
+        for entry in self.heap:
+            if entry[2]: yield entry[2]
+
+    def key(self, ticks):
+        return time.ticks_diff(ticks, self.epoch)
+
+    # Recompute all the keys against a new epoch, dropping the entries
+    # of removed messages.
+    def rebase(self):
+        now = time.ticks_ms()
+        self.heap = [[time.ticks_diff(e[2].send_time,now),e[1],e[2]]
+                     for e in self.heap if e[2]]
+        for entry in self.heap: entry[2].sched_entry = entry
+        heapq.heapify(self.heap)
+        self.epoch = now
+
+    # Queue the message 'm', to send at m.send_time.
+    def push(self, m):
+        if time.ticks_diff(time.ticks_ms(),self.epoch) > _REBASE_MS:
+            self.rebase()
+        entry = [self.key(m.send_time), self.seq, m]
+        self.seq += 1
+        m.sched_entry = entry
+        heapq.heappush(self.heap, entry)
+        self.count += 1
+
+    # Remove the message 'm' from the queue, if queued.
+    def remove(self, m):
+        entry = m.sched_entry
+        if entry == None: return
+        entry[2] = None
+        m.sched_entry = None
+        self.count -= 1
+        if len(self.heap) > self.count*2+16: self.rebase()
+
+    # Call after changing m.send_time of a queued message.
+    def reschedule(self, m):
+        self.remove(m)
+        self.push(m)
+
+    # Return the message with the earliest send time, without removing
+    # it, or None if the queue is empty.
+    def peek(self):
+        heap = self.heap
+        while len(heap) and heap[0][2] == None: heapq.heappop(heap)
+        return heap[0][2] if len(heap) else None
+
+    # Remove and return the message with the earliest send time, or None
+    # if the queue is empty.
+    def pop(self):
+        m = self.peek()
+        if m:
+            heapq.heappop(self.heap)
+            m.sched_entry = None
+            self.count -= 1
+        return m
+
+    # Return the milliseconds till the earliest send time (0 or negative
+    # if a message is already due), or None if the queue is empty.
+    def next_due_ms(self):
+        m = self.peek()
+        if m == None: return None
+        return time.ticks_diff(m.send_time,time.ticks_ms())
+
+    # Return the messages due within 'ms' milliseconds from now, earliest
+    # first. Thanks to the heap property we only visit the entries that
+    # are due, and their children.
+    def due_within(self, ms):
+        limit = self.key(time.ticks_add(time.ticks_ms(),ms))
+        heap = self.heap
+        found = []
+        stack = [0]
+        while len(stack):
+            i = stack.pop()
+            if i >= len(heap) or heap[i][0] > limit: continue
+            if heap[i][2]: found.append(heap[i])
+            stack.append(2*i+1)
+            stack.append(2*i+2)
+        found.sort()
+        return [entry[2] for entry in found]
+
+# Classes of the messages in the send queue, from the most to the least
+# valuable: ACKs, data messages we originated, relays of messages of
+# other nodes, and HELLO beacons.
+SEND_CLASS_ACK = const(0)
+SEND_CLASS_DATA = const(1)
+SEND_CLASS_RELAY = const(2)
+SEND_CLASS_BEACON = const(3)
+SEND_CLASS_NAMES = ('ack','data','relay','beacon')
+
+# The send queue, split by message class: each class has its own
+# SendScheduler and its own capacity, so that a storm of relays can't
+# fill the queue with messages of other nodes, and the queue as a whole
+# holds at most 'max_len' messages.
+#
+# When a message does not fit, the least valuable message, among the
+# queued ones and the new one, is dropped: the one of the least valuable
+# class (of the same class, if the class is full), and within a class
+# the oldest, except for relays, where we drop the one that already
+# spent more TTL, that is, the one that already went farther. The data
+# messages we originate are an exception, see push().
+#
+# Among the messages that are due, the most valuable class is sent
+# first, otherwise messages are sent in send time order.
+#
+# The class of a message is m.send_class, set by the caller.
+class SendQueue:
+    def __init__(self, capacity=(16,20,30,4), max_len=50):
+        self.queues = [SendScheduler() for c in capacity]
+        self.capacity = capacity
+        self.max_len = max_len
+        self.drops = [0]*len(capacity)   # Dropped messages per class.
+
+    def clear(self):
+        for q in self.queues: q.clear()
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues)
+
+    def __contains__(self, m):
+        return m.sched_entry != None
+
+    def __iter__(self):
+        for q in self.queues:
+            for m in q: yield m
+
+    # Return the least valuable message queued in the class 'c', or
+    # None if the class is empty.
+    def least_valuable(self, c):
+        victim = None
+        for entry in self.queues[c].heap:
+            m = entry[2]
+            if m == None: continue
+            # Messages are compared by (ttl, seq): lower is worse.
+            key = (m.ttl if c == SEND_CLASS_RELAY else 0, entry[1])
+            if victim == None or key < victim_key:
+                victim, victim_key = m, key
+        return victim
+
+    # Queue the message 'm'. Return None if there was space for it,
+    # otherwise the message that was dropped to make space: either a
+    # queued message, that is removed from the queue, or 'm' itself,
+    # that was not queued.
+    def push(self, m):
+        c = m.send_class
+        victim = None
+        if len(self.queues[c]) >= self.capacity[c]:
+            victim = self.least_valuable(c)
+        elif len(self) >= self.max_len:
+            for worse in range(len(self.queues)-1,c,-1):
+                if worse == SEND_CLASS_DATA: continue
+                victim = self.least_valuable(worse)
+                if victim: break
+            else:
+                victim = self.least_valuable(c) or m
+        # A new relay is compared with the queued ones by TTL too, while
+        # in the other classes it is the most recent message, so the
+        # queued one is dropped. However our own data messages are never
+        # dropped once queued: the new one is refused instead, so that
+        # the caller knows.
+        if victim and victim.send_class == c:
+            if (c == SEND_CLASS_RELAY and m.ttl < victim.ttl) or \
+               c == SEND_CLASS_DATA:
+                victim = m
+        if victim:
+            self.drops[victim.send_class] += 1
+            if victim is m: return m
+            self.remove(victim)
+        self.queues[c].push(m)
+        return victim
+
+    def remove(self, m):
+        if m.sched_entry != None: self.queues[m.send_class].remove(m)
+
+    def reschedule(self, m):
+        self.queues[m.send_class].reschedule(m)
+
+    # Return the next message to send, without removing it: the first
+    # of the most valuable class with a due message, or the message with
+    # the earliest send time if none is due. None if the queue is empty.
+    def peek(self):
+        now = time.ticks_ms()
+        first = None
+        for q in self.queues:
+            m = q.peek()
+            if m == None: continue
+            if time.ticks_diff(m.send_time,now) <= 0: return m
+            if first == None or time.ticks_diff(m.send_time,first.send_time) < 0:
+                first = m
+        return first
+
+    # Remove and return the message peek() would return.
+    def pop(self):
+        m = self.peek()
+        if m: self.queues[m.send_class].remove(m)
+        return m
+
+    def next_due_ms(self):
+        due = None
+        for q in self.queues:
+            ms = q.next_due_ms()
+            if ms != None and (due == None or ms < due): due = ms
+        return due
+
+    # Return the messages due within 'ms' milliseconds from now, in send
+    # time order.
+    def due_within(self, ms):
+        found = []
+        for q in self.queues: found.extend(q.due_within(ms))
+        now = time.ticks_ms()
+        found.sort(key=lambda m: time.ticks_diff(m.send_time,now))
+        return found
@@ -0,0 +1 @@
+function generateTable(a,b){const c=document.createElement("table");c.className="airtime-table";const d=document.createElement("tr");a.forEach(a=>{const b=document.createElement("th");b.textContent=a,d.appendChild(b)}),c.appendChild(d),b.forEach(a=>{const b=document.createElement("tr");a.forEach(a=>{const c=document.createElement("td");c.textContent=a,b.appendChild(c)}),c.appendChild(b)});return c}function appendSection(a,b){const c=document.createElement("h2");c.textContent=a,document.body.appendChild(c),document.body.appendChild(b)}function displayAirtime(a){const b=a.lora||{},c=document.createElement("p");c.textContent=`Duty cycle: ${(a.duty_cycle??0).toFixed(2)}% measured, ${(a.predicted_duty_cycle??0).toFixed(2)}% predicted`,document.body.appendChild(c),appendSection(`Frames (SF${b.sf} BW${b.bw} CR4/${b.cr})`,generateTable(["Bytes","Airtime (ms)"],Object.entries(a.frames||{}).map(([a,b])=>[a,b]))),appendSection("Presets (20 bytes)",generateTable(["Preset","Airtime (ms)"],Object.entries(a.presets||{}).map(([a,b])=>[a,b]))),appendSection(`Send queue (${a.queue_airtime??0} ms)`,generateTable(["UID","Type","Bytes","TX","Airtime (ms)"],(a.queue||[]).map(a=>[a.uid,a.type,a.len,a.num_tx,a.airtime])))}async function fetchAirtimeData(){try{const a=await fetch("/airtime/get");if(!a.ok)throw new Error(`HTTP error! status: ${a.status}`);return await a.json()}catch(a){return console.error("Error fetching airtime data:",a),null}}async function main(){const a=await fetchAirtimeData();if(!a){const a=document.createElement("div");return a.textContent="Error: failed to fetch airtime data",a.style.color="red",void document.body.appendChild(a)}displayAirtime(a)}document.addEventListener("DOMContentLoaded",main);
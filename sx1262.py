@@ -10,12 +10,35 @@
 
 from machine import Pin
 from micropython import const
-import time
+import time, sys
 import struct
 import urandom
+import asyncio
+from array import array
 
 # SX1262 constants
-_PAYLOAD_LEN = const(20)
+_PAYLOAD_LEN = const(20)        # Frame length in implicit header mode.
+_MAX_PAYLOAD_LEN = const(255)   # Max frame length in explicit header mode.
+ImplicitPayloadLen = const(_PAYLOAD_LEN)
+
+# Maximum time, in microseconds, we wait for the BUSY line to go low
+# before giving up. Most commands release BUSY in a few microseconds,
+# image calibration and the chip startup after a reset are the slowest
+# operations and take a few milliseconds.
+_BUSY_TIMEOUT_US = const(10000)
+_RESET_BUSY_TIMEOUT_US = const(50000)
+# In RX duty cycle mode, BUSY high for more than this time means that the
+# chip is sleeping between two RX windows, see wait_ready().
+_SLEEP_BUSY_US = const(1000)
+
+# Received frames are stored in a ring of preallocated slots, see
+# rx_ring_put(). Each slot can hold the largest possible frame.
+_RX_RING_SLOTS = const(8)
+_RX_SLOT_LEN = const(256)
+
+# Size of the buffers used by command(): opcode + offset + 256 bytes,
+# enough for the largest WriteBuffer / ReadBuffer.
+_CMD_BUF_LEN = const(258)
 
 # Registers IDs and notable values
 RegRxGain = const(0x08ac)
@@ -52,15 +75,18 @@ SetRxCmd = const(0x82)
 SetTxCmd = const(0x83)
 SleepCmd = const(0x84)
 SetRfFrequencyCmd = const(0x86)
+SetCadParamsCmd = const(0x88)
 SetPacketTypeCmd = const(0x8a)
 SetModulationParamsCmd = const(0x8b)
 SetPacketParamsCmd = const(0x8c)
 SetTxParamsCmd = const(0x8e)
 SetBufferBaseAddressCmd = const(0x8f)
+SetRxDutyCycleCmd = const(0x94)
 SetPaConfigCmd = const(0x95)
 SetDIO3AsTCXOCtrlCmd = const(0x97)
 CalibrateImageCmd = const(0x98)
 SetDIO2AsRfSwitchCtrlCmd = const(0x9d)
+SetCadCmd = const(0xc5)
 
 # Constants for SetPacketParam() arguments
 PacketHeaderTypeExplicit = const(0)
@@ -75,15 +101,130 @@ PacketInvertedIQ = const(1)
 POAPreamble = const(0)
 POAHeader = const(1)
 
+# If a CAD started by start_cad() does not complete within this time
+# (in milliseconds), we consider it lost.
+_CAD_TIMEOUT = const(1000)
+
+# Default preamble length in symbols.
+_PREAMBLE_LEN = const(10)
+DefaultPreambleLen = const(_PREAMBLE_LEN)
+
 
 class SX1262:
     def __init__(self, pinset, rx_callback, tx_callback=None):
         self.receiving = False  # True if we are in receive mode.
         self.tx_in_progress = False
         self.packet_on_air = False  # see modem_is_receiving_packet().
+        self.cad_in_progress = False # see start_cad().
+        self.cad_start_time = 0
+        self.cad_result = None      # True if the last CAD found activity.
+        self.cad_result_time = 0
+
+        # In explicit header mode frames have the length of the data
+        # sent, otherwise they are always _PAYLOAD_LEN bytes. See send().
+        self.explicit_header = False
+        self.rx_packet_params_dirty = False
+        self.preamble_len = _PREAMBLE_LEN
+
+        # Shadow of the configuration applied to the chip: arguments of
+        # the last configuration commands sent, by opcode (and register
+        # address for register writes). See configure(). Cleared by
+        # reset().
+        self.shadow = {}
+
+        # RX duty cycle mode, see set_rx_duty_cycle(). When enabled,
+        # the chip alternates short RX windows with sleep periods, and
+        # rx_sleep_mode is True: the chip may be sleeping, and needs
+        # to be woken up before sending it commands. See wait_ready().
+        self.rx_duty_cycle = None   # (rx_ms, sleep_ms) or None.
+        self.rx_sleep_mode = False
+        self.set_rx_duty_cmd = bytearray(7)
+        self.set_rx_duty_cmd[0] = SetRxDutyCycleCmd
+
+        # Radio on time accounting, see set_radio_state(). radio_on_ratio
+        # is the fraction of time the radio is powered in the current
+        # state: 1 for RX, TX and CAD, 0 for standby, less than 1 in RX
+        # duty cycle mode. This is an estimate: in RX duty cycle mode
+        # we use the configured windows ratio, but the chip stays on
+        # longer when it detects a preamble, and we can't measure it.
+        self.radio_on_ms = 0
+        self.radio_on_ratio = 0
+        self.radio_state_time = time.ticks_ms()
         self.msg_sent = 0
         self.received_callback = rx_callback
         self.transmitted_callback = tx_callback
+        self.cad_callback = None    # Called when a CAD result is ready.
+
+        # Commands statistics: number of commands sent, total time
+        # spent waiting for the BUSY line, and how many times the chip
+        # was still busy after _BUSY_TIMEOUT_US.
+        self.cmd_count = 0
+        self.busy_wait_us = 0
+        self.busy_timeouts = 0
+
+        # The IRQ handler just sets this flag: the events are then
+        # processed by irq_task(), outside of the interrupt context.
+        self.irq_flag = asyncio.ThreadSafeFlag()
+
+        # RX ring buffer. Frames are read from the chip FIFO directly
+        # into the slots, and the received callback gets a memoryview
+        # of the slot, so no memory is allocated per frame. For each
+        # slot we also store length, raw RSSI and SNR as reported by
+        # the chip, bad CRC flag and time of reception in ticks_us.
+        self.rx_ring = bytearray(_RX_RING_SLOTS*_RX_SLOT_LEN)
+        self.rx_ring_mv = memoryview(self.rx_ring)
+        self.rx_len = bytearray(_RX_RING_SLOTS)
+        self.rx_rssi = bytearray(_RX_RING_SLOTS)
+        self.rx_snr = bytearray(_RX_RING_SLOTS)
+        self.rx_crc_err = bytearray(_RX_RING_SLOTS)
+        self.rx_ticks = array('I',[0]*_RX_RING_SLOTS)
+        self.rx_head = 0        # Next slot to fill.
+        self.rx_tail = 0        # Next slot to pass to the callback.
+        self.rx_used = 0        # Number of slots filled.
+        self.rx_dropped = 0     # Frames dropped because the ring was full.
+
+        # Preallocated buffers, so that talking with the chip does not
+        # allocate memory. command() uses the generic cmd_tx / cmd_rx
+        # buffers. The commands we send for every frame transmitted or
+        # received have their own buffers, with the opcode already in
+        # place, and are sent with fast_command().
+        self.cmd_tx = bytearray(_CMD_BUF_LEN)
+        self.cmd_rx = bytearray(_CMD_BUF_LEN)
+        self.cmd_tx_mv = memoryview(self.cmd_tx)
+        self.cmd_rx_mv = memoryview(self.cmd_rx)
+        self.get_irq_cmd = bytearray([GetIrqStatusCmd,0,0,0])
+        self.get_irq_reply = bytearray(4)
+        self.clear_irq_cmd = bytearray([ClearIrqStatusCmd,0xff,0xff])
+        self.rx_status_cmd = bytearray([GetRxBufferStatusCmd,0,0,0])
+        self.rx_status_reply = bytearray(4)
+        self.pkt_status_cmd = bytearray([GetPacketStatusCmd,0,0,0,0])
+        self.pkt_status_reply = bytearray(5)
+        self.set_rx_cmd = bytearray([SetRxCmd,0xff,0xff,0xff])
+        self.set_tx_cmd = bytearray([SetTxCmd,0,0,0])
+        self.set_cad_cmd = bytearray([SetCadCmd])
+        self.packet_params_cmd = bytearray(7)
+        self.packet_params_cmd[0] = SetPacketParamsCmd
+        self.packet_params_shadow = bytearray(6)
+        self.writebuf_cmd = bytearray([WriteBufferCmd,0])
+        self.readbuf_cmd = bytearray([ReadBufferCmd,0,0])
+        self.readbuf_reply = bytearray(3)
+        self.zeros = memoryview(bytearray(_RX_SLOT_LEN))
+
+        self.init_hardware(pinset)
+        self.sf = 0  # Currently set spreading.
+        self.bw = 0  # Currently set bandwidth. Saved to compute freq error.
+
+    # Create the pins and SPI objects used to talk with the chip.
+    # This is a separated method so that it is possible to subclass
+    # the driver replacing the hardware with something else (for
+    # instance in order to run benchmarks against a simulated chip).
+    #
+    # If the pinset has a 'backend' object, it provides the pins and the
+    # SPI bus instead, see sx1262_sim.py.
+    def init_hardware(self, pinset):
+        if pinset.get('backend'):
+            pinset['backend'].attach(self)
+            return
         self.busy_pin = Pin(pinset['busy'], Pin.IN)
         self.reset_pin = Pin(pinset['reset'], Pin.OUT)
         self.chipselect_pin = Pin(pinset['chipselect'], Pin.OUT)
@@ -102,19 +243,42 @@ class SX1262:
             self.spi = SPI(0,
                 baudrate=10_000_000, polarity=0, phase=0,
                     sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
-            
-        self.bw = 0  # Currently set bandwidth. Saved to compute freq error.
 
     def reset(self):
         self.reset_pin.off()
         time.sleep_us(500)
         self.reset_pin.on()
         time.sleep_us(500)
+        # The chip is no longer in RX duty cycle mode: clear the state
+        # before waiting, otherwise wait_ready() would try to wake it up
+        # while it is starting up.
+        self.shadow = {}
         self.receiving = False
         self.tx_in_progress = False
+        self.rx_sleep_mode = False
+        self.set_radio_state(0)
+        # After a reset the chip keeps BUSY high while starting up.
+        self.wait_ready(_RESET_BUSY_TIMEOUT_US)
 
     def standby(self):
         self.command(SetStandByCmd, 0)  # argument 0 means STDBY_RC mode.
+        self.rx_sleep_mode = False
+        self.set_radio_state(0)
+
+    # Account the time the radio was on in the previous state, and
+    # switch to a state where it is on for 'ratio' of the time.
+    def set_radio_state(self, ratio):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self.radio_state_time)
+        self.radio_on_ms += elapsed*self.radio_on_ratio
+        self.radio_state_time = now
+        self.radio_on_ratio = ratio
+
+    # Return the estimated total time, in milliseconds, the radio was on
+    # (in RX, TX or CAD mode) since the driver was created.
+    def get_radio_on_time(self):
+        self.set_radio_state(self.radio_on_ratio)
+        return int(self.radio_on_ms)
 
     # Note: the CS pin logic is inverted. It requires to be set to low
     # when the chip is NOT selected for data transfer.
@@ -124,26 +288,69 @@ class SX1262:
     def select_chip(self):
         self.chipselect_pin.off()
 
+    # Wait for the BUSY line to go low, that is, for the chip to be
+    # ready to accept a new command. Return False if the chip is still
+    # busy after 'timeout_us' microseconds.
+    #
+    # In RX duty cycle mode the chip keeps BUSY high while sleeping
+    # between RX windows, and only wakes up on the falling edge of
+    # the chip select line: if BUSY stays high longer than it takes to
+    # process a command, we wake it up. After waking up it is in standby:
+    # the duty cycle is over, and receive() must be called to restart
+    # it (this happens naturally since we only send commands in this
+    # mode in order to transmit or to run a CAD).
+    def wait_ready(self, timeout_us=_BUSY_TIMEOUT_US):
+        if not self.busy_pin.value(): return True
+        start = time.ticks_us()
+        while self.busy_pin.value():
+            elapsed = time.ticks_diff(time.ticks_us(),start)
+            if self.rx_sleep_mode and elapsed > _SLEEP_BUSY_US:
+                self.rx_sleep_mode = False
+                self.set_radio_state(0)
+                self.select_chip()
+                time.sleep_us(100)
+                self.deselect_chip()
+                timeout_us = elapsed + _RESET_BUSY_TIMEOUT_US
+            if elapsed > timeout_us:
+                self.busy_wait_us += timeout_us
+                self.busy_timeouts += 1
+                return False
+        self.busy_wait_us += time.ticks_diff(time.ticks_us(),start)
+        return True
+
     # Send a read or write command, and return the reply we
     # got back. 'data' can be both an array of a single integer.
+    #
+    # The command is built inside a preallocated buffer, and the reply
+    # returned is a view of another preallocated buffer: it is only
+    # valid till the next command is sent, so callers wishing to retain
+    # it must copy it.
+    #
+    # We don't sleep after the command: the chip raises the BUSY line
+    # while it is processing it, so before sending the next command we
+    # just wait for BUSY to go low again.
     def command(self, opcode, data=None):
+        tx = self.cmd_tx
+        tx[0] = opcode
+        n = 1
         if data != None:
             if isinstance(data, int):
-                data = [data]
-            payload = bytearray(1+len(data))  # opcode + payload
-            payload[0] = opcode
-            payload[1:] = bytes(data)
-        else:
-            payload = bytearray([opcode])
-        reply = bytearray(len(payload))
+                tx[1] = data
+                n = 2
+            else:
+                for b in data:
+                    tx[n] = b
+                    n += 1
+        reply = self.cmd_rx_mv[:n]
 
         # Wait for the chip to return available.
-        while self.busy_pin.value():
-            time.sleep_us(1)
+        if not self.wait_ready():
+            print(f"SX1262: BUSY timeout before command {hex(opcode)}")
 
         self.select_chip()
-        self.spi.write_readinto(payload, reply)
+        self.spi.write_readinto(self.cmd_tx_mv[:n], reply)
         self.deselect_chip()
+        self.cmd_count += 1
 
         # Enable this for debugging.
         if False:
@@ -151,50 +358,102 @@ class SX1262:
             print("Chip mode  = ", (reply[1] >> 4) & 7)
             print("Cmd status = ", (reply[1] >> 1) & 7)
 
-        # Wait for the chip to be ready for the next command.
-        time.sleep_us(4000)
+        return reply
 
+    # Send a command already fully built in the preallocated buffer 'cmd'.
+    # If 'reply' is given, it must be a buffer of the same length, and is
+    # filled with the chip reply. This is the path used by the commands
+    # sent for every frame: it does not allocate memory.
+    def fast_command(self, cmd, reply=None):
+        if not self.wait_ready():
+            print(f"SX1262: BUSY timeout before command {hex(cmd[0])}")
+        self.select_chip()
+        if reply != None:
+            self.spi.write_readinto(cmd, reply)
+        else:
+            self.spi.write(cmd)
+        self.deselect_chip()
+        self.cmd_count += 1
         return reply
 
+    # Send a sequence of commands, provided as a list of (opcode, data)
+    # tuples. Between commands we only wait for the BUSY line, so the
+    # sequence takes just the time the chip needs to process it.
+    # Return the time spent, in microseconds.
+    def command_sequence(self, seq):
+        start = time.ticks_us()
+        for opcode, data in seq:
+            self.command(opcode, data)
+        return time.ticks_diff(time.ticks_us(),start)
+
     def readreg(self, addr, readlen=1):
         payload = bytearray(2+1+readlen)  # address + nop + nop*bytes_to_read
         payload[0] = (addr & 0xff00) >> 8
         payload[1] = addr & 0xff
         reply = self.command(ReadRegisterCmd, payload)
-        return reply[4:]
+        return bytes(reply[4:])
 
-    def writereg(self, addr, data):
+    # Return the WriteRegister command arguments to set the register
+    # at 'addr' to 'data'. Used by writereg() and by command sequences.
+    def writereg_args(self, addr, data):
         if isinstance(data, int):
             data = bytes([data])
         payload = bytearray(2+len(data))  # address + bytes_to_write
         payload[0] = (addr & 0xff00) >> 8
         payload[1] = addr & 0xff
         payload[2:] = data
-        self.command(WriteRegisterCmd, payload)
+        return payload
+
+    def writereg(self, addr, data):
+        self.command(WriteRegisterCmd, self.writereg_args(addr, data))
 
     def readbuf(self, off, numbytes):
         payload = bytearray(2+numbytes)
         payload[0] = off
         data = self.command(ReadBufferCmd, payload)
-        return data[3:]
+        return bytes(data[3:])
+
+    # Read len(dest) bytes from the chip FIFO, starting at 'off', directly
+    # into 'dest', that must be a memoryview. Unlike readbuf() this does
+    # not allocate new buffers.
+    def readbuf_into(self, off, dest):
+        self.readbuf_cmd[1] = off
+        if not self.wait_ready():
+            print("SX1262: BUSY timeout before ReadBuffer")
+        self.select_chip()
+        self.spi.write_readinto(self.readbuf_cmd, self.readbuf_reply)
+        self.spi.write_readinto(self.zeros[:len(dest)], dest)
+        self.deselect_chip()
+        self.cmd_count += 1
 
+    # Write 'data' in the chip FIFO at offset 'off'. The data is sent
+    # directly from the caller buffer, without copying it.
     def writebuf(self, off, data):
-        payload = bytearray(1+len(data))
-        payload[0] = off
-        payload[1:] = data
-        self.command(WriteBufferCmd, payload)
+        self.writebuf_cmd[1] = off
+        if not self.wait_ready():
+            print("SX1262: BUSY timeout before WriteBuffer")
+        self.select_chip()
+        self.spi.write(self.writebuf_cmd)
+        self.spi.write(data)
+        self.deselect_chip()
+        self.cmd_count += 1
 
-    def set_frequency(self, mhz):
+    def frequency_args(self, mhz):
         # The final frequency is (rf_freq * xtal freq) / 2^25.
         oscfreq = 32000000  # Oscillator frequency for registers calculation
         rf_freq = int(mhz * (2**25) / oscfreq)
-        arg = [(rf_freq & 0xff000000) >> 24,
-               (rf_freq & 0xff0000) >> 16,
-               (rf_freq & 0xff00) >> 8,
-               (rf_freq & 0xff)]
-        self.command(SetRfFrequencyCmd, arg)
+        return [(rf_freq & 0xff000000) >> 24,
+                (rf_freq & 0xff0000) >> 16,
+                (rf_freq & 0xff00) >> 8,
+                (rf_freq & 0xff)]
+
+    def set_frequency(self, mhz):
+        self.command(SetRfFrequencyCmd, self.frequency_args(mhz))
 
-    def set_packet_params(self, preamble_len=10, header_type=PacketHeaderTypeImplicit, payload_len=_PAYLOAD_LEN, crc=PacketCRCOn, iq_setup=PacketStandardIQ):
+    # When preamble_len is None, the preamble length set in
+    # self.preamble_len is used.
+    def packet_params_args(self, preamble_len=None, header_type=PacketHeaderTypeImplicit, payload_len=_PAYLOAD_LEN, crc=PacketCRCOn, iq_setup=PacketStandardIQ):
+        if preamble_len == None: preamble_len = self.preamble_len
         pp = bytearray(6)
         pp[0] = preamble_len >> 8
         pp[1] = preamble_len & 0xff
@@ -202,7 +461,25 @@ class SX1262:
         pp[3] = payload_len
         pp[4] = crc
         pp[5] = iq_setup
-        self.command(SetPacketParamsCmd, pp)
+        return pp
+
+    def set_packet_params(self, preamble_len=None, header_type=PacketHeaderTypeImplicit, payload_len=_PAYLOAD_LEN, crc=PacketCRCOn, iq_setup=PacketStandardIQ):
+        if preamble_len == None: preamble_len = self.preamble_len
+        pp = self.packet_params_cmd
+        pp[1] = preamble_len >> 8
+        pp[2] = preamble_len & 0xff
+        pp[3] = header_type
+        pp[4] = payload_len
+        pp[5] = crc
+        pp[6] = iq_setup
+        self.fast_command(pp)
+
+        # Track the params written in the shadow configuration, so that
+        # configure() knows if it needs to send them again. They are
+        # copied into a preallocated buffer: this runs for every frame.
+        shadow = self.packet_params_shadow
+        for i in range(6): shadow[i] = pp[i+1]
+        self.shadow[SetPacketParamsCmd] = shadow
 
     def begin(self):
         self.reset()
@@ -215,10 +492,58 @@ class SX1262:
         curval |= 0x1E
         self.writereg(RegTxClampConfig, curval)
 
+    # Return the packet params arguments used while receiving. In
+    # explicit header mode we accept frames of any length.
+    def rx_packet_params_args(self):
+        if self.explicit_header:
+            return self.packet_params_args(
+                header_type=PacketHeaderTypeExplicit,
+                payload_len=_MAX_PAYLOAD_LEN)
+        return self.packet_params_args()
+
+    # Return the key of the command in the shadow configuration.
+    # Register writes are tracked per register address.
+    def shadow_key(self, opcode, data):
+        if opcode == WriteRegisterCmd:
+            return (opcode << 16) | (data[0] << 8) | data[1]
+        return opcode
+
+    # Remove from the commands sequence 'seq' the commands that would
+    # set the chip to the configuration it already has, according to
+    # the shadow configuration. ClearIrqStatus is an action, not a
+    # setting, and is removed as well.
+    def changed_commands(self, seq):
+        changed = []
+        for opcode, data in seq:
+            if opcode == ClearIrqStatusCmd: continue
+            if isinstance(data, int): data = [data]
+            if self.shadow.get(self.shadow_key(opcode, data)) != bytes(data):
+                changed.append((opcode, data))
+        return changed
+
+    # Send the commands sequence 'seq', updating the shadow
+    # configuration.
+    def configuration_sequence(self, seq):
+        self.command_sequence(seq)
+        for opcode, data in seq:
+            if opcode == ClearIrqStatusCmd: continue
+            if isinstance(data, int): data = [data]
+            self.shadow[self.shadow_key(opcode, data)] = bytes(data)
+
     # Set the radio parameters. Allowed spreadings are from 6 to 12.
     # Bandwidth and coding rate are listeed below in the dictionaries.
-    # TX power is from -9 to +22 dbm.
-    def configure(self, freq, bandwidth, rate, spreading, txpower):
+    # TX power is from -9 to +22 dbm. If explicit_header is True, frames
+    # are sent with the LoRa header and have variable length, otherwise
+    # we use implicit header mode and fixed length frames.
+    #
+    # If incremental is True, we only send the commands changing the
+    # configuration the chip already has, without interrupting the
+    # reception if nothing changed. Otherwise the whole configuration
+    # is sent. Return the number of configuration commands sent.
+    #
+    # 'cad' is an optional (symbols, det_peak, det_min) tuple with the
+    # Channel Activity Detection parameters, see cad_params_args().
+    def configure(self, freq, bandwidth, rate, spreading, txpower, explicit_header=False, incremental=False, cad=None):
         Bw = {7800: 0,
               10400: 0x8,
               15600: 0x1,
@@ -234,9 +559,9 @@ class SX1262:
                       7: 3,
                       8: 4}
 
-        # Make sure the chip is in standby mode
-        # during configuration.
-        self.standby()
+        # The whole configuration is sent as a single sequence of
+        # commands, see command_sequence().
+        seq = []
 
         # Set LoRa parameters.
         lp = bytearray(4)
@@ -244,16 +569,20 @@ class SX1262:
         lp[1] = Bw[bandwidth]
         lp[2] = CodingRate[rate]
         lp[3] = 1  # Enable low data rate optimization
-        self.command(SetModulationParamsCmd, lp)
+        seq.append((SetModulationParamsCmd, lp))
 
         # Set packet params.
-        self.set_packet_params()
+        self.sf = spreading
+        self.bw = bandwidth
+        self.explicit_header = explicit_header
+        self.rx_packet_params_dirty = False
+        seq.append((SetPacketParamsCmd, self.rx_packet_params_args()))
 
         # Set RF frequency.
-        self.set_frequency(freq)
+        seq.append((SetRfFrequencyCmd, self.frequency_args(freq)))
 
         # Use maximum sensibility
-        self.writereg(RegRxGain, 0x96)
+        seq.append((WriteRegisterCmd, self.writereg_args(RegRxGain, 0x96)))
 
         # Set TCXO voltage to 1.7 with 5000us delay.
         tcxo_delay = int(5000.0 / 15.625)
@@ -262,10 +591,10 @@ class SX1262:
         tcxo_config[1] = (tcxo_delay >> 16) & 0xff
         tcxo_config[2] = (tcxo_delay >> 8) & 0xff
         tcxo_config[3] = (tcxo_delay >> 0) & 0xff
-        self.command(SetDIO3AsTCXOCtrlCmd, tcxo_config)
+        seq.append((SetDIO3AsTCXOCtrlCmd, tcxo_config))
 
         # Set DIO2 as RF switch like in Semtech examples.
-        self.command(SetDIO2AsRfSwitchCtrlCmd, 1)
+        seq.append((SetDIO2AsRfSwitchCtrlCmd, 1))
 
         # Set the power amplifier configuration.
         paconfig = bytearray(4)
@@ -273,19 +602,19 @@ class SX1262:
         paconfig[1] = 7  # Max output +22 dBm
         paconfig[2] = 0  # Select PA for SX1262 (1 would be SX1261)
         paconfig[3] = 1  # Always set to 1 as for datasheet
-        self.command(SetPaConfigCmd, paconfig)
+        seq.append((SetPaConfigCmd, paconfig))
 
         # Set TX power and ramping. We always use high power mode.
         txpower = min(max(-9, txpower), 22)
         txparams = bytearray(2)
         txparams[0] = (0xF7 + (txpower+9)) % 256
         txparams[1] = 4  # 200us ramping time
-        self.command(SetTxParamsCmd, txparams)
+        seq.append((SetTxParamsCmd, txparams))
 
         # We either receive or send, so let's use all the 256 bytes
         # of FIFO available by setting both recv and send FIFO address
         # to the base.
-        self.command(SetBufferBaseAddressCmd, [0, 0])
+        seq.append((SetBufferBaseAddressCmd, [0, 0]))
 
         # Setup the IRQ handler to receive the packet tx/rx and
         # other events. Note that the chip will put the packet
@@ -294,15 +623,17 @@ class SX1262:
         # practice most of the times only one chip DIO is connected
         # to the MCU.
         self.dio_pin.irq(handler=self.txrxdone, trigger=Pin.IRQ_RISING)
-        self.command(SetDioIrqParamsCmd, [
-                     0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff])
-        self.clear_irq()
+        seq.append((SetDioIrqParamsCmd, [
+                    0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff]))
+        seq.append((ClearIrqStatusCmd, [0xff, 0xff]))
 
         # Set sync word to 0x12 (private network).
         # Note that "12" is in the most significant hex digits of
         # the two registers: [1]4 and [2]4.
-        self.writereg(RegLoRaSyncWordMSB, 0x14)
-        self.writereg(RegLoRaSyncWordLSB, 0x24)
+        seq.append((WriteRegisterCmd,
+                    self.writereg_args(RegLoRaSyncWordMSB, 0x14)))
+        seq.append((WriteRegisterCmd,
+                    self.writereg_args(RegLoRaSyncWordLSB, 0x24)))
 
         # Calibrate for the specific selected frequency
         if 430 <= freq <= 440:
@@ -319,7 +650,30 @@ class SX1262:
             f1, f2 = None, None
 
         if f1 and f2:
-            self.command(CalibrateImageCmd, [f1, f2])
+            seq.append((CalibrateImageCmd, [f1, f2]))
+
+        if cad:
+            seq.append((SetCadParamsCmd,
+                        self.cad_params_args(cad[0],cad[1],cad[2],spreading)))
+
+        if incremental: seq = self.changed_commands(seq)
+        if not seq: return 0
+
+        # Make sure the chip is in standby mode
+        # during configuration.
+        self.standby()
+        self.configuration_sequence(seq)
+
+        # Going in standby aborted the frame we were transmitting, if
+        # any, and a CAD in progress. We will not get their IRQs, so
+        # end them here: the transmitted callback is called as if the
+        # TX was done, otherwise the user would wait for it forever.
+        self.cad_in_progress = False
+        if self.tx_in_progress:
+            self.tx_in_progress = False
+            if self.transmitted_callback:
+                self.run_callback(self.transmitted_callback)
+        return len(seq)
 
     # This is just for debugging. We can understand if a given command
     # caused a failure while debugging the driver since the command status
@@ -330,63 +684,209 @@ class SX1262:
         print("Chip mode  = ", (status >> 4) & 7)
         print("Cmd status = ", (status >> 1) & 7)
 
-    # Put the chip in continuous receive mode.
+    # Set the preamble length, in symbols, used for the frames we
+    # send and receive. Takes effect with the next configure(), send()
+    # or receive().
+    def set_preamble_len(self, preamble_len):
+        self.preamble_len = min(max(preamble_len,_PREAMBLE_LEN),0xffff)
+        self.rx_packet_params_dirty = True
+
+    # Enable the RX duty cycle mode: instead of continuous receive, the
+    # chip listens for 'rx_ms' milliseconds, then sleeps 'sleep_ms'
+    # milliseconds, and so forth. If a preamble is detected during the
+    # RX window, the chip stays in RX till the frame is received. So
+    # in order to be received, frames must be sent with a preamble
+    # longer than sleep_ms + 2*rx_ms, see airtime.wakeup_preamble_len().
+    # Passing None disables the mode. Takes effect with the next
+    # receive().
+    def set_rx_duty_cycle(self, rx_ms, sleep_ms=None):
+        if rx_ms == None:
+            self.rx_duty_cycle = None
+            return
+        self.rx_duty_cycle = (rx_ms, sleep_ms)
+        # Periods are in units of 15.625 us, that is 1/64 of ms,
+        # as 24 bits big endian values.
+        cmd = self.set_rx_duty_cmd
+        for i, ms in ((1,rx_ms),(4,sleep_ms)):
+            period = min(ms*64,0xffffff)
+            cmd[i] = period >> 16
+            cmd[i+1] = (period >> 8) & 0xff
+            cmd[i+2] = period & 0xff
+
+    # Put the chip in receive mode: continuous, or duty cycled if
+    # enabled with set_rx_duty_cycle().
     # Note that the SX1262 is bugged and if there is a strong
     # nearby signal sometimes it "crashes" and no longer
     # receives anything, so it may be a better approach to
     # set a timeout and re-enter receive from time to time?
     def receive(self):
-        self.command(SetRxCmd, [0xff, 0xff, 0xff])
+        # In explicit header mode send() sets the payload length to the
+        # size of the frame transmitted. Restore the max length. The
+        # params are also restored after a preamble length change.
+        if self.rx_packet_params_dirty:
+            if self.explicit_header:
+                self.set_packet_params(header_type=PacketHeaderTypeExplicit,
+                                       payload_len=_MAX_PAYLOAD_LEN)
+            else:
+                self.set_packet_params()
+            self.rx_packet_params_dirty = False
+        if self.rx_duty_cycle:
+            self.fast_command(self.set_rx_duty_cmd)
+            self.rx_sleep_mode = True
+            rx_ms, sleep_ms = self.rx_duty_cycle
+            self.set_radio_state(rx_ms/(rx_ms+sleep_ms))
+        else:
+            self.fast_command(self.set_rx_cmd)
+            self.set_radio_state(1)
         self.receiving = True
 
     def get_irq(self):
-        reply = self.command(GetIrqStatusCmd, [0, 0, 0])
+        reply = self.fast_command(self.get_irq_cmd, self.get_irq_reply)
         return (reply[2] << 8) | reply[3]
 
     def clear_irq(self):
-        reply = self.command(ClearIrqStatusCmd, [0xff, 0xff])
+        self.fast_command(self.clear_irq_cmd)
 
-    # This is our IRQ handler. By default we don't mask any interrupt
-    # so the function may be called for more events we actually handle.
+    # This is our IRQ handler. It runs in interrupt context, so it does
+    # the minimum possible work: no SPI transfers and no allocations.
+    # It just wakes up irq_task(), that will talk with the chip and
+    # process the event.
     def txrxdone(self, pin):
+        self.irq_flag.set()
+
+    # Task processing the events signaled by the IRQ handler. It must
+    # be started by the application with asyncio.create_task(). The
+    # received and transmitted callbacks are called from this task.
+    async def irq_task(self):
+        while True:
+            await self.irq_flag.wait()
+            # If this task ends, nobody services the IRQs anymore, and
+            # the node can't receive nor transmit till reboot: log any
+            # error and keep going.
+            try:
+                self.service_irq()
+            except Exception as e:
+                print("SX1262: error servicing the IRQ")
+                sys.print_exception(e)
+
+    # Call a callback registered by the user, logging the exceptions it
+    # raises instead of propagating them: the other events must be
+    # handled anyway.
+    def run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            print("SX1262: error in callback")
+            sys.print_exception(e)
+
+    # Handle all the pending events, then pass the received frames to
+    # the callback.
+    def service_irq(self):
+        # While we handle an event the chip may raise new ones
+        # (for instance a back-to-back frame): keep going until
+        # the IRQ status register is clear.
+        while self.process_irq(): pass
+        self.rx_ring_drain()
+
+    # Store the frame just received in the next slot of the RX ring.
+    # If the ring is full the frame is dropped.
+    def rx_ring_put(self, bad_crc):
+        bs = self.fast_command(self.rx_status_cmd, self.rx_status_reply)
+        ps = self.fast_command(self.pkt_status_cmd, self.pkt_status_reply)
+        if self.rx_used == _RX_RING_SLOTS:
+            self.rx_dropped += 1
+            return
+
+        slot = self.rx_head
+        packet_len = bs[2]
+        packet_start = bs[3]
+        off = slot*_RX_SLOT_LEN
+        self.readbuf_into(packet_start,
+                          self.rx_ring_mv[off:off+packet_len])
+        self.rx_len[slot] = packet_len
+        self.rx_rssi[slot] = ps[2]
+        self.rx_snr[slot] = ps[3]
+        self.rx_crc_err[slot] = bad_crc
+        self.rx_ticks[slot] = time.ticks_us()
+        self.rx_head = (slot+1) % _RX_RING_SLOTS
+        self.rx_used += 1
+
+    # Call the received callback for every frame in the RX ring, from
+    # the oldest to the newest. The packet passed to the callback is a
+    # memoryview of the ring slot, that is reused once the callback
+    # returns: callers that want to retain the packet must copy it.
+    def rx_ring_drain(self):
+        while self.rx_used:
+            slot = self.rx_tail
+            off = slot*_RX_SLOT_LEN
+            packet = self.rx_ring_mv[off:off+self.rx_len[slot]]
+            rssi = -self.rx_rssi[slot]/2  # Average RSSI in dB.
+            snr = self.rx_snr[slot]
+            snr = snr-256 if snr > 128 else snr  # Convert to signed
+            snr /= 4  # The reported value is upscaled 4 times.
+            bad_crc = self.rx_crc_err[slot] != 0
+
+            # Consume the slot before calling the callback: if it fails,
+            # we must not deliver the same frame again. The slot is not
+            # reused while the callback runs, since new frames are only
+            # stored by process_irq(), in this same task.
+            self.rx_tail = (slot+1) % _RX_RING_SLOTS
+            self.rx_used -= 1
+
+            # Call the callback the user registered, if any.
+            if self.received_callback:
+                self.run_callback(self.received_callback,
+                                  self, packet, rssi, snr, bad_crc)
+
+    # Read the IRQ status and handle the pending events. By default we
+    # don't mask any interrupt so we may find more events than the ones
+    # we actually handle. Return False if no event was pending.
+    def process_irq(self):
         event = self.get_irq()
+        if event == IRQSourceNone: return False
         self.clear_irq()
 
         if event & (IRQSourceRxDone | IRQSourceCrcErr):
             # Packet received. The channel is no longer busy.
             self.packet_on_air = False
 
-            # Obtain packet information.
-            bs = self.command(GetRxBufferStatusCmd, [0]*3)
-            ps = self.command(GetPacketStatusCmd, [0]*4)
-
-            # Extract packet information.
-            packet_len = bs[2]
-            packet_start = bs[3]         
-            rssi = -ps[2]/2  # Average RSSI in dB.
-            snr = ps[3]-256 if ps[3] > 128 else ps[3]  # Convert to unsigned
-            snr /= 4  # The reported value is upscaled 4 times.
-
-            packet = self.readbuf(packet_start, packet_len)
             bad_crc = (event & IRQSourceCrcErr) != 0
-
             if bad_crc:
                 print("SX1262: packet with bad CRC received")
 
-            # Call the callback the user registered, if any.
-            if self.received_callback:
-                self.received_callback(self, packet, rssi, snr, bad_crc)
-                
+            # Save the packet in the RX ring. The received callback
+            # is called later by rx_ring_drain().
+            self.rx_ring_put(bad_crc)
+
+            # In RX duty cycle mode, after a frame is received the
+            # chip returns in standby: restart the duty cycle.
+            if self.rx_duty_cycle and self.receiving:
+                self.receive()
+
         elif event & IRQSourceTxDone:
             self.msg_sent += 1
             # After sending a message, the chip will return in
             # standby mode. However if we were receiving we
             # need to return back to such state.
             if self.transmitted_callback:
-                self.transmitted_callback()
+                self.run_callback(self.transmitted_callback)
             if self.receiving:
                 self.receive()
+            else:
+                self.set_radio_state(0)
             self.tx_in_progress = False
+        elif event & IRQSourceCadDone:
+            # The CAD is over: the chip is now in standby, so return
+            # to receive mode if needed.
+            self.cad_in_progress = False
+            self.cad_result = (event & IRQSourceCadDetected) != 0
+            self.cad_result_time = time.ticks_ms()
+            if self.receiving:
+                self.receive()
+            else:
+                self.set_radio_state(0)
+            if self.cad_callback:
+                self.run_callback(self.cad_callback)
         elif event & IRQSourcePreambleDetected:
             # Packet detected, we will return true for some
             # time when user calls modem_is_receiving_packet().
@@ -399,6 +899,7 @@ class SX1262:
             self.packet_on_air_type = POAHeader
         else:
             print("SX1262: not handled event IRQ flags "+bin(event))
+        return True
 
     def get_instantaneous_rss(self):
         data = self.command(0x15, [0, 0])
@@ -413,25 +914,79 @@ class SX1262:
     # While the RX1276 has a register that tells us if a reception is
     # in progress, the RX1262 lacks it, so we try to do our best using
     # other systems...
-    def modem_is_receiving_packet(self):
+    #
+    # The timeouts, in milliseconds, tell us for how long we trust the
+    # detection of just a preamble or also a valid header.
+    def modem_is_receiving_packet(self, preamble_timeout=2000, header_timeout=5000):
         if self.packet_on_air != False:
             # We are willing to wait more or less before cleaning
             # the channel busy flag, depending on the fact we
             # were able to detect just a preamble or also a valid
             # header.
-            timeout = 2000 if self.packet_on_air_type == POAPreamble else 5000
+            timeout = preamble_timeout if self.packet_on_air_type == POAPreamble else header_timeout
             age = time.ticks_diff(time.ticks_ms(), self.packet_on_air)
             if age > timeout:
                 self.packet_on_air = False
         return self.packet_on_air != False
 
+    # Return the arguments of SetCadParams for the Channel Activity
+    # Detection parameters: the number of symbols to listen (1, 2, 4, 8
+    # or 16), and the detection peak and minimum thresholds. When
+    # det_peak is 0, the value suggested by Semtech for the spreading
+    # is used. See configure().
+    def cad_params_args(self, symbols, det_peak, det_min, spreading):
+        CadSymbols = {1: 0, 2: 1, 4: 2, 8: 3, 16: 4}
+        CadDetPeak = {5: 22, 6: 22, 7: 22, 8: 22, 9: 23, 10: 24,
+                      11: 25, 12: 28}
+        if det_peak == 0: det_peak = CadDetPeak[spreading]
+        # The last 4 bytes are the exit mode (CAD only, return in
+        # standby when done) and the timeout, only used by CAD_RX.
+        return [CadSymbols[symbols], det_peak, det_min, 0, 0, 0, 0]
+
+    # Start a Channel Activity Detection, used for listen-before-talk.
+    # The CAD takes just a few symbols time, then the CadDone IRQ sets
+    # self.cad_result to True if activity was detected, otherwise False,
+    # and we return to receive mode. Note that while the CAD is in
+    # progress we are not receiving.
+    def start_cad(self):
+        self.cad_result = None
+        self.cad_in_progress = True
+        self.cad_start_time = time.ticks_ms()
+        self.standby()
+        self.fast_command(self.set_cad_cmd)
+        self.set_radio_state(1)
+
+    # Return True if a CAD is in progress. If the CAD started long ago
+    # and we never got the CadDone event, consider it lost.
+    def cad_running(self):
+        if self.cad_in_progress:
+            age = time.ticks_diff(time.ticks_ms(), self.cad_start_time)
+            if age > _CAD_TIMEOUT:
+                self.cad_in_progress = False
+                if self.receiving: self.receive()
+        return self.cad_in_progress
+
     # Send the specified packet immediately. Will raise the interrupt
     # when finished.
+    #
+    # In explicit header mode the frame is exactly as long as 'data'.
+    # In implicit header mode frames are always _PAYLOAD_LEN bytes, so
+    # shorter data is padded with zeros.
     def send(self, data):
         self.tx_in_progress = True
-        self.set_packet_params()
-        self.writebuf(0x00, data)
-        self.command(SetTxCmd, [0, 0, 0])  # Enter TX mode without timeout.
+        if self.explicit_header:
+            self.set_packet_params(header_type=PacketHeaderTypeExplicit,
+                                   payload_len=len(data))
+            self.rx_packet_params_dirty = True
+            self.writebuf(0x00, data)
+        else:
+            self.set_packet_params()
+            self.writebuf(0x00, data)
+            if len(data) < _PAYLOAD_LEN:
+                self.writebuf(len(data), self.zeros[:_PAYLOAD_LEN-len(data)])
+        self.fast_command(self.set_tx_cmd)  # Enter TX mode without timeout.
+        self.rx_sleep_mode = False
+        self.set_radio_state(1)
 
 
 # # Example usage.
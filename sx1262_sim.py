@@ -0,0 +1,508 @@
+# Copyright (C) 2024 Salvatore Sanfilippo <antirez@gmail.com>
+# All Rights Reserved
+#
+# This code is released under the BSD 2 clause license.
+# See the LICENSE file for more information
+
+# Simulated SX1262 chip. It replaces the pins and the SPI bus used by the
+# driver, so that the driver, and the whole FreakWAN stack on top of it,
+# can run without the radio hardware: on a board without the LoRa chip,
+# or on the host with CPython (see host/sitecustomize.py).
+#
+# The simulated chip implements the subset of the SX1262 command set
+# used by sx1262.py: the BUSY line, the IRQ status register raising the
+# DIO pin, the 256 bytes FIFO, the packet status, CAD, RX duty cycle and
+# the time on air of transmitted frames. Frames are delivered, via a
+# SimChannel, to the other simulated chips that are listening with the
+# same radio parameters.
+#
+# Usage: pass a SimRadio as 'backend' in the driver pinset.
+#
+#   channel = SimChannel()
+#   lora = SX1262({'backend':SimRadio(channel)}, rx_callback)
+#
+# The simulated time only advances when SimChannel.tick() is called:
+# the SimChannel.run() task calls it every millisecond.
+
+import time, asyncio
+from micropython import const
+import sx1262
+from airtime import time_on_air
+
+_FIFO_LEN = const(256)
+_CMD_BUF_LEN = const(260)
+
+# Time in microseconds the simulated chip keeps the BUSY line high
+# after each command. Commands not listed here take _DEFAULT_BUSY_US.
+_DEFAULT_BUSY_US = const(20)
+_WAKEUP_BUSY_US = const(350)
+_RESET_BUSY_US = const(3500)
+CommandBusyTime = {
+    sx1262.SetTxCmd: 100,
+    sx1262.SetRxCmd: 100,
+    sx1262.SetRxDutyCycleCmd: 100,
+    sx1262.SetDIO3AsTCXOCtrlCmd: 100,
+    sx1262.CalibrateImageCmd: 3500,
+}
+
+# Chip modes. The value is the one reported in the status byte.
+_MODE_STDBY = const(2)
+_MODE_RX = const(5)
+_MODE_TX = const(6)
+# Not reported as such by the real chip, that says RX for both.
+_MODE_RX_DUTY = const(8)
+_MODE_CAD = const(9)
+
+# Bandwidth in Hz for the SetModulationParams bandwidth argument.
+Bandwidth = {0: 7800, 8: 10400, 1: 15600, 9: 20800, 2: 31250, 10: 41700,
+             3: 62500, 4: 125000, 5: 250000, 6: 500000}
+
+# A pin that calls 'callback' with the new value when it changes. The
+# driver registers the DIO handler with irq(), and the simulated chip
+# calls it when an IRQ is raised.
+class SimPin:
+    def __init__(self, callback=None):
+        self.v = 1
+        self.callback = callback
+        self.handler = None
+
+    def value(self, v=None):
+        if v == None: return self.v
+        if v != self.v and self.callback: self.callback(v)
+        self.v = v
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def irq(self, handler=None, trigger=None):
+        self.handler = handler
+
+# The BUSY line: high for some time after each command, and while the
+# chip sleeps between the RX windows of the RX duty cycle mode.
+class SimBusyPin(SimPin):
+    def __init__(self, radio):
+        super().__init__()
+        self.radio = radio
+        self.busy_until = time.ticks_us()
+
+    def value(self, v=None):
+        if self.radio.sleeping(): return 1
+        return 1 if time.ticks_diff(self.busy_until, time.ticks_us()) > 0 else 0
+
+# The SPI bus: the bytes are passed to the simulated chip, that fills
+# the reply while the command is transferred, and executes it when the
+# chip select line goes high.
+class SimSPI:
+    def __init__(self, radio):
+        self.radio = radio
+
+    def write(self, data):
+        self.radio.transfer(data, None)
+
+    def write_readinto(self, data, reply):
+        self.radio.transfer(data, reply)
+
+class SimRadio:
+    # 'rssi' and 'snr' are the signal quality of the frames this
+    # radio receives, unless SimChannel.set_link() says otherwise.
+    def __init__(self, channel=None, rssi=-60, snr=10):
+        self.channel = channel
+        self.rssi = rssi
+        self.snr = snr
+        self.busy_pin = SimBusyPin(self)
+        self.reset_pin = SimPin(self.reset_changed)
+        self.chipselect_pin = SimPin(self.chipselect_changed)
+        self.dio_pin = SimPin()
+        self.spi = SimSPI(self)
+
+        # Command being transferred while the chip is selected.
+        self.cmd = bytearray(_CMD_BUF_LEN)
+        self.cmd_len = 0
+
+        # Statistics.
+        self.tx_frames = 0
+        self.rx_frames = 0
+        self.rx_collisions = 0
+        self.reset()
+        if channel: channel.add(self)
+
+    # Called by the driver init_hardware(): install our pins and bus.
+    def attach(self, lora):
+        lora.busy_pin = self.busy_pin
+        lora.reset_pin = self.reset_pin
+        lora.chipselect_pin = self.chipselect_pin
+        lora.dio_pin = self.dio_pin
+        lora.spi = self.spi
+
+    # Chip state after power on or reset.
+    def reset(self):
+        self.mode = _MODE_STDBY
+        self.fifo = bytearray(_FIFO_LEN)
+        self.regs = {}
+        self.irq = 0
+        self.irq_mask = 0
+        self.freq = 0
+        self.sf = 7
+        self.bw = 125000
+        self.cr = 5
+        self.ldro = 0
+        self.preamble = 8
+        self.explicit_header = True
+        self.payload_len = 255
+        self.crc = 1
+        self.tx_base = 0
+        self.rx_base = 0
+        self.rx_len = 0
+        self.rx_start = 0
+        self.pkt_rssi = 0
+        self.pkt_snr = 0
+        self.cad_symbols = 2
+        self.duty_rx_us = 0
+        self.duty_period_us = 0
+        self.duty_start = 0
+        self.lock = None        # Transmission we are receiving.
+        self.lock_collided = False
+        self.rx_single = False  # Return in standby after this frame.
+        self.tx = None          # Transmission in progress.
+        self.op_end = 0         # End of current CAD, in ticks_us.
+
+    def reset_changed(self, v):
+        if v == 0: return
+        self.reset()
+        self.set_busy(_RESET_BUSY_US)
+
+    # A falling edge of the chip select line starts a new command, and
+    # wakes up the chip if it is sleeping. A rising edge ends it.
+    def chipselect_changed(self, v):
+        if v == 0:
+            self.cmd_len = 0
+            if self.sleeping():
+                self.mode = _MODE_STDBY
+                self.set_busy(_WAKEUP_BUSY_US)
+        else:
+            self.execute()
+
+    def set_busy(self, busy_us):
+        self.busy_pin.busy_until = time.ticks_add(time.ticks_us(), busy_us)
+
+    # True if the chip is in the sleep part of the RX duty cycle.
+    def sleeping(self):
+        if self.mode != _MODE_RX_DUTY: return False
+        elapsed = time.ticks_diff(time.ticks_us(), self.duty_start)
+        return elapsed % self.duty_period_us >= self.duty_rx_us
+
+    # True if the chip is listening, so that it may detect a preamble.
+    def listening(self):
+        if self.mode == _MODE_RX: return True
+        return self.mode == _MODE_RX_DUTY and not self.sleeping()
+
+    def status(self):
+        mode = self.mode
+        if mode == _MODE_RX_DUTY: mode = _MODE_RX
+        elif mode == _MODE_CAD: mode = _MODE_STDBY
+        return mode << 4
+
+    # Transfer the bytes in 'data', filling 'reply', if not None, with
+    # what the chip sends back.
+    def transfer(self, data, reply):
+        cmd = self.cmd
+        for i in range(len(data)):
+            pos = self.cmd_len
+            if pos < _CMD_BUF_LEN:
+                cmd[pos] = data[i]
+                self.cmd_len += 1
+            if reply != None: reply[i] = self.reply_byte(pos)
+
+    # Return the byte the chip sends at position 'pos' of the command
+    # being transferred.
+    def reply_byte(self, pos):
+        op = self.cmd[0]
+        if op == sx1262.ReadBufferCmd:
+            if pos < 3: return self.status()
+            return self.fifo[(self.cmd[1]+pos-3) & 0xff]
+        elif op == sx1262.ReadRegisterCmd:
+            if pos < 4: return self.status()
+            addr = (self.cmd[1] << 8 | self.cmd[2]) + pos - 4
+            return self.regs.get(addr, 0)
+        elif op == sx1262.GetIrqStatusCmd:
+            if pos == 2: return self.irq >> 8
+            if pos == 3: return self.irq & 0xff
+        elif op == sx1262.GetRxBufferStatusCmd:
+            if pos == 2: return self.rx_len
+            if pos == 3: return self.rx_start
+        elif op == sx1262.GetPacketStatusCmd:
+            if pos == 2 or pos == 4: return min(int(-self.pkt_rssi*2),255)
+            if pos == 3: return int(self.pkt_snr*4) & 0xff
+        elif op == 0x15:  # GetRssiInst
+            if pos == 2: return min(int(-self.rssi*2),255)
+        return self.status()
+
+    # Execute the command transferred, now that the chip was deselected.
+    def execute(self):
+        cmd = self.cmd
+        n = self.cmd_len
+        if n == 0: return
+        op = cmd[0]
+        self.set_busy(CommandBusyTime.get(op, _DEFAULT_BUSY_US))
+        if op == sx1262.SetStandByCmd:
+            self.stop()
+        elif op == sx1262.SetModulationParamsCmd:
+            self.sf = cmd[1]
+            self.bw = Bandwidth[cmd[2]]
+            self.cr = cmd[3]+4
+            self.ldro = cmd[4]
+        elif op == sx1262.SetPacketParamsCmd:
+            self.preamble = cmd[1] << 8 | cmd[2]
+            self.explicit_header = cmd[3] == sx1262.PacketHeaderTypeExplicit
+            self.payload_len = cmd[4]
+            self.crc = cmd[5]
+        elif op == sx1262.SetRfFrequencyCmd:
+            rf_freq = cmd[1] << 24 | cmd[2] << 16 | cmd[3] << 8 | cmd[4]
+            self.freq = rf_freq * 32000000 // (1 << 25)
+        elif op == sx1262.SetBufferBaseAddressCmd:
+            self.tx_base = cmd[1]
+            self.rx_base = cmd[2]
+        elif op == sx1262.WriteRegisterCmd:
+            addr = cmd[1] << 8 | cmd[2]
+            for i in range(3, n):
+                self.regs[addr+i-3] = cmd[i]
+        elif op == sx1262.WriteBufferCmd:
+            off = cmd[1]
+            for i in range(2, n):
+                self.fifo[(off+i-2) & 0xff] = cmd[i]
+        elif op == sx1262.SetDioIrqParamsCmd:
+            self.irq_mask = cmd[1] << 8 | cmd[2]
+        elif op == sx1262.ClearIrqStatusCmd:
+            self.irq &= ~(cmd[1] << 8 | cmd[2])
+        elif op == sx1262.SetRxCmd:
+            self.stop()
+            self.mode = _MODE_RX
+        elif op == sx1262.SetRxDutyCycleCmd:
+            self.stop()
+            # Periods are 24 bits values in units of 15.625 us.
+            rx = cmd[1] << 16 | cmd[2] << 8 | cmd[3]
+            sleep = cmd[4] << 16 | cmd[5] << 8 | cmd[6]
+            self.duty_rx_us = rx*15625//1000
+            self.duty_period_us = self.duty_rx_us + sleep*15625//1000
+            self.duty_start = time.ticks_us()
+            self.mode = _MODE_RX_DUTY
+        elif op == sx1262.SetTxCmd:
+            self.stop()
+            self.start_tx()
+        elif op == sx1262.SetCadParamsCmd:
+            self.cad_symbols = 1 << cmd[1]
+        elif op == sx1262.SetCadCmd:
+            self.stop()
+            self.mode = _MODE_CAD
+            cad_us = self.symbol_time_us()*self.cad_symbols
+            self.op_end = time.ticks_add(time.ticks_us(), cad_us)
+        elif op == sx1262.SleepCmd:
+            self.stop()
+        # Other commands (calibration, PA and TCXO setup, ...) don't
+        # change the simulated chip state.
+
+    # Leave the current mode, aborting transmissions and receptions.
+    def stop(self):
+        if self.tx: self.channel.end_tx(self.tx, aborted=True)
+        self.tx = None
+        self.lock = None
+        self.rx_single = False
+        self.mode = _MODE_STDBY
+
+    def symbol_time_us(self):
+        return (1 << self.sf) * 1000000 // self.bw
+
+    # Transmit the frame in the FIFO, as long as the payload length
+    # set with SetPacketParams.
+    def start_tx(self):
+        frame = bytes(self.fifo[self.tx_base:self.tx_base+self.payload_len])
+        toa_ms = time_on_air(len(frame), self.sf, self.bw, self.cr,
+            self.preamble, self.explicit_header, self.crc != 0, self.ldro != 0)
+        self.mode = _MODE_TX
+        self.tx_frames += 1
+        if self.channel:
+            self.tx = self.channel.start_tx(self, frame, toa_ms)
+        else:
+            # Nobody listening: the transmission just ends after the
+            # time on air. See tick().
+            self.tx = None
+            self.op_end = time.ticks_add(time.ticks_us(), int(toa_ms*1000))
+
+    # Set the specified IRQ flags, raising the DIO line if the
+    # IRQ is enabled.
+    def raise_irq(self, flags):
+        self.irq |= flags
+        if flags & self.irq_mask and self.dio_pin.handler:
+            self.dio_pin.handler(self.dio_pin)
+
+    # Put a frame in the FIFO as if it was received from the air, and
+    # raise the RX done IRQ. Used to test the driver RX path without
+    # a channel.
+    def inject(self, frame, bad_crc=False):
+        self.rx_start = self.rx_base
+        self.rx_len = len(frame)
+        for i in range(len(frame)):
+            self.fifo[(self.rx_base+i) & 0xff] = frame[i]
+        self.pkt_rssi = self.rssi
+        self.pkt_snr = self.snr
+        self.rx_frames += 1
+        flags = sx1262.IRQSourceRxDone
+        if bad_crc: flags |= sx1262.IRQSourceCrcErr
+        self.raise_irq(flags)
+
+    # Called by the channel when a transmission we were receiving ends.
+    def receive(self, frame, rssi, snr, collided):
+        self.rssi, rx_rssi = rssi, self.rssi
+        self.snr, rx_snr = snr, self.snr
+        if collided: self.rx_collisions += 1
+        self.inject(frame, collided)
+        self.rssi = rx_rssi
+        self.snr = rx_snr
+        # In RX duty cycle mode the chip returns in standby after
+        # receiving a frame, while in continuous mode it keeps
+        # receiving.
+        if self.rx_single:
+            self.rx_single = False
+            self.mode = _MODE_STDBY
+
+    # Called by the channel: lock to the transmission 'tx', whose
+    # preamble is on air, and start receiving it.
+    def lock_tx(self, tx, collided):
+        self.lock = tx
+        self.lock_collided = collided
+        # A preamble detected during an RX window keeps the chip in RX
+        # till the end of the frame.
+        if self.mode == _MODE_RX_DUTY:
+            self.mode = _MODE_RX
+            self.rx_single = True
+        self.raise_irq(sx1262.IRQSourcePreambleDetected)
+
+    # Advance the simulated time: complete CAD and transmissions
+    # without a channel.
+    def tick(self, now):
+        if self.mode == _MODE_CAD:
+            if time.ticks_diff(now, self.op_end) >= 0:
+                self.mode = _MODE_STDBY
+                flags = sx1262.IRQSourceCadDone
+                if self.channel and self.channel.busy(self):
+                    flags |= sx1262.IRQSourceCadDetected
+                self.raise_irq(flags)
+        elif self.mode == _MODE_TX and self.tx == None:
+            if time.ticks_diff(now, self.op_end) >= 0:
+                self.tx_done()
+
+    # Called when our transmission is over.
+    def tx_done(self):
+        self.tx = None
+        self.mode = _MODE_STDBY
+        self.raise_irq(sx1262.IRQSourceTxDone)
+
+# A transmission on the air.
+class SimTransmission:
+    def __init__(self, radio, frame, start, preamble_end, end):
+        self.radio = radio
+        self.frame = frame
+        self.start = start
+        self.preamble_end = preamble_end
+        self.end = end
+
+# The channel connecting the simulated chips. Frames are received by
+# the chips in range listening on the same frequency, spreading and
+# bandwidth. A chip listening while a preamble is on the air locks to
+# the frame, and receives it with the CRC error flag set if another
+# audible transmission overlaps with it.
+#
+# 'airtime_scale' multiplies the time on air of the frames: 0 delivers
+# frames instantly at the next tick(), useful to measure the host CPU
+# cost of the protocol without waiting for the radio.
+class SimChannel:
+    def __init__(self, airtime_scale=1):
+        self.airtime_scale = airtime_scale
+        self.radios = []
+        self.links = {}     # (tx,rx) -> (rssi,snr) or None if out of range.
+        self.on_air = []
+
+    def add(self, radio):
+        self.radios.append(radio)
+
+    # Set the signal quality of the frames 'a' and 'b' receive from each
+    # other. If rssi is None, the two radios can't hear each other.
+    def set_link(self, a, b, rssi, snr=10):
+        link = None if rssi == None else (rssi, snr)
+        self.links[(a,b)] = link
+        self.links[(b,a)] = link
+
+    # Return the (rssi,snr) of the frames 'rx' receives from 'tx', or
+    # None if out of range.
+    def link(self, tx, rx):
+        return self.links.get((tx,rx), (rx.rssi, rx.snr))
+
+    # True if the two radios use the same channel and modulation.
+    def same_params(self, a, b):
+        return a.freq == b.freq and a.sf == b.sf and a.bw == b.bw
+
+    def start_tx(self, radio, frame, toa_ms):
+        now = time.ticks_us()
+        toa_us = int(toa_ms*1000*self.airtime_scale)
+        preamble_us = int(radio.preamble*radio.symbol_time_us()*self.airtime_scale)
+        tx = SimTransmission(radio, frame, now,
+                             time.ticks_add(now, preamble_us),
+                             time.ticks_add(now, toa_us))
+        # Receivers locked to other frames now get a collision.
+        for r in self.radios:
+            if r.lock and self.audible(tx, r): r.lock_collided = True
+        self.on_air.append(tx)
+        return tx
+
+    def end_tx(self, tx, aborted=False):
+        self.on_air.remove(tx)
+        for r in self.radios:
+            if r.lock != tx: continue
+            r.lock = None
+            if aborted: continue
+            rssi, snr = self.link(tx.radio, r)
+            r.receive(tx.frame, rssi, snr, r.lock_collided)
+
+    # True if 'r' can hear the transmission 'tx'.
+    def audible(self, tx, r):
+        return (r != tx.radio and self.link(tx.radio, r) != None and
+                self.same_params(tx.radio, r))
+
+    # True if 'radio' would detect activity on the channel with a CAD.
+    def busy(self, radio):
+        for tx in self.on_air:
+            if self.audible(tx, radio): return True
+        return False
+
+    # Advance the simulated time: receivers lock to preambles on the
+    # air, and transmissions whose time on air elapsed are delivered.
+    def tick(self):
+        now = time.ticks_us()
+        for tx in self.on_air:
+            # Only receivers listening while the preamble is on the air
+            # can receive the frame. With airtime_scale 0 the frame is
+            # all sent at once.
+            if time.ticks_diff(now, tx.preamble_end) > 0 and \
+               tx.preamble_end != tx.start: continue
+            for r in self.radios:
+                if r.lock or not r.listening() or not self.audible(tx, r):
+                    continue
+                collided = False
+                for other in self.on_air:
+                    if other != tx and self.audible(other, r):
+                        collided = True
+                r.lock_tx(tx, collided)
+        for tx in self.on_air[:]:
+            if time.ticks_diff(now, tx.end) >= 0:
+                self.end_tx(tx)
+                tx.radio.tx_done()
+        for r in self.radios: r.tick(now)
+
+    # Task calling tick() every 'period_ms' milliseconds.
+    async def run(self, period_ms=1):
+        while True:
+            self.tick()
+            await asyncio.sleep_ms(period_ms)
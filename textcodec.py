@@ -0,0 +1,126 @@
+# Copyright (C) 2024 Salvatore Sanfilippo <antirez@gmail.com>
+# All Rights Reserved
+#
+# This code is released under the BSD 2 clause license.
+# See the LICENSE file for more information
+
+# Compression of short strings using a static dictionary, in the spirit
+# of SMAZ: the dictionary contains letters, syllables and words common
+# in chat messages and sensor readings, and each of them is replaced by
+# a single byte, its index in the dictionary. Bytes not covered by the
+# dictionary are emitted verbatim, after an escape byte:
+#
+#   0-253    Dictionary entry.
+#   254 <b>  The byte <b>.
+#   255 <len> <bytes>  A run of 'len' bytes.
+#
+# There is no header and no length: the compressed data is only
+# meaningful given its length, that the caller must store.
+
+from micropython import const
+
+_ESC_BYTE = const(254)
+_ESC_RUN = const(255)
+_MAX_RUN = const(255)
+
+# Entries are separated by '|'. Single letters should stay first, so
+# that codes of common letters don't change if more entries are added.
+_DICTIONARY = (
+    " |e|t|a|o|i|n|s|r|h|l|d|u|c|m|y|w|g|f|p|b|k|v|x|j|q|z|"
+    "I|A|T|S|H|W|O|C|M|N|B|L|D|P|R|E|G|F|"
+    ".|,|!|?|:|;|-|=|%|'|/|(|)|+|\n|"
+    "0|1|2|3|4|5|6|7|8|9|00|10|20|.0|.5|"
+    " the | the|the|The | and|and|ing |ing|ion| of | to | is | in |"
+    " it | a | I |I'm|'s|n't| you|you|You|are|was|for|not|but|"
+    "with|have|this|that|what|What|where|when|how|here|there|"
+    "ok|OK|ok |yes|Yes|no |No |hi |Hi |hey|Hey|hello|Hello|"
+    "thanks|Thanks|please|good|see|now|just|can|will|all|"
+    "ciao|Ciao|grazie| di | il | la | che | e |"
+    "er|re|on|an|en|at|es|ed|te|ti|or|st|ar|nd|nt|is|of|it|al|as|"
+    "ha|ng|co|se|me|de|ou|le|ve|ll|ne|ea|ro|ri|li|ra|io|ic|el|ch|"
+    "ca|ma|ta|la|si|to|in|he|th|be|ho|ow|wh|ay|om|ut|ur|ck|ly|"
+    ", |. |! |? |: |  |...|"
+    "temp|hum|bat|volt|rssi|snr|node|msg|°C|km|ms|dBm|"
+    "http|www|.com|.org"
+).split('|')
+
+# Code of each dictionary entry, and for every byte value the entries
+# starting with it, longest first, so that the compressor finds the
+# longest match trying just a few entries.
+_CODEBOOK = [entry.encode() for entry in _DICTIONARY]
+_BY_FIRST_BYTE = {}
+for code, entry in enumerate(_CODEBOOK):
+    _BY_FIRST_BYTE.setdefault(entry[0],[]).append((entry,code))
+for entries in _BY_FIRST_BYTE.values():
+    entries.sort(key=lambda e: -len(e[0]))
+
+# Emit the pending verbatim bytes to 'out'.
+def _flush_verbatim(out, verbatim):
+    if len(verbatim) == 1:
+        out.append(_ESC_BYTE)
+        out.append(verbatim[0])
+    elif len(verbatim):
+        out.append(_ESC_RUN)
+        out.append(len(verbatim))
+        out.extend(verbatim)
+
+# Compress the bytes 'data', returning the compressed bytes.
+def compress(data):
+    out = bytearray()
+    verbatim = bytearray()
+    i = 0
+    while i < len(data):
+        for entry, code in _BY_FIRST_BYTE.get(data[i],()):
+            if data.startswith(entry,i): break
+        else:
+            verbatim.append(data[i])
+            i += 1
+            if len(verbatim) == _MAX_RUN:
+                _flush_verbatim(out, verbatim)
+                verbatim = bytearray()
+            continue
+        _flush_verbatim(out, verbatim)
+        verbatim = bytearray()
+        out.append(code)
+        i += len(entry)
+    _flush_verbatim(out, verbatim)
+    return bytes(out)
+
+# Decompress the bytes produced by compress(). Raise ValueError if the
+# data is truncated or uses dictionary entries we don't have.
+def decompress(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c == _ESC_BYTE:
+            if i+1 >= len(data): raise ValueError("truncated escape")
+            out.append(data[i+1])
+            i += 2
+        elif c == _ESC_RUN:
+            if i+1 >= len(data) or i+2+data[i+1] > len(data):
+                raise ValueError("truncated run")
+            out.extend(data[i+2:i+2+data[i+1]])
+            i += 2+data[i+1]
+        elif c < len(_CODEBOOK):
+            out.extend(_CODEBOOK[c])
+            i += 1
+        else:
+            raise ValueError("unknown code")
+    return bytes(out)
+
+# Encode 'text' in at most 'max_len' bytes. Return a (data, compressed)
+# tuple: the text is compressed only if this makes it shorter (and
+# if 'can_compress' is True), and if it does not fit it is truncated.
+def encode_text(text, max_len, can_compress=True):
+    while True:
+        data = text.encode()
+        compressed = False
+        if can_compress:
+            packed = compress(data)
+            compressed = len(packed) < len(data)
+            if compressed: data = packed
+        if len(data) <= max_len: return data, compressed
+        # Every character is at least a byte, so removing as many
+        # characters as the excess bytes gets us at least near.
+        text = text[:len(text)-(len(data)-max_len)]
@@ -25,6 +25,7 @@ class WebServer:
         self.active = False
         self.server_task = None
         self.dns_task = None
+        self.airtime_callback = None
 
         # Captive Portal Detection Routes
         @self.app.route('/generate_204')
@@ -73,6 +74,15 @@ class WebServer:
             
             return json.dumps(response), 200, {'Content-Type': 'application/json'}
         
+        @self.app.route('/airtime')
+        async def airtime(request):
+            return self.read_html('/server/airtime.html'), 200, {'Content-Type': 'text/html'}
+
+        @self.app.route('/airtime/get')
+        async def get_airtime(request):
+            info = self.airtime_callback() if self.airtime_callback else {}
+            return json.dumps(info), 200, {'Content-Type': 'application/json'}
+
         @self.app.route('/clock')
         async def clock(request):
             return self.read_html('/server/clock.html'), 200, {'Content-Type': 'text/html'}
@@ -130,6 +140,11 @@ class WebServer:
             await self.command_queue.put('toggle_display')
             return 'Display toggled!', 200
 
+    # Register the function returning the predicted airtime information
+    # shown in the /airtime page.
+    def set_airtime_callback(self, callback_function):
+        self.airtime_callback = callback_function
+
     def get_info(self):
         return ServerInfo(ssid=self.ssid, active=self.active)
 